@@ -0,0 +1,266 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from canvas import codec
+from canvas.localserver import MemoryStore, fixtures
+from canvas.object import Object
+from canvas.package import Package, PackageSet
+from canvas.repository import Repository
+from canvas.template import Template
+from canvas.texttable import TextTable
+
+
+def _rows(templates, packages, repos, objects):
+    store = MemoryStore()
+    fixtures(store, templates=templates, packages=packages, repos=repos, objects=objects)
+
+    # round trip through JSON so no strings are shared with the fixtures,
+    # as is the case for templates decoded from the server
+    return json.loads(json.dumps(store.find('template')))
+
+
+def _built(template):
+    # build the lazily built content of the template, without building the
+    # views (unions) returned by its public properties
+    template._packages
+    template._repos
+    template._objects
+
+    return template
+
+
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        start = time.monotonic()
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+        elapsed = time.monotonic() - start
+
+    finally:
+        tracemalloc.stop()
+
+    return (result, after - before, elapsed)
+
+
+def memory(templates=100, packages=1000, repos=10, objects=10):
+    """
+    Measures the memory retained by Package, Repository and Object instances,
+    and by whole Templates, built from synthetic server responses.
+
+    Returns:
+      List of dicts with the kind, count, total bytes, bytes per item and
+      seconds taken to build.
+    """
+
+    rows = _rows(templates, packages, repos, objects)
+    results = []
+
+    def _record(kind, build, count=len):
+        (items, size, elapsed) = _measure(build)
+
+        results.append({
+            'kind':    kind,
+            'count':   count(items),
+            'bytes':   size,
+            'per':     round(size / max(count(items), 1), 1),
+            'seconds': round(elapsed, 3)
+        })
+
+    _record('package', lambda: [Package(p, template='canvas:{0}'.format(r['stub']))
+                                for r in rows for p in r['packages']])
+    _record('repository', lambda: [Repository(o, template='canvas:{0}'.format(r['stub']))
+                                   for r in rows for o in r['repos']])
+    _record('object', lambda: [Object(o) for r in rows for o in r['objects']])
+
+    # templates are measured per package, repo and object they hold, both
+    # fully built and as loaded (their content is only built on access)
+    def _count(templates):
+        return sum(len(r['packages']) + len(r['repos']) + len(r['objects']) for r in rows[:len(templates)])
+
+    _record('template', lambda: [_built(Template(r)) for r in rows], count=_count)
+    _record('template (lazy)', lambda: [Template(r) for r in rows], count=_count)
+
+    return results
+
+
+def parse(count=50000):
+    """
+    Compares building a PackageSet from package strings one at a time via
+    Package against the bulk PackageSet.parse.
+
+    Returns:
+      List of dicts with the method, count, seconds and microseconds per
+      package string.
+    """
+
+    forms = ['package-{0}', '~package-{0}:x86_64', 'package-{0}@1.{0}-1', '!package-{0}#1@2.0-3:i686', '@group {0}']
+    specs = [forms[i % len(forms)].format(i) for i in range(count)]
+
+    results = []
+
+    def _record(method, build):
+        start = time.monotonic()
+        packages = build()
+        elapsed = time.monotonic() - start
+
+        results.append({
+            'method':  method,
+            'count':   len(packages),
+            'seconds': round(elapsed, 3),
+            'per':     round(elapsed * 1000000 / max(count, 1), 2)
+        })
+
+    _record('Package', lambda: PackageSet(Package(s) for s in specs))
+    _record('PackageSet.parse', lambda: PackageSet.parse(specs)[0])
+
+    return results
+
+
+def serialize(packages=10000, repeat=5):
+    """
+    Compares encoding a synthetic template to JSON by encoding its whole
+    to_object() form against Template.to_json, which joins the encodings of
+    each package and repo. Decoding is measured too. Each available codec
+    backend is measured.
+
+    Returns:
+      List of dicts with the method, backend, seconds per run and
+      microseconds per package.
+    """
+
+    rows = _rows(1, packages, 10, 10)
+    results = []
+
+    def _record(method, run, count=repeat):
+        start = time.monotonic()
+
+        for i in range(count):
+            run()
+
+        elapsed = (time.monotonic() - start) / max(count, 1)
+
+        results.append({
+            'method':  method,
+            'backend': codec.backend(),
+            'seconds': round(elapsed, 4),
+            'per':     round(elapsed * 1000000 / max(packages, 1), 2)
+        })
+
+    previous = codec.backend()
+
+    try:
+        for b in codec.BACKENDS:
+            try:
+                codec.set_backend(b)
+
+            except ValueError:
+                continue
+
+            t = Template(rows[0])
+            data = t.to_json()
+
+            _record('to_object', lambda: codec.dumps(t.to_object()))
+            _record('to_json', t.to_json)
+            _record('loads', lambda: codec.loads(data))
+
+    finally:
+        codec.set_backend(previous)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Canvas client benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    p = subparsers.add_parser('memory', help='memory held by loaded templates')
+    p.add_argument('--templates', type=int, default=100, help='number of synthetic templates')
+    p.add_argument('--packages', type=int, default=1000, help='packages per synthetic template')
+    p.add_argument('--repos', type=int, default=10, help='repos per synthetic template')
+    p.add_argument('--objects', type=int, default=10, help='objects per synthetic template')
+    p.add_argument('--json', action='store_true', help='output results as JSON')
+
+    p = subparsers.add_parser('parse', help='bulk package string parsing')
+    p.add_argument('--count', type=int, default=50000, help='number of package strings')
+    p.add_argument('--json', action='store_true', help='output results as JSON')
+
+    p = subparsers.add_parser('serialize', help='template JSON encoding and decoding')
+    p.add_argument('--packages', type=int, default=10000, help='packages in the synthetic template')
+    p.add_argument('--repeat', type=int, default=5, help='runs to average over')
+    p.add_argument('--json', action='store_true', help='output results as JSON')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'memory':
+        results = memory(templates=args.templates, packages=args.packages, repos=args.repos, objects=args.objects)
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+
+        else:
+            l = TextTable(header=['KIND', 'COUNT', 'BYTES', 'BYTES/ITEM', 'SECONDS'])
+
+            for r in results:
+                l.add_row([r['kind'], r['count'], r['bytes'], r['per'], r['seconds']])
+
+            print(l)
+
+    elif args.benchmark == 'parse':
+        results = parse(count=args.count)
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+
+        else:
+            l = TextTable(header=['METHOD', 'COUNT', 'SECONDS', 'USEC/ITEM'])
+
+            for r in results:
+                l.add_row([r['method'], r['count'], r['seconds'], r['per']])
+
+            print(l)
+
+    elif args.benchmark == 'serialize':
+        results = serialize(packages=args.packages, repeat=args.repeat)
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+
+        else:
+            l = TextTable(header=['METHOD', 'BACKEND', 'SECONDS', 'USEC/PACKAGE'])
+
+            for r in results:
+                l.add_row([r['method'], r['backend'], r['seconds'], r['per']])
+
+            print(l)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from canvas import codec
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'canvas')
+
+
+def _read_json(path):
+    try:
+        with open(path, 'rb') as f:
+            return codec.loads(f.read())
+
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    # write atomically so concurrent canvas processes never see a partially
+    # written file
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(codec.dumps(data))
+
+        os.replace(tmp_path, path)
+
+    except (IOError, OSError) as e:
+        logging.debug('Unable to write cache file {0}: {1}'.format(path, e))
+
+
+class LookupIndex(object):
+    """
+    A persistent index of [user:]name[@version] lookups to uuids.
+
+    Lookups are grouped by kind (eg. 'template' or 'machine') and stored as a
+    single JSON file, allowing repeated operations on the same template or
+    machine to skip the server side name lookup.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.environ.get('CANVAS_TEMPLATE_CACHE', CACHE_PATH), 'index.json')
+
+        self._path = path
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        index = _read_json(self._path)
+
+        if not isinstance(index, dict):
+            index = {}
+
+        return index
+
+    def _save(self, index):
+        self._index = index
+        _write_json(self._path, index)
+
+    #
+    # PROPERTIES
+    @property
+    def path(self):
+        return self._path
+
+    #
+    # PUBLIC METHODS
+    def clear(self):
+        with self._lock:
+            self._save({})
+
+    def discard(self, kind, unv=None, uuid=None):
+        """ Remove the lookup for unv and/or all lookups resolving to uuid. """
+        with self._lock:
+            # merge with any changes made by other processes
+            index = self._load()
+            lookups = index.get(kind, {})
+
+            drop = [k for k, v in lookups.items() if k == unv or (uuid is not None and v == uuid)]
+
+            if len(drop):
+                for k in drop:
+                    del lookups[k]
+
+                self._save(index)
+
+            else:
+                self._index = index
+
+    def get(self, kind, unv):
+        if unv is None:
+            return None
+
+        with self._lock:
+            if self._index is None:
+                self._index = self._load()
+
+            return self._index.get(kind, {}).get(unv)
+
+    def set(self, kind, unv, uuid):
+        if unv is None or uuid is None:
+            return
+
+        self.update(kind, {unv: uuid})
+
+    def update(self, kind, lookups):
+        """ Record a dict of unv to uuid lookups, writing only on change. """
+        with self._lock:
+            if self._index is None:
+                self._index = self._load()
+
+            current = self._index.get(kind, {})
+
+            if all(current.get(k) == v for k, v in lookups.items()):
+                return
+
+            # merge with any changes made by other processes
+            index = self._load()
+            index.setdefault(kind, {}).update(lookups)
+
+            self._save(index)
+
+
+class CompiledCache(object):
+    """
+    An on-disk cache of compiled templates, ie. templates with all includes
+    resolved and flattened, rendered once and reused until the template or
+    any of its includes change.
+
+    Each artifact is keyed by the versions of the template and its includes
+    (see Template.versions) and the layout under path is:
+      <uuid>/manifest.json  - key, versions, digest and artifact file names
+      <uuid>/template.json  - resolved template (see Template.to_compiled)
+      <uuid>/template.ks    - resolved kickstart
+    """
+
+    MANIFEST = 'manifest.json'
+    JSON = 'template.json'
+    KICKSTART = 'template.ks'
+
+    def __init__(self, path):
+        self._path = path
+
+    def _dir(self, uuid):
+        return os.path.join(self._path, uuid)
+
+    #
+    # PROPERTIES
+    @property
+    def path(self):
+        return self._path
+
+    #
+    # PUBLIC METHODS
+    def clear(self):
+        """ Remove all compiled artifacts. """
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def get(self, uuid, versions=None):
+        """
+        Returns the manifest of the compiled template uuid.
+
+        Args:
+          uuid: template uuid.
+          versions: only return the manifest if compiled from these versions.
+
+        Returns:
+          Manifest dict or None if not compiled (or outdated).
+        """
+
+        m = self.manifest(uuid)
+
+        if m is None:
+            return None
+
+        if versions is not None and m.get('key') != self.key(versions):
+            return None
+
+        return m
+
+    def invalidate(self, uuid):
+        """ Remove the compiled artifact of the template uuid. """
+        if uuid is not None:
+            shutil.rmtree(self._dir(uuid), ignore_errors=True)
+
+    @staticmethod
+    def key(versions):
+        """ Returns the artifact key of a dict of template versions. """
+        data = json.dumps(versions, separators=(',', ':'), sort_keys=True, default=str)
+
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def kickstart(self, uuid):
+        """ Returns the path of the compiled kickstart of the template uuid. """
+        return os.path.join(self._dir(uuid), self.KICKSTART)
+
+    def load(self, uuid):
+        """ Returns the compiled template data of the template uuid, if any. """
+        if uuid is None:
+            return None
+
+        return _read_json(os.path.join(self._dir(uuid), self.JSON))
+
+    def manifest(self, uuid):
+        """ Returns the manifest of the template uuid regardless of versions. """
+        if uuid is None:
+            return None
+
+        m = _read_json(os.path.join(self._dir(uuid), self.MANIFEST))
+
+        # the artifacts are written before the manifest, so an existing
+        # manifest implies complete artifacts unless removed since
+        if m is None or not os.path.exists(self.kickstart(uuid)):
+            return None
+
+        return m
+
+    def put(self, template):
+        """
+        Compiles a resolved template, writing its JSON and kickstart
+        artifacts followed by the manifest.
+
+        Args:
+          template: Template with all includes resolved.
+
+        Returns:
+          Manifest dict, or None if the template has no uuid or the artifacts
+          could not be written.
+        """
+
+        uuid = template.uuid
+
+        if uuid is None:
+            return None
+
+        data = template.to_compiled()
+        path = self._dir(uuid)
+
+        _write_json(os.path.join(path, self.JSON), data)
+
+        # stream the kickstart, again atomically
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=path)
+
+            with os.fdopen(fd, 'w') as f:
+                template.write_kickstart(f, resolved=True)
+
+            os.replace(tmp_path, self.kickstart(uuid))
+
+        except (IOError, OSError) as e:
+            logging.debug('Unable to write compiled kickstart for {0}: {1}'.format(uuid, e))
+            return None
+
+        manifest = {
+            'uuid':      uuid,
+            'unv':       template.unv,
+            'key':       self.key(data['versions']),
+            'versions':  data['versions'],
+            'digest':    template.digest(resolved=True),
+            'compiled':  time.time(),
+            'json':      self.JSON,
+            'kickstart': self.KICKSTART
+        }
+
+        _write_json(os.path.join(path, self.MANIFEST), manifest)
+
+        return manifest
+
+
+class TemplateCache(object):
+    """
+    An on-disk cache of template data as returned by the canvas server.
+
+    Entries are stored per template uuid alongside the server reported
+    `updated` stamp and ETag (if any) so they can be revalidated cheaply. A
+    separate index maps [user:]name[@version] lookups to uuids, allowing
+    fresh entries to be served without touching the network at all.
+
+    The layout under path is:
+      index.json            - name lookups to uuid (see LookupIndex)
+      templates/<uuid>.json - cached entry for each template
+      compiled/<uuid>/      - compiled template artifacts (see CompiledCache)
+    """
+
+    def __init__(self, path=None, ttl=0):
+        if path is None:
+            path = os.environ.get('CANVAS_TEMPLATE_CACHE', CACHE_PATH)
+
+        self._path = path
+        self._ttl = float(ttl or 0)
+        self._index = LookupIndex(os.path.join(path, 'index.json'))
+        self._compiled = CompiledCache(os.path.join(path, 'compiled'))
+
+    def _entry_path(self, uuid):
+        return os.path.join(self._path, 'templates', '{0}.json'.format(uuid))
+
+    #
+    # PROPERTIES
+    @property
+    def compiled(self):
+        return self._compiled
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    #
+    # PUBLIC METHODS
+    def clear(self):
+        """ Remove all cached entries, lookups and compiled templates. """
+        self._index.clear()
+        self._compiled.clear()
+
+        try:
+            for f in os.listdir(os.path.join(self._path, 'templates')):
+                os.remove(os.path.join(self._path, 'templates', f))
+
+        except OSError:
+            pass
+
+    def entry(self, uuid):
+        """
+        Returns the cached entry for the template uuid.
+
+        An entry is a dict containing the template `data` along with the
+        `etag`, `updated` and `fetched` stamps used for revalidation.
+        """
+
+        if uuid is None:
+            return None
+
+        return _read_json(self._entry_path(uuid))
+
+    def get(self, unv=None, uuid=None, fresh=False):
+        """
+        Returns cached template data by uuid or name lookup.
+
+        Args:
+          unv: template lookup in the form [user:]name[@version].
+          uuid: template uuid, takes precedence over unv.
+          fresh: only return data fetched within the configured ttl.
+
+        Returns:
+          Template data dict or None if not cached (or stale).
+        """
+
+        if uuid is None:
+            uuid = self.lookup(unv)
+
+        e = self.entry(uuid)
+
+        if e is None:
+            return None
+
+        if fresh and not self.is_fresh(e):
+            return None
+
+        return e.get('data')
+
+    def invalidate(self, uuid=None, unv=None):
+        """ Remove the cached entry for uuid and/or any lookups referencing it. """
+        if uuid is None:
+            uuid = self.lookup(unv)
+
+        if uuid is None:
+            return
+
+        try:
+            os.remove(self._entry_path(uuid))
+
+        except OSError:
+            pass
+
+        self._compiled.invalidate(uuid)
+        self._index.discard('template', uuid=uuid)
+
+    def is_fresh(self, entry):
+        return (time.time() - entry.get('fetched', 0)) < self._ttl
+
+    def lookup(self, unv):
+        """ Returns the uuid last seen for the [user:]name[@version] lookup. """
+        return self._index.get('template', unv)
+
+    def put(self, unv, data, etag=None, updated=None):
+        """
+        Stores template data and records the lookup for unv.
+
+        Args:
+          unv: template lookup in the form [user:]name[@version].
+          data: template data dict as returned by the server.
+          etag: ETag returned by the server, if any.
+          updated: server reported update stamp, if any.
+        """
+
+        uuid = data.get('uuid')
+
+        if uuid is None:
+            return
+
+        if updated is None:
+            updated = data.get('updated')
+
+        _write_json(self._entry_path(uuid), {
+            'etag':    etag,
+            'updated': updated,
+            'fetched': time.time(),
+            'data':    data
+        })
+
+        self._index.set('template', unv, uuid)
+
+    def touch(self, uuid):
+        """ Marks the cached entry as freshly validated. """
+        e = self.entry(uuid)
+
+        if e is not None:
+            e['fetched'] = time.time()
+            _write_json(self._entry_path(uuid), e)
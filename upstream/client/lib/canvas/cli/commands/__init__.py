@@ -22,6 +22,8 @@ import logging
 import os
 import sys
 
+import canvas.timing
+from canvas.cache import TemplateCache
 import canvas.cli.commands.argparsers.root
 import canvas.cli.commands.argparsers.config
 import canvas.cli.commands.argparsers.template
@@ -78,6 +80,14 @@ def buildCommandLineParser(config):
         default=config.get('core', 'host', CANVAS_HOST),
         help='url of the canvas server'
     )
+    connection_overrides.add_argument(
+        '--timings',
+        action='store_true',
+        help=(
+            'print request latency and payload timings on exit. '
+            'Set CANVAS_TIMINGS=json for JSON output'
+        )
+    )
 
     verbose = argparse.ArgumentParser(add_help=False)
     verbose.add_argument(
@@ -207,6 +217,11 @@ def parseCommandLine(config):
     argcomplete.autocomplete(parsers.main)
     args, args_extra = parsers.main.parse_known_args()
 
+    # enable timings before any service is created
+    if getattr(args, 'timings', False):
+        output = os.environ.get('CANVAS_TIMINGS', 'table').lower()
+        canvas.timing.enable(output='json' if output == 'json' else 'table')
+
     return (parsers, args, args_extra)
 
 
@@ -228,6 +243,21 @@ class Command(object):
     def __init__(self, prog_name='canvas'):
         self.prog_name = prog_name
 
+    def _delta_updates(self, config):
+        # send template changes as deltas, see core.delta_updates
+        return str(config.get('core', 'delta_updates', '0')).lower() in ('1', 'true', 'yes', 'on')
+
+    def _template_cache(self, config):
+        # the local template cache, as configured by cache.path and cache.ttl
+        try:
+            ttl = int(config.get('cache', 'ttl', 0))
+
+        except ValueError:
+            logging.warning('invalid cache.ttl {0}, caching disabled'.format(config.get('cache', 'ttl')))
+            ttl = 0
+
+        return TemplateCache(path=config.get('cache', 'path'), ttl=ttl)
+
     def configure(self, config, args, args_extra):
         pass
 
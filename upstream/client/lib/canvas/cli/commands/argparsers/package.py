@@ -38,6 +38,22 @@ def build(subparsers, **kwargs):
         help='package name'
     )
 
+    # packages to add or update may also be read from package list files
+    package_lists = argparse.ArgumentParser(add_help=False)
+    package_lists.add_argument(
+        'package',
+        nargs='*',
+        help='package name'
+    )
+    package_lists.add_argument(
+        '-f', '--file',
+        dest='files',
+        action='append',
+        default=[],
+        metavar='PATH',
+        help='read packages from a package list file, may be given more than once'
+    )
+
     #
     # ADD ARGUMENTS
     #
@@ -49,7 +65,7 @@ def build(subparsers, **kwargs):
             kwargs["verbose"],
             kwargs["template"],
             kwargs["connection_overrides"],
-            packages
+            package_lists
         ],
         help='add packages to a template'
     )
@@ -70,7 +86,7 @@ def build(subparsers, **kwargs):
             kwargs["verbose"],
             kwargs["template"],
             kwargs["connection_overrides"],
-            packages
+            package_lists
         ],
         help='update packages to a template'
     )
@@ -88,6 +104,18 @@ def build(subparsers, **kwargs):
         ],
         help='list packages in a template'
     )
+    package_list_parser.add_argument(
+        '--filter-name',
+        dest='filter_name',
+        metavar='PATTERN',
+        help='only list packages with names matching the glob pattern'
+    )
+    package_list_parser.add_argument(
+        '--filter-arch',
+        dest='filter_arch',
+        metavar='PATTERN',
+        help='only list packages with archs matching the glob pattern, - for no arch'
+    )
 
     #
     # REMOVE ARGUMENTS
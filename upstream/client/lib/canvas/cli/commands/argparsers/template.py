@@ -69,6 +69,27 @@ def build(subparsers, **kwargs):
         help='add new template'
     )
 
+    #
+    # COMPILE ARGUMENTS
+    #
+    template_compile_parser = subparsers_template.add_parser(
+        'compile',
+        description=(
+            'Resolve a template and its includes and compile the result, '
+            'as JSON and kickstart, to the local cache.'
+        ),
+        parents=[
+            kwargs["template"],
+            kwargs["connection_overrides"],
+        ],
+        help='compile a resolved template to the local cache'
+    )
+    template_compile_parser.add_argument(
+        '--force',
+        action='store_true',
+        help='compile even if the compiled template is current'
+    )
+
     #
     # COPY ARGUMENTS
     #
@@ -25,6 +25,7 @@ import sys
 from canvas.cli.commands import Command
 from canvas.machine import Machine
 from canvas.package import Package
+from canvas.packagetable import PackageTable
 from canvas.repository import Repository
 from canvas.service import Service, ServiceException
 from canvas.template import Template
@@ -174,18 +175,19 @@ class MachineCommand(Command):
 
         ts = Template.from_system()
 
-        (l_r, r_l) = t.package_diff(ts.packages_all)
+        packages = PackageTable.from_packages(t.packages_all)
+        (l_r, r_l) = packages.diff(PackageTable.from_packages(ts.packages_all, strings=packages.strings))
 
         print("In template not in system:")
 
-        for p in l_r:
-            print(" - {0}".format(p.name))
+        for name in l_r.column('name'):
+            print(" - {0}".format(name))
 
         print()
         print("On system not in template:")
 
-        for p in r_l:
-            print(" + {0}".format(p.name))
+        for name in r_l.column('name'):
+            print(" + {0}".format(name))
 
         print()
 
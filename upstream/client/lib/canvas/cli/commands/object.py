@@ -38,7 +38,8 @@ class ObjectCommand(Command):
         self.config = config
 
         # create our canvas service object
-        self.cs = Service(host=args.host, username=args.username)
+        self.cs = Service(host=args.host, username=args.username,
+            delta_updates=self._delta_updates(config))
 
         # store args for additional processing
         self.args = args
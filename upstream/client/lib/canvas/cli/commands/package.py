@@ -17,10 +17,12 @@
 #
 
 import logging
+import os
 import sys
 
 from canvas.cli.commands import Command
-from canvas.package import Package
+from canvas.package import Package, PackageSet
+from canvas.packagetable import PackageTable
 from canvas.service import Service, ServiceException
 from canvas.template import Template
 from canvas.texttable import TextTable
@@ -29,6 +31,40 @@ logger = logging.getLogger('canvas')
 
 
 class PackageCommand(Command):
+    def _parse_packages(self):
+        # packages are given as package strings and package list files (-f)
+        packages = PackageSet()
+        failed = False
+
+        if not self.args.package and not self.args.files:
+            print('error: no packages or package list files specified')
+            return None
+
+        for p in self.args.files:
+            if not os.path.isfile(p):
+                print('error: {0}: package list file not found'.format(p))
+                failed = True
+                continue
+
+            (ps, errors) = PackageSet.parse(p)
+            packages.update(ps)
+
+            for (lineno, line, reason) in errors:
+                print('error: {0}:{1}: {2}: {3}'.format(p, lineno, reason, line))
+                failed = True
+
+        (ps, errors) = PackageSet.parse(self.args.package)
+        packages.update(ps)
+
+        for (lineno, line, reason) in errors:
+            print('error: {0}: {1}'.format(reason, line))
+            failed = True
+
+        if failed:
+            return None
+
+        return packages
+
     def configure(self, config, args, args_extra, parsers):
         if args.action == None:
             parsers.package.print_help()
@@ -38,7 +74,12 @@ class PackageCommand(Command):
         self.config = config
 
         # create our canvas service object
-        self.cs = Service(host=args.host, username=args.username)
+        self.cs = Service(
+            host=args.host,
+            username=args.username,
+            cache=self._template_cache(config),
+            delta_updates=self._delta_updates(config)
+        )
 
         # store args for additional processing
         self.args = args
@@ -61,7 +102,7 @@ class PackageCommand(Command):
               "\n"
               "Specific usage:\n"
               "{0} package add [user:]template[@version] [--nodeps] package1 packagelist1 package2 ... packageN\n"
-              "{0} package list [user:]template[@version] [--filter-name] [--filter-summary] [--filter-description] [--filter-arch] [--filter-repo] [--output=path]\n"
+              "{0} package list [user:]template[@version] [--filter-name=pattern] [--filter-arch=pattern] [--output=path]\n"
               "{0} package rm [user:]template[@version] [--nodeps] package1 package2 ... packageN\n"
               "{0} package update [user:]template[@version] [--nodeps] package1 packagelist1 package2 ... packageN\n"
               "\n".format(self.prog_name))
@@ -109,14 +150,17 @@ class PackageCommand(Command):
             print(e)
             return 1
 
-        for p in self.args.package:
-            try:
-                pkg = Package(p)
-            except TypeError as e:
-                print (e)
-                return 1
+        packages = self._parse_packages()
 
-            t.add_package(pkg)
+        if packages is None:
+            return 1
+
+        try:
+            t.add_packages(packages)
+
+        except TypeError as e:
+            print (e)
+            return 1
 
         packages = list(t.packages_delta)
         packages.sort(key=lambda x: x.name)
@@ -156,44 +200,32 @@ class PackageCommand(Command):
         t = Template(self.args.template, user=self.args.username)
 
         try:
-            t = self.cs.template_get(t)
+            t = self.cs.template_get(t, cached=True, fields=['packages'])
 
         except ServiceException as e:
             print(e)
             return 1
 
-        packages = list(t.packages_all)
-        packages.sort(key=lambda x: x.name)
+        packages = PackageTable.from_packages(t.packages_all)
+        packages = packages.filter(name=self.args.filter_name, arch=self.args.filter_arch).sort('name')
 
         if len(packages):
             l = TextTable(header=['PACKAGE', 'EPOCH', 'VERSION', 'RELEASE', 'ARCH', 'ACTION'])
 
-            for p in packages:
-                if p.epoch is None:
-                    p.epoch = '-'
-
-                if p.version is None:
-                    p.version = '-'
-
-                if p.release is None:
-                    p.release = '-'
+            for (name, epoch, version, release, arch, action, template) in packages:
+                if action & Package.ACTION_INCLUDE:
+                    action = '+'
 
-                if p.arch is None:
-                    p.arch = '-'
+                elif action & Package.ACTION_EXCLUDE:
+                    action = '-'
 
-                if p.included:
-                    p.action = '+'
-
-                elif p.excluded:
-                    p.action = '-'
-
-                elif p.ignored:
-                    p.action = '!'
+                elif action & Package.ACTION_IGNORE:
+                    action = '!'
 
                 else:
-                    p.action = '?'
+                    action = '?'
 
-                l.add_row([p.name, p.epoch, p.version, p.release, p.arch, p.action])
+                l.add_row([name] + ['-' if v is None else v for v in (epoch, version, release, arch)] + [action])
 
             print(l)
             print()
@@ -211,13 +243,7 @@ class PackageCommand(Command):
             print(e)
             return 1
 
-        packages = []
-
-        for p in self.args.package:
-            p = Package(p)
-            if t.remove_package(p):
-                packages.append(p)
-
+        packages = t.remove_packages(Package(p) for p in self.args.package)['removed']
         packages.sort(key=lambda x: x.name)
 
         # describe process for dry runs
@@ -264,11 +290,12 @@ class PackageCommand(Command):
         # track updates to determine server update
         updated = False
 
-        for p in self.args.package:
+        packages = self._parse_packages()
 
-            # parse new and find old
-            pn = Package(p)
+        if packages is None:
+            return 1
 
+        for pn in packages:
             print(pn)
 
             if pn not in t.packages:
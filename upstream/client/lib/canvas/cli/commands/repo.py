@@ -38,7 +38,12 @@ class RepoCommand(Command):
         self.config = config
 
         # create our canvas service object
-        self.cs = Service(host=args.host, username=args.username)
+        self.cs = Service(
+            host=args.host,
+            username=args.username,
+            cache=self._template_cache(config),
+            delta_updates=self._delta_updates(config)
+        )
 
         # eval enabled
         try:
@@ -215,7 +220,7 @@ class RepoCommand(Command):
         t = Template(self.args.template, user=self.args.username)
 
         try:
-            t = self.cs.template_get(t)
+            t = self.cs.template_get(t, cached=True, fields=['repos'])
 
         except ServiceException as e:
             print(e)
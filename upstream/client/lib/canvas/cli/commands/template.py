@@ -23,6 +23,7 @@ import logging
 import os
 import sys
 import random
+import shutil
 import string
 import subprocess
 import yaml
@@ -31,6 +32,7 @@ from functools import reduce
 
 from canvas.cli.commands import Command
 from canvas.package import Package
+from canvas.packagetable import PackageTable
 from canvas.repository import Repository
 from canvas.service import Service, ServiceException
 from canvas.template import Template
@@ -49,7 +51,14 @@ class TemplateCommand(Command):
         self.config = config
 
         # create our canvas service object
-        self.cs = Service(host=args.host, username=args.username)
+        self.cache = self._template_cache(config)
+
+        self.cs = Service(
+            host=args.host,
+            username=args.username,
+            cache=self.cache,
+            delta_updates=self._delta_updates(config)
+        )
 
         try:
             # expand includes
@@ -68,6 +77,19 @@ class TemplateCommand(Command):
         # store args for additional processing
         self.args = args
 
+    def _template_resolved(self, t):
+        # resolved templates are served compiled where possible, otherwise
+        # (eg. the cache is not writable) they are resolved directly and the
+        # caller writes the kickstart itself, signalled by a None path
+        try:
+            (t, manifest) = self.cs.template_get_compiled(t)
+            return (t, self.cache.compiled.kickstart(manifest['uuid']))
+
+        except ServiceException as e:
+            logging.debug('Unable to compile template {0}: {1}'.format(t.unv, e))
+
+        return (self.cs.template_get(t, cached=True), None)
+
     def run(self):
         command = None
 
@@ -111,6 +133,19 @@ class TemplateCommand(Command):
         logging.info('Template added.')
         return 0
 
+    def run_compile(self):
+        t = Template(self.args.template, user=self.args.username)
+
+        try:
+            (t, manifest) = self.cs.template_compile(t, force=self.args.force)
+
+        except ServiceException as e:
+            logging.exception(e)
+            return 1
+
+        logging.info('Template compiled: {0}'.format(self.cache.compiled.kickstart(manifest['uuid'])))
+        return 0
+
     def run_copy(self):
         t = Template(self.args.template_from, user=self.args.username)
 
@@ -139,7 +174,7 @@ class TemplateCommand(Command):
 
         # grab the template we're pushing to
         try:
-            t = self.cs.template_get(t)
+            t = self.cs.template_get(t, cached=True)
 
         except ServiceException as e:
             logging.exception(e)
@@ -150,7 +185,7 @@ class TemplateCommand(Command):
             ts = Template(self.args.template_to, user=self.args.username)
 
             try:
-                ts = self.cs.template_get(ts)
+                ts = self.cs.template_get(ts, cached=True)
 
             except ServiceException as e:
                 logging.exception(e)
@@ -160,36 +195,50 @@ class TemplateCommand(Command):
         else:
             ts = Template.from_system()
 
-        (l_r, r_l) = t.package_diff(ts.packages_all)
+        packages = PackageTable.from_packages(t.packages_all)
+        (l_r, r_l) = packages.diff(PackageTable.from_packages(ts.packages_all, strings=packages.strings))
 
         if len(l_r):
             print('In template and not marked for install in system:')
 
-            for p in l_r:
-                print(" * {0}".format(p.name))
+            for name in l_r.column('name'):
+                print(" * {0}".format(name))
 
             print()
 
         if len(r_l):
             print('Marked for install on system and not in template:')
 
-            for p in r_l:
-                print(" * {0}".format(p.name))
+            for name in r_l.column('name'):
+                print(" * {0}".format(name))
 
         print()
 
     def run_dump(self):
         t = Template(self.args.template, user=self.args.username)
 
+        ks_path = None
+
         try:
-            t = self.cs.template_get(t, resolve_includes=not self.args.no_resolve_includes)
+            if self.args.no_resolve_includes:
+                t = self.cs.template_get(t, resolve_includes=False, cached=True)
+
+            else:
+                (t, ks_path) = self._template_resolved(t)
 
         except ServiceException as e:
             logging.exception(e)
             return 1
 
         if self.args.kickstart:
-            print(t.to_kickstart(resolved=not self.args.no_resolve_includes))
+            if ks_path is not None:
+                with open(ks_path, 'r') as f:
+                    shutil.copyfileobj(f, sys.stdout)
+
+            else:
+                t.write_kickstart(sys.stdout, resolved=not self.args.no_resolve_includes)
+
+            print()
             return 0
 
         elif self.args.yaml:
@@ -297,7 +346,7 @@ class TemplateCommand(Command):
             return 1
 
         try:
-            t = self.cs.template_get(t)
+            (t, compiled_path) = self._template_resolved(t)
 
         except ServiceException as e:
             logging.exception(e)
@@ -368,8 +417,12 @@ class TemplateCommand(Command):
             if not os.path.exists(os.path.dirname(ks_path)):
                 os.makedirs(os.path.dirname(ks_path))
 
-            with open(ks_path, 'w') as f:
-                f.write(t.to_kickstart(resolved=True))
+            if compiled_path is not None:
+                shutil.copyfile(compiled_path, ks_path)
+
+            else:
+                with open(ks_path, 'w') as f:
+                    t.write_kickstart(f, resolved=True)
 
         except IOError as e:
             logging.error('You need root privileges to build iso at this location.')
@@ -570,14 +623,11 @@ class TemplateCommand(Command):
             if self.args.push_all:
                 db_list = db.sack.query().installed()
 
-            # add our user installed packages
-            for p in db_list:
-                # no need to store versions
-                t.add_package(Package(p, evr=False))
+            # add our user installed packages, no need to store versions
+            t.add_packages(Package(p, evr=False) for p in db_list)
 
             # add only enabled repos
-            for r in db.repos.enabled():
-                t.add_repo(Repository(r))
+            t.add_repos(Repository(r) for r in db.repos.enabled())
 
         objects = list(t.objects_delta)
         objects.sort(key=lambda x: x.name)
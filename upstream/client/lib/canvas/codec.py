@@ -0,0 +1,148 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compact JSON encoding and decoding for canvas objects.
+
+The standard library json module is always available. When the optional
+orjson package is installed it is used instead, unless disabled by setting
+the CANVAS_JSON_BACKEND environment variable to 'json'. Encoded output is
+the same for either backend, except that orjson writes exponent floats in
+their shortest form (eg. 1e20 rather than 1e+20) and NaN or infinite floats
+as null.
+"""
+
+import json
+import logging
+import os
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+BACKENDS = ('json', 'orjson')
+
+# name, dumps and loads of the backend in use, see set_backend
+_backend = None
+
+
+# json.dumps builds a new encoder per call when given any options, which
+# dominates the cost of encoding small objects
+_encoders = {
+    False: json.JSONEncoder(separators=(',', ':')),
+    True:  json.JSONEncoder(separators=(',', ':'), sort_keys=True)
+}
+
+
+def _json_dumps(obj, sort_keys=False):
+    return _encoders[sort_keys].encode(obj)
+
+
+def _orjson_dumps(obj, sort_keys=False):
+    try:
+        b = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    except TypeError:
+        # eg. integers beyond 64 bits or non string keys
+        return _json_dumps(obj, sort_keys=sort_keys)
+
+    # json escapes non-ASCII and DEL characters, orjson doesn't
+    if not b.isascii() or b'\x7f' in b:
+        return _json_dumps(obj, sort_keys=sort_keys)
+
+    return b.decode('ascii')
+
+
+def _json_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+
+    return json.loads(data)
+
+
+def _orjson_loads(data):
+    return orjson.loads(data)
+
+
+def backend():
+    """ Returns the name of the JSON backend in use. """
+    if _backend is None:
+        try:
+            set_backend(os.environ.get('CANVAS_JSON_BACKEND'))
+
+        except ValueError as e:
+            logging.warning('{0}, using the default'.format(e))
+            set_backend()
+
+    return _backend[0]
+
+
+def set_backend(name=None):
+    """
+    Selects the JSON backend, one of BACKENDS.
+
+    Args:
+      name: backend name, or None for the fastest available.
+
+    Raises:
+      ValueError: the backend is unknown or not installed.
+    """
+
+    global _backend
+
+    if name is None:
+        name = 'json' if orjson is None else 'orjson'
+
+    if name not in BACKENDS:
+        raise ValueError('unknown JSON backend: {0}'.format(name))
+
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON backend orjson is not installed')
+
+    logging.debug('Using JSON backend {0}'.format(name))
+
+    if name == 'orjson':
+        _backend = (name, _orjson_dumps, _orjson_loads)
+
+    else:
+        _backend = (name, _json_dumps, _json_loads)
+
+
+def dumps(obj, sort_keys=False):
+    """
+    Returns the compact JSON encoding of obj, as a str.
+
+    Args:
+      obj: object to encode.
+      sort_keys: sort the keys of all dicts.
+    """
+
+    if _backend is None:
+        backend()
+
+    return _backend[1](obj, sort_keys=sort_keys)
+
+
+def loads(data):
+    """ Returns the object decoded from the JSON str or bytes data. """
+    if _backend is None:
+        backend()
+
+    return _backend[2](data)
@@ -0,0 +1,313 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import http.client
+import io
+import logging
+import select
+import threading
+import time
+import urllib.error
+import urllib.request
+import urllib.response
+import zlib
+
+
+class ConnectionPool(object):
+    """ A thread safe pool of idle HTTP/1.1 connections keyed on scheme and host. """
+
+    def __init__(self, maxsize=4):
+        self._maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(c) for c in self._idle.values())
+
+    def close(self):
+        """ Close and forget all idle connections. """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+
+        for conns in idle.values():
+            for c in conns:
+                c.close()
+
+    @staticmethod
+    def _dropped(conn):
+        # an idle connection has nothing to read unless the server has
+        # closed it (or sent something unsolicited), either way it's unusable
+        if conn.sock is None:
+            return True
+
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+
+        except (OSError, ValueError):
+            return True
+
+    def get(self, key):
+        """ Return an idle connection for key, or None if none are available. """
+        while True:
+            with self._lock:
+                conns = self._idle.get(key, [])
+
+                if not len(conns):
+                    return None
+
+                conn = conns.pop()
+
+            if not self._dropped(conn):
+                return conn
+
+            logging.debug('Discarding pooled connection closed by the server')
+            conn.close()
+
+    def put(self, key, conn):
+        """ Return a connection to the pool, closing it if the pool is full. """
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+
+            if len(conns) < self._maxsize:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+
+class CompressionHandler(urllib.request.BaseHandler):
+    """
+    Negotiates gzip/deflate compressed responses and transparently decodes
+    them, so callers always read the identity encoded body.
+
+    Request bodies of at least compress_min bytes are gzip compressed when
+    compress_min is set, this requires the server to accept gzip encoded
+    request bodies.
+    """
+
+    # run before HTTPErrorProcessor so error bodies are decoded too
+    handler_order = 400
+
+    def __init__(self, compress_min=None):
+        self._compress_min = compress_min
+
+    def _decode(self, body, encoding):
+        if encoding == 'gzip':
+            return gzip.decompress(body)
+
+        if encoding == 'deflate':
+            # some servers send raw deflate streams without the zlib header
+            try:
+                return zlib.decompress(body)
+
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+
+        return body
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+
+        data = req.data
+
+        if (self._compress_min is not None and isinstance(data, bytes) and
+                len(data) >= self._compress_min and not req.has_header('Content-encoding')):
+            req.data = gzip.compress(data)
+            req.add_unredirected_header('Content-Encoding', 'gzip')
+
+        return req
+
+    def http_response(self, req, resp):
+        encoding = resp.headers.get('Content-Encoding', '').strip().lower()
+
+        if encoding not in ('gzip', 'deflate'):
+            return resp
+
+        try:
+            body = self._decode(resp.read(), encoding)
+
+        except (OSError, EOFError, zlib.error) as e:
+            raise urllib.error.URLError('unable to decode {0} response: {1}'.format(encoding, e))
+
+        headers = resp.headers
+        del headers['Content-Encoding']
+        del headers['Content-Length']
+        headers['Content-Length'] = str(len(body))
+
+        decoded = urllib.response.addinfourl(io.BytesIO(body), headers, resp.geturl(), resp.getcode())
+        decoded.msg = resp.msg
+
+        return decoded
+
+    https_request = http_request
+    https_response = http_response
+
+
+class KeepAliveHandlerMixin(object):
+    """
+    Replaces the one-shot connection logic of the urllib HTTP handlers with
+    persistent connections drawn from a ConnectionPool.
+
+    Response bodies are read in full before the connection is handed back to
+    the pool so that callers keep the usual file-like urllib response.
+
+    If timings (see canvas.timing.Timings) are provided each request is
+    recorded along with its connect, time to first byte and total times.
+    """
+
+    def __init__(self, pool=None, timings=None, **kwargs):
+        super().__init__(**kwargs)
+
+        if pool is None:
+            pool = ConnectionPool()
+
+        self._pool = pool
+        self._timings = timings
+
+    # methods that are safe to send again if the response was lost
+    IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS')
+
+    @classmethod
+    def _retryable(cls, method, sending, error):
+        """
+        Returns whether a request failing on a reused connection may be sent
+        again on a new one. The server may drop a pooled connection just as
+        it's reused, in which case sending fails with the connection closed,
+        or an idempotent request sees the connection closed without any
+        response. Anything else may have been processed by the server.
+        """
+
+        if sending:
+            return isinstance(error, (http.client.RemoteDisconnected, BrokenPipeError,
+                                      ConnectionResetError, ConnectionAbortedError))
+
+        return method in cls.IDEMPOTENT and isinstance(error, http.client.RemoteDisconnected)
+
+    def _keepalive_open(self, http_class, req, **http_conn_args):
+        # proxy tunnels hold per-request state, leave those to urllib
+        if getattr(req, '_tunnel_host', None):
+            return self.do_open(http_class, req, **http_conn_args)
+
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        key = (req.type, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers['Connection'] = 'keep-alive'
+        headers = {name.title(): val for name, val in headers.items()}
+
+        sent = len(req.data) if isinstance(req.data, bytes) else 0
+        method = req.get_method()
+
+        conn = self._pool.get(key)
+        reused = conn is not None
+
+        while True:
+            start = time.monotonic()
+            connect = 0
+            sending = True
+
+            try:
+                if conn is None:
+                    conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                    conn.connect()
+                    connect = time.monotonic() - start
+
+                conn.request(method, req.selector, req.data, headers)
+                sending = False
+
+                r = conn.getresponse()
+                ttfb = time.monotonic() - start
+                body = r.read()
+
+            except (http.client.HTTPException, OSError) as e:
+                if conn is not None:
+                    conn.close()
+
+                if reused and self._retryable(method, sending, e):
+                    logging.debug('Stale pooled connection to {0}, reconnecting'.format(host))
+                    conn = None
+                    reused = False
+                    continue
+
+                if self._timings is not None:
+                    elapsed = time.monotonic() - start
+                    self._timings.request(method, req.full_url, None,
+                        sent, 0, connect, elapsed, elapsed)
+
+                raise urllib.error.URLError(e)
+
+            break
+
+        if self._timings is not None:
+            self._timings.request(method, req.full_url, r.status,
+                sent, len(body), connect, ttfb, time.monotonic() - start)
+
+        if r.will_close:
+            conn.close()
+
+        else:
+            self._pool.put(key, conn)
+
+        resp = urllib.response.addinfourl(io.BytesIO(body), r.msg, req.get_full_url(), r.status)
+        resp.msg = r.reason
+
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self._keepalive_open(http.client.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self._keepalive_open(http.client.HTTPSConnection, req, context=self._context)
+
+
+def build_opener(*handlers, pool=None, compress_min=None, timings=None):
+    """
+    Build a urllib opener whose HTTP and HTTPS handlers share a single pool of
+    keep-alive connections and negotiate compressed responses.
+
+    Args:
+      handlers: additional urllib handlers (eg. cookie processors).
+      pool: ConnectionPool to share, a new one is created if omitted.
+      compress_min: gzip request bodies of at least this many bytes.
+      timings: canvas.timing.Timings to record requests in, if any.
+
+    Returns:
+      urllib.request.OpenerDirector
+    """
+
+    if pool is None:
+        pool = ConnectionPool()
+
+    return urllib.request.build_opener(
+        KeepAliveHTTPHandler(pool=pool, timings=timings),
+        KeepAliveHTTPSHandler(pool=pool, timings=timings),
+        CompressionHandler(compress_min=compress_min),
+        *handlers
+    )
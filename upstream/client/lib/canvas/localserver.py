@@ -0,0 +1,698 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A local, in-process stand-in for the canvas server REST API.
+
+It implements the API routes of the Mojolicious server (see
+server/lib/Canvas.pm) closely enough to exercise Service and canvasd end to
+end without network access, with optional injected latency and bandwidth
+limits for benchmarking. It is not intended to be exposed to other hosts.
+
+Run standalone with:
+  python3 -m canvas.localserver --port 3000 --fixtures 10 --packages 5000
+"""
+
+import argparse
+import codecs
+import collections
+import gzip
+import hashlib
+import hmac
+import http.cookies
+import http.server
+import json
+import os
+import re
+import socketserver
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+RE_ROUTE = re.compile(r'^/(?P<api>api/)?(?P<route>[a-z]+)(?:/(?P<uuid>[^/.]+)(?P<sync>/sync)?)?(?:\.json)?$')
+
+# fields always returned by a projection, see Api.pm _fields_project
+FIELDS_IDENTIFYING = ('uuid', 'name', 'stub', 'username', 'version', 'includes', 'updated')
+
+SESSION_COOKIE = 'canvas'
+
+
+class LocalServerException(Exception):
+    def __init__(self, reason, code=500):
+        self.code = code
+        self.reason = reason
+
+    def __str__(self):
+        return self.reason
+
+
+class MemoryStore(object):
+    """
+    Stores templates and machines as server side rows (ie. as returned by
+    the API) keyed on uuid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {'template': collections.OrderedDict(), 'machine': collections.OrderedDict()}
+
+    #
+    # PUBLIC METHODS
+    def delete(self, kind, uuid):
+        with self._lock:
+            return self._rows[kind].pop(uuid, None) is not None
+
+    def find(self, kind, **filters):
+        """ Returns all rows of kind matching each non None filter. """
+        filters = {k: v for k, v in filters.items() if v is not None}
+
+        with self._lock:
+            return [r for r in self._rows[kind].values() if all(r.get(k) == v for k, v in filters.items())]
+
+    def get(self, kind, uuid):
+        with self._lock:
+            return self._rows[kind].get(uuid)
+
+    def put(self, kind, row):
+        with self._lock:
+            self._rows[kind][row['uuid']] = row
+
+
+class SQLiteStore(object):
+    """ As MemoryStore, but persisted to an SQLite database at path. """
+
+    def __init__(self, path=':memory:'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        with self._db:
+            for kind in ('template', 'machine'):
+                self._db.execute('CREATE TABLE IF NOT EXISTS {0}s (uuid TEXT PRIMARY KEY, row TEXT)'.format(kind))
+
+    #
+    # PUBLIC METHODS
+    def close(self):
+        self._db.close()
+
+    def delete(self, kind, uuid):
+        with self._lock, self._db:
+            return self._db.execute('DELETE FROM {0}s WHERE uuid=?'.format(kind), (uuid,)).rowcount > 0
+
+    def find(self, kind, **filters):
+        filters = {k: v for k, v in filters.items() if v is not None}
+
+        with self._lock:
+            rows = [json.loads(r) for (r,) in self._db.execute('SELECT row FROM {0}s ORDER BY rowid'.format(kind))]
+
+        return [r for r in rows if all(r.get(k) == v for k, v in filters.items())]
+
+    def get(self, kind, uuid):
+        with self._lock:
+            r = self._db.execute('SELECT row FROM {0}s WHERE uuid=?'.format(kind), (uuid,)).fetchone()
+
+        return json.loads(r[0]) if r is not None else None
+
+    def put(self, kind, row):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO {0}s (uuid, row) VALUES (?, ?)'.format(kind),
+                (row['uuid'], json.dumps(row, separators=(',', ':'))))
+
+
+class LocalRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body are written separately, avoid delayed ack stalls
+    disable_nagle_algorithm = True
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+
+        if not length:
+            return b''
+
+        body = self.rfile.read(length)
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        return body
+
+    def _dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+
+        time.sleep(self.server.latency)
+
+        m = RE_ROUTE.match(url.path)
+        api = m is not None and m.group('api') is not None
+        route = m.group('route') if m else None
+        uuid = m.group('uuid') if m else None
+
+        handler = None
+
+        if not api and route in ('authenticate', 'deauthenticate', 'authorised') and uuid is None:
+            handler = getattr(self, '_{0}'.format(route))
+
+        elif api and route in ('templates', 'machines') and uuid is None and method in ('GET', 'POST'):
+            handler = getattr(self, '_{0}_{1}'.format(route, method.lower()))
+
+        elif api and route in ('template', 'machine') and uuid is not None:
+            if m.group('sync'):
+                if route == 'machine' and method == 'GET':
+                    handler = self._machine_sync
+
+            elif method in ('GET', 'PUT', 'DELETE'):
+                handler = getattr(self, '_{0}_{1}'.format(route, method.lower()))
+
+        # unknown routes are redirected to the index, as the real server does
+        if handler is None:
+            self._body()
+            return self._send(302, b'', headers={'Location': '/'})
+
+        try:
+            status, res = handler(uuid) if uuid is not None else handler()
+
+        except LocalServerException as e:
+            status, res = e.code, {'error': e.reason}
+
+        except ValueError:
+            status, res = 500, {'error': 'invalid json.'}
+
+        self._send(status, json.dumps(res, separators=(',', ':')).encode('utf-8'))
+
+    def _project(self, data):
+        fields = self.query.get('fields')
+
+        if fields is None:
+            return data
+
+        keep = set(FIELDS_IDENTIFYING).union(fields.split(','))
+
+        def _project(row):
+            return {k: v for k, v in row.items() if k in keep}
+
+        return [_project(r) for r in data] if isinstance(data, list) else _project(data)
+
+    def _send(self, status, body, headers=None):
+        headers = dict(headers or {})
+
+        if (self.server.compress and len(body) and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+
+        for k, v in headers.items():
+            self.send_header(k, v)
+
+        self.end_headers()
+
+        # throttle the body to the configured bandwidth (bytes per second)
+        bandwidth = self.server.bandwidth
+
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+
+        chunk = max(1, int(bandwidth / 100))
+
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            self.wfile.flush()
+            time.sleep(len(body[i:i + chunk]) / bandwidth)
+
+    def _session_user(self):
+        cookie = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+
+        if SESSION_COOKIE not in cookie:
+            return None
+
+        return self.server.sessions.get(cookie[SESSION_COOKIE].value)
+
+    def _user_required(self):
+        user = self._session_user()
+
+        if user is None:
+            raise LocalServerException('not authenticated.', 403)
+
+        return user
+
+    def _visible(self, row, user):
+        return row.get('username') == user or row.get('meta', {}).get('public', False)
+
+    #
+    # AUTHENTICATION
+    def _authenticate(self):
+        body = self._body()
+        data = json.loads(body.decode('utf-8')) if body else {}
+
+        username = self.query.get('u', data.get('u', ''))
+        password = self.query.get('p', data.get('p', ''))
+
+        if not username or self.server.users.get(username) != password:
+            return 403, ''
+
+        token = hashlib.sha256(os.urandom(32)).hexdigest()
+        self.server.sessions[token] = username
+
+        cookie = http.cookies.SimpleCookie()
+        cookie[SESSION_COOKIE] = token
+        cookie[SESSION_COOKIE]['path'] = '/'
+        self._cookie = cookie[SESSION_COOKIE].OutputString()
+
+        return 200, ''
+
+    def _authorised(self):
+        self._body()
+        return (200 if self._session_user() is not None else 403), {}
+
+    def _deauthenticate(self):
+        self._body()
+        cookie = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+
+        if SESSION_COOKIE in cookie:
+            self.server.sessions.pop(cookie[SESSION_COOKIE].value, None)
+
+        return 200, 'Done!'
+
+    #
+    # TEMPLATES
+    def _templates_get(self):
+        user = self._session_user()
+
+        rows = self.server.store.find('template',
+            uuid=self.query.get('uuid'),
+            stub=self.query.get('name'),
+            version=self.query.get('version'),
+            username=self.query.get('user'))
+
+        rows = [r for r in rows if self._visible(r, user)]
+        rows.sort(key=lambda r: (r['username'], r['stub']))
+
+        return 200, self._project(rows)
+
+    def _templates_post(self):
+        user = self._user_required()
+        template = json.loads(self._body().decode('utf-8'))
+
+        template['stub'] = re.sub(r'[^\w-]+', '', template.get('stub') or template.get('name') or '')
+
+        if not template['stub']:
+            raise LocalServerException('invalid name defined.')
+
+        owner = template.get('user') or user
+
+        if owner != user:
+            raise LocalServerException('not authorised to add')
+
+        if self.server.store.find('template', stub=template['stub'], username=owner,
+                version=template.get('version') or ''):
+            raise LocalServerException('template already exists')
+
+        row = template_row(template, owner)
+        self.server.store.put('template', row)
+
+        return 200, {'uuid': row['uuid']}
+
+    def _template_get(self, uuid):
+        self._body()
+        row = self.server.store.get('template', uuid)
+
+        # the real server reports a missing template as an error
+        if row is None or not self._visible(row, self._session_user()):
+            raise LocalServerException('too many template found.')
+
+        return 200, self._project(row)
+
+    def _template_put(self, uuid):
+        user = self._user_required()
+        template = json.loads(self._body().decode('utf-8'))
+        current = self.server.store.get('template', uuid)
+
+        if current is None or current['username'] != user:
+            raise LocalServerException('template doesn\'t exist')
+
+        template['stub'] = template.get('stub') or template.get('name')
+        row = template_row(template, user, uuid=uuid, created=current.get('created'))
+        self.server.store.put('template', row)
+
+        return 200, {'uuid': uuid}
+
+    def _template_delete(self, uuid):
+        user = self._user_required()
+        self._body()
+        current = self.server.store.get('template', uuid)
+
+        if current is None or current['username'] != user:
+            raise LocalServerException('template doesn\'t exist')
+
+        self.server.store.delete('template', uuid)
+
+        return 200, {'uuid': uuid}
+
+    #
+    # MACHINES
+    def _machines_get(self):
+        user = self._session_user()
+
+        rows = self.server.store.find('machine',
+            uuid=self.query.get('uuid'),
+            stub=self.query.get('name'),
+            username=self.query.get('user'))
+
+        return 200, [machine_public(r) for r in rows if r.get('username') == user]
+
+    def _machines_post(self):
+        user = self._user_required()
+        machine = json.loads(self._body().decode('utf-8'))
+
+        machine['stub'] = re.sub(r'[^\w-]+', '', machine.get('stub') or machine.get('name') or '')
+
+        if not machine['stub']:
+            raise LocalServerException('invalid name defined.')
+
+        if self.server.store.get('template', machine.get('template')) is None:
+            raise LocalServerException('template doesn\'t exist')
+
+        if self.server.store.find('machine', stub=machine['stub'], username=user):
+            raise LocalServerException('machine already exists')
+
+        row = machine_row(machine, user)
+        self.server.store.put('machine', row)
+
+        return 200, {'uuid': row['uuid'], 'key': row['key']}
+
+    def _machine_get(self, uuid):
+        self._body()
+        row = self.server.store.get('machine', uuid)
+
+        if row is None or row.get('username') != self._session_user():
+            raise LocalServerException('too many machine found.')
+
+        return 200, machine_public(row)
+
+    def _machine_put(self, uuid):
+        user = self._user_required()
+        machine = json.loads(self._body().decode('utf-8'))
+        current = self.server.store.get('machine', uuid)
+
+        if current is None or current['username'] != user:
+            raise LocalServerException('machine doesn\'t exist')
+
+        machine['stub'] = machine.get('stub') or machine.get('name')
+        row = machine_row(machine, user, uuid=uuid, key=current['key'], created=current.get('created'))
+        self.server.store.put('machine', row)
+
+        return 200, {'uuid': uuid}
+
+    def _machine_delete(self, uuid):
+        user = self._user_required()
+        self._body()
+        current = self.server.store.get('machine', uuid)
+
+        if current is None or current['username'] != user:
+            raise LocalServerException('machine doesn\'t exist')
+
+        self.server.store.delete('machine', uuid)
+
+        return 200, {'uuid': uuid}
+
+    def _machine_sync(self, uuid):
+        self._body()
+
+        if self.headers.get('x-canvas-uuid') != uuid:
+            raise LocalServerException('internal server error.')
+
+        row = self.server.store.get('machine', uuid)
+
+        if row is None:
+            raise LocalServerException('machine doesn\'t exist')
+
+        # unauthenticated machines prove themselves with an hmac of the nonce
+        if self._session_user() is None:
+            nonce = self.headers.get('x-canvas-nonce', '')
+            expected = hmac.new(codecs.decode(row['key'], 'hex'), msg=(nonce + uuid).encode('utf-8'),
+                digestmod='sha512').hexdigest()
+
+            if not hmac.compare_digest(expected, self.headers.get('x-canvas-hash', '')):
+                raise LocalServerException('access denied')
+
+        template = None
+
+        if self.headers.get('x-canvas-template', '0') == '1':
+            template = self.server.store.get('template', row['template'])
+
+        return 200, {'machine': machine_public(row), 'template': template}
+
+    #
+    # HTTP METHODS
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def end_headers(self):
+        cookie = getattr(self, '_cookie', None)
+
+        if cookie is not None:
+            self.send_header('Set-Cookie', cookie)
+            self._cookie = None
+
+        super().end_headers()
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            super().log_message(*args)
+
+
+class LocalHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """
+    Runs the canvas API stand-in on a background thread.
+
+    Args:
+      host: address to listen on.
+      port: port to listen on, 0 picks a free port.
+      store: MemoryStore or SQLiteStore, defaults to an empty MemoryStore.
+      users: dict of username to password accepted by /authenticate.
+      latency: seconds added to every response.
+      bandwidth: response bytes per second, unlimited if None.
+      compress: gzip responses when the client accepts it.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, store=None, users=None, latency=0, bandwidth=None,
+            compress=False, verbose=False):
+        if store is None:
+            store = MemoryStore()
+
+        self._server = LocalHTTPServer((host, port), LocalRequestHandler)
+        self._server.store = store
+        self._server.users = dict(users or {})
+        self._server.sessions = {}
+        self._server.latency = latency
+        self._server.bandwidth = bandwidth
+        self._server.compress = compress
+        self._server.verbose = verbose
+
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    #
+    # PROPERTIES
+    @property
+    def store(self):
+        return self._server.store
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self._server.server_address[:2])
+
+    #
+    # PUBLIC METHODS
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+
+        return self.url
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+
+        self._server.server_close()
+
+
+def machine_public(row):
+    """ Returns a machine row without its secret key. """
+    return {k: v for k, v in row.items() if k != 'key'}
+
+
+def machine_row(machine, username, uuid=None, key=None, created=None):
+    now = time.time()
+
+    if uuid is None:
+        uuid = hashlib.sha256('{0}{1}{2}'.format(username, machine['stub'], now).encode('utf-8')).hexdigest()
+
+    if key is None:
+        key = hashlib.sha512(os.urandom(64)).hexdigest()
+
+    return {
+        'uuid':        uuid,
+        'key':         key,
+        'name':        machine.get('title') or '',
+        'stub':        machine['stub'],
+        'version':     machine.get('version') or '',
+        'description': machine.get('description') or '',
+        'template':    machine.get('template'),
+        'meta':        machine.get('meta') or {},
+        'username':    username,
+        'stores':      machine.get('stores') or [],
+        'objects':     machine.get('objects') or [],
+        'history':     machine.get('history') or [],
+        'created':     created or now,
+        'updated':     now
+    }
+
+
+def template_row(template, username, uuid=None, created=None):
+    """ Converts a client template object to the row returned by the server. """
+    now = time.time()
+
+    if uuid is None:
+        uuid = hashlib.sha256('{0}{1}{2}'.format(username, template['stub'], now).encode('utf-8')).hexdigest()
+
+    return {
+        'uuid':        uuid,
+        'name':        template.get('title') or '',
+        'stub':        template['stub'],
+        'version':     template.get('version') or '',
+        'description': template.get('description') or '',
+        'includes':    template.get('includes') or [],
+        'repos':       template.get('repos') or [],
+        'packages':    template.get('packages') or [],
+        'meta':        template.get('meta') or {},
+        'username':    username,
+        'stores':      template.get('stores') or [],
+        'objects':     template.get('objects') or [],
+        'created':     created or now,
+        'updated':     now
+    }
+
+
+def fixtures(store, username='canvas', templates=10, packages=1000, repos=10, objects=10, public=True):
+    """
+    Populates store with synthetic templates for benchmarking.
+
+    Templates are named t0..tN, each including the two templates following it
+    (forming a diamond shaped include graph) and carrying its own share of
+    packages, repos and kickstart style objects.
+
+    Returns:
+      List of the unv of each template created, the root template first.
+    """
+
+    unvs = []
+
+    for i in range(templates):
+        includes = ['{0}:t{1}'.format(username, j) for j in (i + 1, i + 2) if j < templates]
+
+        template = {
+            'stub':        't{0}'.format(i),
+            'title':       'Synthetic template {0}'.format(i),
+            'description': 'Generated by canvas.localserver.fixtures',
+            'includes':    includes,
+            'packages':    [{'n': 'package-{0}-{1}'.format(i, p), 'v': '1.{0}'.format(p % 10),
+                             'r': '1.fc25', 'a': 'x86_64', 'z': 1} for p in range(packages)],
+            'repos':       [{'s': 'repo-{0}-{1}'.format(i, r), 'n': 'Repo {0}'.format(r),
+                             'bu': ['http://example.com/{0}/{1}/$basearch'.format(i, r)], 'e': True, 'z': 1}
+                            for r in range(repos)],
+            'objects':     [{'name': 'script-{0}-{1}'.format(i, o), 'source': 'raw',
+                             'data': 'echo {0}-{1} {2}\n'.format(i, o, 'x' * 1024),
+                             'actions': [{'type': 'ks-post'}]} for o in range(objects)],
+            'meta':        {'public': public}
+        }
+
+        store.put('template', template_row(template, username))
+        unvs.append('{0}:t{1}'.format(username, i))
+
+    return unvs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the canvas server API')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=3000, help='port to listen on')
+    parser.add_argument('--db', help='SQLite database path, in memory if omitted')
+    parser.add_argument('--user', action='append', default=[], metavar='USER:PASS', help='add a user')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, help='response bytes per second')
+    parser.add_argument('--compress', action='store_true', help='gzip responses')
+    parser.add_argument('--fixtures', type=int, default=0, metavar='N', help='generate N synthetic templates')
+    parser.add_argument('--packages', type=int, default=1000, help='packages per synthetic template')
+    parser.add_argument('--verbose', action='store_true', help='log requests')
+    args = parser.parse_args()
+
+    store = SQLiteStore(args.db) if args.db else MemoryStore()
+    users = dict(u.split(':', 1) for u in args.user)
+
+    if args.fixtures:
+        fixtures(store, username=next(iter(users), 'canvas'), templates=args.fixtures, packages=args.packages)
+
+    server = LocalServer(host=args.host, port=args.port, store=store, users=users, latency=args.latency,
+        bandwidth=args.bandwidth, compress=args.compress, verbose=args.verbose)
+
+    print('Serving canvas API on {0}'.format(server.url))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -27,7 +27,9 @@ import pykickstart.constants
 
 import canvas.utilities
 
+from canvas import codec
 from canvas.set import CanvasSet
+from canvas.utilities import intern_str
 
 class ErrorInvalidObject(Exception):
     def __init__(self, reason, code=0):
@@ -43,6 +45,8 @@ class ErrorInvalidObject(Exception):
 class Object(object):
     """ A Canvas object that represents a template Object. """
 
+    __slots__ = ('_name', '_xsum', '_source', '_data', '_actions', '_cache_dir', '_template')
+
     # CONSTANTS
     ACTIONS_ALL = ['copy', 'extract',
                    'execute', 'execute-command', 'ks-command',
@@ -70,8 +74,9 @@ class Object(object):
         self._source = None
         self._data = None
         self._actions = []
+        self._template = None
 
-        self._cache_dir = os.getenv('CANVAS_CACHE_DIR', '/var/cache/canvas')
+        self._cache_dir = intern_str(os.getenv('CANVAS_CACHE_DIR', '/var/cache/canvas'))
 
         if kwargs:
             self._name     = kwargs.get('name', self._name)
@@ -79,7 +84,7 @@ class Object(object):
             self._source   = kwargs.get('source', self._source)
             self._data     = kwargs.get('data', self._data)
             self._actions  = kwargs.get('actions', self._actions)
-            self._template = kwargs.get('template', None)
+            self._template = intern_str(kwargs.get('template', None))
 
             # check if we've got a data_file to read data from
             if kwargs.get('data_file', None) is not None:
@@ -113,7 +118,7 @@ class Object(object):
                 self._actions  = args[0].get('actions', self._actions)
                 self._source   = args[0].get('source', self._source)
                 self._data     = args[0].get('data', self._data)
-                self._template = args[0].get('template', None)
+                self._template = intern_str(args[0].get('template', None))
 
         # calculate checksum if not defined
         if self._xsum is None:
@@ -163,7 +168,9 @@ class Object(object):
             return False
 
     def __hash__(self):
-        return self._name + self._xsum
+        # consistent with equality, except between an object without a
+        # checksum and one with, which share a name rather than a hash
+        return hash(self._xsum or self._name)
 
     def __ne__(self, other):
         return (not self.__eq__(other))
@@ -337,15 +344,16 @@ class Object(object):
         # check we we're a ks-script
         return type in self.MAP_OBJ_STRING_TO_SCRIPT_TYPE.keys()
 
-    def to_kickstart(self):
+    def iter_kickstart(self):
+        """ Yields the kickstart representation in chunks, see to_kickstart. """
         if len(self._actions) != 1:
-            return ''
+            return
 
         action = self._actions[0]
         type = action.get('type', '')
 
         if type == 'ks-command':
-            return self.data
+            yield self.data
 
         elif type in self.MAP_OBJ_STRING_TO_SCRIPT_TYPE.keys():
             header = ''
@@ -378,9 +386,13 @@ class Object(object):
                 if action.get('interp', '/bin/sh') != '/bin/sh':
                     header += ' --interpreter={0}'.format(action.get('interp'))
 
-            return header + "\n" + self.data + footer
+            # yield script data as is, rather than copying large payloads
+            yield header + "\n"
+            yield self.data
+            yield footer
 
-        return ''
+    def to_kickstart(self):
+        return ''.join(self.iter_kickstart())
 
     def to_ks_script(self):
         # kickstart scripts only have a single action
@@ -414,8 +426,35 @@ class Object(object):
         }
 
     def to_json(self):
-        return json.dumps(self.to_object(), separators=(',', ':'), sort_keys=True)
+        return codec.dumps(self.to_object(), sort_keys=True)
 
 class ObjectSet(CanvasSet):
     def __init__(self, initvalue=()):
         CanvasSet.__init__(self, initvalue)
+
+    def _bucket(self, item):
+        # objects with a checksum are equal by checksum alone, those without
+        # one are equal to any object of the same name and share a bucket
+        return getattr(item, 'xsum', None)
+
+    def _find(self, item):
+        if self._bucket(item) is None:
+            buckets = self._buckets.keys()
+
+        else:
+            buckets = (self._bucket(item), None)
+
+        # the first equal object in insertion order, tokens are increasing
+        tokens = [t for b in buckets for t in self._buckets.get(b, ()) if self._items[t] == item]
+
+        return min(tokens) if tokens else None
+
+    def _leaf(self, item):
+        # the checksum already covers the data, so avoid rehashing large
+        # payloads
+        o = item.to_object()
+
+        if o['checksum']['sha256'] is not None:
+            del o['data']
+
+        return hashlib.sha256(json.dumps(o, separators=(',', ':'), sort_keys=True).encode('utf-8')).digest()
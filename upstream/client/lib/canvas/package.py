@@ -16,12 +16,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import fnmatch
 import hawkey
-import json
 import re
+import weakref
 import dnf
 
+from canvas import codec
 from canvas.set import CanvasSet
+from canvas.utilities import intern_str
+
+_substitutions = None
 
 #
 # CLASS DEFINITIONS / IMPLEMENTATIONS
@@ -29,10 +34,15 @@ from canvas.set import CanvasSet
 class Package(object):
     """ A Canvas object that represents an installable Package. """
 
+    __slots__ = ('name', 'epoch', 'version', 'release', 'arch', 'action', 'template')
+
     # name[[#epoch]@version-release][:arch]
     RE_PACKAGE = re.compile(r"^([+~!])?([^#@:\s]+)(?:(?:#(\d+))?@([^\s-]+)-([^:\s-]+))?(?::(\w+))?$")
     RE_GROUP = re.compile(r"^([+~!])?(@[\w ]+)$")
 
+    # either of the above, matched in a single pass
+    RE_SPEC = re.compile(r"^([+~!])?(?:(@[\w ]+)|([^#@:\s]+)(?:(?:#(\d+))?@([^\s-]+)-([^:\s-]+))?(?::(\w+))?)$")
+
     # CONSTANTS
     ACTION_PIN              = 0x80
     ACTION_GROUP_OPTIONAL   = 0x40
@@ -47,6 +57,9 @@ class Package(object):
     #    F    |    T
     #    F    |    F
 
+    # action of each string prefix
+    ACTION_PREFIX = {None: ACTION_INCLUDE, '+': ACTION_INCLUDE, '~': ACTION_EXCLUDE, '!': ACTION_IGNORE}
+
 
     def __init__(self, package, evr=True, template=None):
         if isinstance(package, dnf.package.Package) or \
@@ -58,13 +71,14 @@ class Package(object):
         if not isinstance(package, dict):
             raise TypeError("Package must be a dict")
 
-        self.name     = package.get('n', None)
+        # names, archs and templates repeat across many packages
+        self.name     = intern_str(package.get('n', None))
         self.epoch    = package.get('e', None)
         self.version  = package.get('v', None)
         self.release  = package.get('r', None)
-        self.arch     = package.get('a', None)
+        self.arch     = intern_str(package.get('a', None))
         self.action   = package.get('z', self.ACTION_INCLUDE)
-        self.template = package.get('t', template)
+        self.template = intern_str(package.get('t', template))
 
         if not self.name:
             raise ValueError("Name cannot be None")
@@ -88,6 +102,22 @@ class Package(object):
             self.version = None
             self.release = None
 
+    @classmethod
+    def _from_fields(cls, name, epoch, version, release, arch, action, template):
+        # build from already validated fields, skipping the parsing and
+        # checks of __init__
+        p = cls.__new__(cls)
+
+        p.name     = intern_str(name)
+        p.epoch    = epoch
+        p.version  = version
+        p.release  = release
+        p.arch     = intern_str(arch)
+        p.action   = action | cls.ACTION_GROUP if name.startswith('@') else action
+        p.template = intern_str(template)
+
+        return p
+
     def __eq__(self, other):
         if isinstance(other, Package):
             if (self.arch is None) or (other.arch is None):
@@ -185,42 +215,26 @@ class Package(object):
         if not isinstance(package, str):
             raise TypeError("Package needs to be a string")
 
-        pkg_match = cls.RE_PACKAGE.match(package)
-        grp_match = cls.RE_GROUP.match(package)
-        action = cls.ACTION_INCLUDE
+        m = cls.RE_SPEC.match(package)
 
-        if pkg_match is not None:
-            regex = pkg_match
-        elif grp_match is not None:
-            regex = grp_match
-        else:
+        if m is None:
             raise ValueError
 
-        if regex.group(1) == '~':
-            action = cls.ACTION_EXCLUDE
-
-        elif regex.group(1) == '!':
-            action = cls.ACTION_IGNORE
+        (prefix, group, name, epoch, version, release, arch) = m.groups()
+        action = cls.ACTION_PREFIX[prefix]
 
-        name = regex.group(2)
+        if group is not None:
+            return {'n': group, 'z': action, 't': template}
 
-        if regex is pkg_match:
-            epoch   = regex.group(3)
-            version = regex.group(4)
-            release = regex.group(5)
-            arch    = regex.group(6)
-
-            return {
-                'n': name,
-                'e': epoch,
-                'v': version,
-                'r': release,
-                'a': arch,
-                'z': action,
-                't': template
-            }
-
-        return {'n': name, 'z': action, 't': template}
+        return {
+            'n': name,
+            'e': epoch,
+            'v': version,
+            'r': release,
+            'a': arch,
+            'z': action,
+            't': template
+        }
 
     @property
     def pinned(self):
@@ -239,7 +253,7 @@ class Package(object):
 
     def to_json(self):
         """ Return a json representation of the package object """
-        return json.dumps(self.to_object(), separators=(',', ':'), sort_keys=True)
+        return codec.dumps(self.to_object(), sort_keys=True)
 
     def to_object(self):
         """ Return a dictionary representation of the package object """
@@ -255,8 +269,11 @@ class Package(object):
         # only build with non-None values
         return {k: v for k, v in obj.items() if v != None}
 
-    def to_pkg_spec(self):
-        """ Return a dictionary representation of the package object """
+    def to_pkg_spec(self, subs=None):
+        """ Return the DNF package spec of the package object
+        Args:
+            subs: DNF substitutions (eg. releasever), defaults to substitutions()
+        """
         pkg = self.name
 
         # calculate evr
@@ -269,9 +286,10 @@ class Package(object):
             evr = self.epoch + ':'
 
         if self.version is not None and self.release is not None:
-            db = dnf.Base()
-            conf = db.conf.substitutions
-            evr += '{0}-{1}.fc{2}'.format(self.version, self.release, conf['releasever'])
+            if subs is None:
+                subs = substitutions()
+
+            evr += '{0}-{1}.fc{2}'.format(self.version, self.release, subs['releasever'])
         # NOTE: This is valid according to DNF docs,
         # however current str form makes this impossible
         #elif self.version is not None:
@@ -287,10 +305,11 @@ class Package(object):
 
         return pkg
 
-    def to_pkg(self, db=None):
+    def to_pkg(self, db=None, index=None):
         """ Convert this package into a DNF Package object.
         Args:
             db: A DNF Base object
+            index: An InstalledIndex to look up, in preference to db
         Returns:
             The DNF package object
         Raises:
@@ -298,33 +317,257 @@ class Package(object):
 
         """
 
-        if not isinstance(db, dnf.Base):
-            db = dnf.Base()
-            try:
-                db.fill_sack()
+        if index is None:
+            index = InstalledIndex.from_db(db)
 
-            except OSError as e:
-                pass
-
-        p_list = db.sack.query().installed().filter(name=self.name)
-
-        if not p_list:
-            return None
-
-        return list(p_list)[0]
+        return index.get(self.name, self.arch)
 
 
 class PackageSet(CanvasSet):
     def __init__(self, initvalue=()):
         CanvasSet.__init__(self, initvalue)
 
+    @classmethod
+    def parse(cls, specs, template=None):
+        """ Build a PackageSet from many Package strings in a single pass.
+
+        Blank lines and lines starting with # are skipped. Invalid lines are
+        reported rather than aborting the parse.
+
+        Args:
+            specs: A path to a package list file, or an iterable of Package
+                   strings (eg. a list, or an open file or stream)
+            template: The template unv to assign to each package
+        Returns:
+            A tuple of the PackageSet and a list of (line number, line, reason)
+            for each line that could not be parsed
+        """
+
+        if isinstance(specs, str):
+            with open(specs, 'r') as f:
+                return cls.parse(f, template=template)
+
+        match = Package.RE_SPEC.match
+        prefixes = Package.ACTION_PREFIX
+        packages = []
+        errors = []
+
+        for lineno, line in enumerate(specs, 1):
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            m = match(line)
+
+            if m is None:
+                errors.append((lineno, line, 'invalid package format'))
+                continue
+
+            (prefix, group, name, epoch, version, release, arch) = m.groups()
+
+            if group is not None:
+                packages.append(Package._from_fields(group, None, None, None, None, prefixes[prefix], template))
+
+            else:
+                packages.append(Package._from_fields(name, epoch, version, release, arch, prefixes[prefix], template))
+
+        return (cls(packages), errors)
+
+    def to_pkg_specs(self, subs=None):
+        """ Return the DNF package specs of all packages, in order
+        Args:
+            subs: DNF substitutions (eg. releasever), defaults to substitutions()
+        """
+
+        if subs is None:
+            subs = substitutions()
+
+        return [p.to_pkg_spec(subs) for p in self]
+
+    def _bucket(self, item):
+        # an arch-less package equals the same package of any arch, so
+        # packages can only be bucketed by name
+        return getattr(item, 'name', None)
+
+    def _merge(self, item):
+        # replace the package of the same arch, otherwise a more explicit
+        # arch still takes precedence over an arch-less package
+        for token in self._buckets.get(self._bucket(item), ()):
+            if self._items[token].arch == item.arch:
+                if self._items[token] is not item:
+                    self._items[token] = item
+                    self._version += 1
+
+                return
+
+        self.add(item)
+
     def add(self, item):
-        if item not in self._set:
-            self._set.append(item)
+        if self._find(item) is None:
+            self._append(item)
 
         # add if new package has more explicit arch definition than existing
         elif item.arch is not None:
-            for i, x in enumerate(self._set):
-                if x.name == item.name and x.arch is None:
-                    self._set[i] = item
+            for token in self._buckets[self._bucket(item)]:
+                if self._items[token].arch is None:
+                    self._items[token] = item
+                    self._version += 1
+
+
+
+class InstalledIndex(object):
+    """
+    An index of the installed packages in a DNF sack, keyed by name and
+    name.arch, so many packages can be looked up with a single sack load.
+
+    Indexes built via from_db() are cached per DNF Base object until
+    invalidate() is called (eg. after a transaction).
+    """
+
+    _cache = weakref.WeakKeyDictionary()
+    _default = None
+
+    def __init__(self, packages=()):
+        self._names = {}
+        self._count = 0
+
+        for p in packages:
+            self._names.setdefault(p.name, []).append(p)
+            self._count += 1
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return self._count
+
+    #
+    # PUBLIC METHODS
+    @classmethod
+    def from_db(cls, db=None):
+        """ Returns the index of installed packages for db.
+        Args:
+            db: A DNF Base object, a new one is filled if not provided
+        Returns:
+            The InstalledIndex
+        """
+
+        if not isinstance(db, dnf.Base):
+            if cls._default is None:
+                db = dnf.Base()
+                try:
+                    db.fill_sack()
+
+                except OSError as e:
+                    pass
+
+                cls._default = cls(db.sack.query().installed())
+
+            return cls._default
+
+        sack = db.sack
+        entry = cls._cache.get(db)
+
+        # rebuild if the sack has been reloaded since we last indexed it
+        if entry is None or entry[0] is not sack:
+            entry = cls._cache[db] = (sack, cls(sack.query().installed()))
+
+        return entry[1]
+
+    @classmethod
+    def invalidate(cls, db=None):
+        """ Discards the cached index for db, or all cached indexes. """
+        if db is None:
+            cls._cache.clear()
+            cls._default = None
+
+        else:
+            cls._cache.pop(db, None)
+
+    def get(self, name, arch=None):
+        """ Returns the first installed package matching name (and arch), or None. """
+        for p in self._names.get(name, ()):
+            if arch is None or p.arch == arch:
+                return p
+
+        return None
+
+    def packages(self, name, arch=None):
+        """ Returns all installed packages matching name (and arch). """
+        return [p for p in self._names.get(name, ()) if arch is None or p.arch == arch]
+
+    def match(self, package, subs=None):
+        """ Returns all installed packages matching the package's name, epoch,
+        version, release and arch, where defined. Fields containing glob
+        wildcards (eg. a name of foo-*) are matched as globs.
+        Args:
+            package: The canvas Package to match
+            subs: DNF substitutions (eg. releasever), defaults to substitutions()
+        Returns:
+            A list of DNF package objects
+        """
+
+        if _is_glob(package.name):
+            candidates = [p for n, ps in self._names.items() if fnmatch.fnmatchcase(n, package.name) for p in ps]
+
+        else:
+            candidates = self._names.get(package.name)
+
+        if not candidates:
+            return []
+
+        epoch = None if package.epoch is None else str(package.epoch)
+        releases = None
+
+        # specs are built with the release suffixed by the distribution tag,
+        # so accept either form
+        if package.release is not None:
+            if subs is None:
+                subs = substitutions()
+
+            releases = (package.release, '{0}.fc{1}'.format(package.release, subs['releasever']))
+
+        return [p for p in candidates if
+            (package.arch is None or _matches(p.arch, package.arch)) and
+            (epoch is None or str(p.epoch) == epoch) and
+            (package.version is None or _matches(p.version, package.version)) and
+            (releases is None or any(_matches(p.release, r) for r in releases))]
+
+
+def _is_glob(value):
+    return value is not None and any(c in value for c in '*?[')
+
+
+def _matches(value, pattern):
+    # an exact match, or a glob match for patterns with wildcards
+    if _is_glob(pattern):
+        return fnmatch.fnmatchcase(value, pattern)
+
+    return value == pattern
+
+
+def substitutions():
+    """
+    Returns the DNF substitutions (eg. releasever) used to build package
+    specs. They are read from DNF once per process unless overridden via
+    set_substitutions().
+    """
+
+    global _substitutions
+
+    if _substitutions is None:
+        _substitutions = dict(dnf.Base().conf.substitutions)
+
+    return _substitutions
+
+
+def set_substitutions(subs=None):
+    """
+    Overrides the DNF substitutions used to build package specs, or resets
+    them to be read from DNF on next use if subs is None.
+    """
+
+    global _substitutions
 
+    _substitutions = None if subs is None else dict(subs)
@@ -0,0 +1,325 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+import fnmatch
+import re
+import threading
+
+from canvas.package import Package, PackageSet
+
+# id of None in every column
+NONE = -1
+
+
+class StringDictionary(object):
+    """
+    Maps each distinct value (typically a string) to a small integer id so
+    table columns can be stored and compared as integer arrays.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._values = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    #
+    # PUBLIC METHODS
+    def find(self, value):
+        """ Returns the id of value, NONE if value is None or unknown. """
+        if value is None:
+            return NONE
+
+        return self._ids.get(value, NONE)
+
+    def id(self, value):
+        """ Returns the id of value, adding it to the dictionary if unknown. """
+        if value is None:
+            return NONE
+
+        i = self._ids.get(value)
+
+        if i is None:
+            with self._lock:
+                i = self._ids.get(value)
+
+                if i is None:
+                    i = self._ids[value] = len(self._values)
+                    self._values.append(value)
+
+        return i
+
+    def match(self, pattern):
+        """ Returns the set of ids whose value matches the glob pattern. """
+        m = re.compile(fnmatch.translate(pattern)).match
+
+        return {i for i, v in enumerate(self._values) if isinstance(v, str) and m(v)}
+
+    def value(self, i):
+        """ Returns the value of id i. """
+        if i == NONE:
+            return None
+
+        return self._values[i]
+
+
+class PackageTable(object):
+    """
+    A columnar representation of many packages, storing the name, epoch,
+    version, release, arch, action and template of each package in parallel
+    integer arrays backed by a StringDictionary.
+
+    Filtering, diffing and joining operate on the integer columns rather
+    than Package objects, which suits analysis over tens of thousands of
+    packages. Tables convert losslessly to and from PackageSets and the
+    package objects of Template.to_object().
+
+    Each table has its own dictionary unless one is given as strings. Tables
+    to be diffed or joined should share one, as columns are only comparable
+    within a dictionary and the other table is re-encoded otherwise.
+    """
+
+    COLUMNS = ('name', 'epoch', 'version', 'release', 'arch', 'template')
+
+    def __init__(self, strings=None):
+        self._strings = StringDictionary() if strings is None else strings
+
+        self._name = array.array('l')
+        self._epoch = array.array('l')
+        self._version = array.array('l')
+        self._release = array.array('l')
+        self._arch = array.array('l')
+        self._template = array.array('l')
+        self._action = array.array('l')
+
+    def __iter__(self):
+        return self.rows()
+
+    def __len__(self):
+        return len(self._name)
+
+    def _columns(self):
+        return (self._name, self._epoch, self._version, self._release, self._arch, self._template, self._action)
+
+    def _keys(self):
+        # packages equal on name when either is arch-less, or on name and arch
+        names = set(self._name)
+        arched = set(zip(self._name, self._arch))
+        archless = {n for n, a in zip(self._name, self._arch) if a == NONE}
+
+        return (names, arched, archless)
+
+    def _compatible(self, other):
+        # ids are only comparable within the same dictionary
+        if other._strings is self._strings:
+            return other
+
+        t = PackageTable(strings=self._strings)
+
+        for row in other.rows():
+            t.append(*row[:5], action=row[5], template=row[6])
+
+        return t
+
+    def _contains(self, keys):
+        (names, arched, archless) = keys
+
+        return [(n in names) if a == NONE else ((n, a) in arched or n in archless)
+                for n, a in zip(self._name, self._arch)]
+
+    #
+    # PROPERTIES
+    @property
+    def strings(self):
+        return self._strings
+
+    #
+    # PUBLIC METHODS
+    def append(self, name, epoch=None, version=None, release=None, arch=None,
+               action=Package.ACTION_INCLUDE, template=None):
+        """ Appends a single package row. """
+        s = self._strings.id
+
+        self._name.append(s(name))
+        self._epoch.append(s(epoch))
+        self._version.append(s(version))
+        self._release.append(s(release))
+        self._arch.append(s(arch))
+        self._template.append(s(template))
+        self._action.append(action)
+
+    def column(self, name):
+        """ Returns the decoded values of the named column. """
+        if name == 'action':
+            return list(self._action)
+
+        if name not in self.COLUMNS:
+            raise ValueError('unknown column: {0}'.format(name))
+
+        v = self._strings.value
+
+        return [v(i) for i in getattr(self, '_' + name)]
+
+    def diff(self, other):
+        """
+        Returns the packages unique to each table, using the same equality as
+        PackageSet (arch-less packages match any arch of the same name).
+
+        Returns:
+          Tuple of PackageTables, (in self only, in other only).
+        """
+
+        other = self._compatible(other)
+
+        in_other = self._contains(other._keys())
+        in_self = other._contains(self._keys())
+
+        return (self.take(i for i, c in enumerate(in_other) if not c),
+                other.take(i for i, c in enumerate(in_self) if not c))
+
+    def filter(self, name=None, arch=None, action=None, template=None):
+        """
+        Returns a table of the rows matching all given criteria.
+
+        Args:
+          name: glob pattern the package name must match.
+          arch: glob pattern the arch must match, '-' for no arch.
+          action: action flags (eg. Package.ACTION_INCLUDE) that must be set.
+          template: template unv the package must come from.
+        """
+
+        masks = []
+
+        if name is not None:
+            ids = self._strings.match(name)
+            masks.append([i in ids for i in self._name])
+
+        if arch is not None:
+            ids = {NONE} if arch == '-' else self._strings.match(arch)
+            masks.append([i in ids for i in self._arch])
+
+        if action is not None:
+            masks.append([(a & action) == action for a in self._action])
+
+        if template is not None:
+            t = self._strings.find(template)
+            masks.append([i == t for i in self._template])
+
+        if not masks:
+            return self.take(range(len(self)))
+
+        return self.take(i for i, m in enumerate(zip(*masks)) if all(m))
+
+    def join(self, other):
+        """
+        Returns the (self, other) row index pairs of packages equal in both
+        tables, eg. to compare the versions of packages common to both.
+        """
+
+        other = self._compatible(other)
+
+        by_name = {}
+
+        for j, n in enumerate(other._name):
+            by_name.setdefault(n, []).append(j)
+
+        pairs = []
+
+        for i, (n, a) in enumerate(zip(self._name, self._arch)):
+            for j in by_name.get(n, ()):
+                if a == NONE or other._arch[j] == NONE or a == other._arch[j]:
+                    pairs.append((i, j))
+
+        return pairs
+
+    def row(self, i):
+        """ Returns row i as a tuple of name, epoch, version, release, arch, action and template. """
+        v = self._strings.value
+
+        return (v(self._name[i]), v(self._epoch[i]), v(self._version[i]), v(self._release[i]),
+                v(self._arch[i]), self._action[i], v(self._template[i]))
+
+    def rows(self):
+        """ Yields each row as per row(). """
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def sort(self, column='name'):
+        """ Returns a table with rows ordered by the named column. """
+        values = self.column(column)
+
+        return self.take(sorted(range(len(self)), key=lambda i: (values[i] is None, values[i] or '')))
+
+    def take(self, indexes):
+        """ Returns a table of the rows at indexes, in the order given. """
+        t = PackageTable(strings=self._strings)
+        indexes = list(indexes)
+
+        for src, dst in zip(self._columns(), t._columns()):
+            dst.extend(src[i] for i in indexes)
+
+        return t
+
+    def to_object(self):
+        """ Returns the rows as package objects, as per Package.to_object(). """
+        objects = []
+
+        for (n, e, v, r, a, z, t) in self.rows():
+            o = {'n': n, 'e': e, 'v': v, 'r': r, 'a': a, 'z': z}
+
+            # only build with non-None values, as Package.to_object()
+            objects.append({key: value for key, value in o.items() if value is not None})
+
+        return objects
+
+    def to_packageset(self):
+        """ Returns the rows as a PackageSet of Packages. """
+        return PackageSet(
+            Package({'n': n, 'e': e, 'v': v, 'r': r, 'a': a, 'z': z, 't': t})
+            for (n, e, v, r, a, z, t) in self.rows())
+
+    @classmethod
+    def from_object(cls, objects, template=None, strings=None):
+        """
+        Builds a table from package objects as returned by Package.to_object(),
+        or from a template object as returned by Template.to_object().
+        """
+
+        if isinstance(objects, dict):
+            objects = objects.get('packages', [])
+
+        t = cls(strings=strings)
+
+        for o in objects:
+            t.append(o.get('n'), o.get('e'), o.get('v'), o.get('r'), o.get('a'),
+                     o.get('z', Package.ACTION_INCLUDE), o.get('t', template))
+
+        return t
+
+    @classmethod
+    def from_packages(cls, packages, strings=None):
+        """ Builds a table from an iterable of Packages, eg. a PackageSet. """
+        t = cls(strings=strings)
+
+        for p in packages:
+            t.append(p.name, p.epoch, p.version, p.release, p.arch, p.action, p.template)
+
+        return t
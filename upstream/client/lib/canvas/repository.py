@@ -17,13 +17,19 @@
 #
 
 import dnf
-import json
 
+from canvas import codec
 from canvas.set import CanvasSet
+from canvas.utilities import intern_str
 
 class Repository(object):
     """ A Canvas object that represents a Repository of packages. """
 
+    __slots__ = ('_name', '_stub', '_baseurl', '_mirrorlist', '_metalink', '_gpgkey', '_enabled',
+                 '_gpgcheck', '_cost', '_install', '_ignoregroups', '_proxy', '_noverifyssl',
+                 '_exclude_packages', '_include_packages', '_priority', '_meta_expired',
+                 '_template', '_action')
+
     # CONSTANTS
     ACTION_EXCLUDE          = 0x02
     ACTION_INCLUDE          = 0x01
@@ -39,8 +45,8 @@ class Repository(object):
         if not isinstance(repository, dict):
             raise TypeError("Repository must be a dict")
 
-        self._name     = repository.get('name', repository.get('n', None))
-        self._stub     = repository.get('stub', repository.get('s', None))
+        self._name     = intern_str(repository.get('name', repository.get('n', None)))
+        self._stub     = intern_str(repository.get('stub', repository.get('s', None)))
 
         self._baseurl    = repository.get('baseurl', repository.get('bu', None))
         self._mirrorlist = repository.get('mirrorlist', repository.get('ml', None))
@@ -63,7 +69,7 @@ class Repository(object):
 
         self._meta_expired = repository.get('meta_expired', repository.get('me', None))
 
-        self._template = repository.get('template', repository.get('t', template))
+        self._template = intern_str(repository.get('template', repository.get('t', template)))
 
         self._action   = repository.get('action', repository.get('z', self.ACTION_INCLUDE))
 
@@ -380,7 +386,7 @@ class Repository(object):
         return repo # + "\n" + url
 
     def to_json(self):
-        return json.dumps(self.to_object(), separators=(',', ':'), sort_keys=True)
+        return codec.dumps(self.to_object(), sort_keys=True)
 
     def to_object(self):
         o = {
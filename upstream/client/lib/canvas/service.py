@@ -15,16 +15,54 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import asyncio
 import codecs
+import collections
+import concurrent.futures
+import functools
 import getpass
 import hmac
 import http.cookiejar
+import io
 import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import urllib.request, urllib.parse, urllib.error
 
+from canvas import codec
+from canvas.cache import LookupIndex
+from canvas.connection import ConnectionPool, build_opener
 from canvas.template import Template
 from canvas.machine import Machine
+from canvas.timing import span
+import canvas.timing
+
+# the session cookie jar, with the time each host's session was last verified
+# kept alongside it, private to the user
+SESSION_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'canvas', 'session')
+
+# marks the worker threads of an AsyncService, see _template_resolve_includes
+_async_worker = threading.local()
+
+
+def _async_worker_init():
+    _async_worker.active = True
+
+
+def _timed(phase):
+    # record the wall time of a Service method as the named phase
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with span(self._timings, phase):
+                return fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 class ServiceException(Exception):
@@ -40,25 +78,243 @@ class ServiceException(Exception):
 
 
 class Service(object):
-    def __init__(self, host='https://canvas.kororaproject.org', username=None):
+    def __init__(self, host='https://canvas.kororaproject.org', username=None, pool=None, max_workers=4, cache=None, index=None, session_ttl=None, compress_min=None, timings=None, delta_updates=False, session_path=None):
         self._host = host
         self._urlbase = host
 
         self._username = username
 
-        self._cookiejar = http.cookiejar.LWPCookieJar('/tmp/.canvas-session')
-        self._opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self._cookiejar))
+        # all requests, including the authentication cookie flow, share a
+        # pool of keep-alive connections and accept compressed responses
+        if pool is None:
+            pool = ConnectionPool()
+
+        self._pool = pool
+
+        # request and phase timings, if enabled (see canvas.timing)
+        if timings is None:
+            timings = canvas.timing.default()
+
+        self._timings = timings
+
+        # the session cookie jar, shared with other canvas processes
+        if session_path is None:
+            session_path = SESSION_PATH
+
+        self._cookiejar = http.cookiejar.LWPCookieJar(session_path)
+        self._opener = build_opener(urllib.request.HTTPCookieProcessor(self._cookiejar),
+                pool=self._pool, compress_min=compress_min, timings=self._timings)
 
         self._authenticated = False
+        self._authenticated_at = None
+        self._auth_lock = threading.RLock()
+
+        # verified sessions are trusted for session_ttl seconds, both within
+        # this process and by other processes sharing the cookie jar
+        if session_ttl is None:
+            session_ttl = os.environ.get('CANVAS_SESSION_TTL', 300)
+
+        self._session_ttl = float(session_ttl)
+        self._session_stamp_path = session_path + '.verified'
+
+        # bound on concurrent requests when resolving template includes
+        self._max_workers = max_workers
+
+        # delta template updates (PATCH) are only sent when enabled, as not
+        # every server supports them, and stop once the server refuses one
+        self._delta_supported = bool(delta_updates)
+
+        # optional on-disk TemplateCache for read only template access
+        self._cache = cache
+
+        # persistent name to uuid lookups, avoiding a lookup round trip for
+        # templates and machines we've seen before
+        if index is None:
+            index = cache.index if cache is not None else LookupIndex()
+
+        self._index = index
+
+    @staticmethod
+    def _unv(user, name, version=None):
+        if version:
+            return '{0}:{1}@{2}'.format(user, name, version)
+
+        return '{0}:{1}'.format(user, name)
+
+    @staticmethod
+    def _fields(fields):
+        # normalise a field projection to the comma separated query form
+        if fields is None:
+            return None
+
+        if isinstance(fields, str):
+            fields = fields.split(',')
+
+        return ','.join(f.strip() for f in fields if f.strip())
+
+    def _index_add(self, kind, items):
+        # record lookups from server responses (templates or machines)
+        lookups = {}
+
+        for i in items:
+            if not isinstance(i, dict) or not i.get('uuid') or not i.get('stub'):
+                continue
+
+            user = i.get('user', i.get('username'))
+
+            # names are unique per account, so the versionless key used by
+            # deletes resolves to the same uuid as the versioned one
+            lookups[self._unv(user, i['stub'])] = i['uuid']
+
+            if i.get('version'):
+                lookups[self._unv(user, i['stub'], i['version'])] = i['uuid']
+
+        if len(lookups):
+            self._index.update(kind, lookups)
+
+    def _index_request(self, kind, unv, method=None):
+        """
+        Performs a request directly against the uuid previously seen for unv,
+        skipping the name lookup.
+
+        Returns:
+          The decoded response, or None if the lookup is unknown or stale.
+
+        Raises:
+          ServiceException: a request other than a read failed, it is not
+            sent again.
+        """
+
+        uuid = self._index.get(kind, unv)
+
+        if uuid is None:
+            return None
+
+        r = urllib.request.Request('{0}/api/{1}/{2}.json'.format(self._urlbase, kind, uuid))
+
+        if method is not None:
+            r.get_method = lambda: method
+
+        try:
+            u = self._open(r)
+            res = json.loads(u.read().decode('utf-8'))
+
+            if method == 'DELETE':
+                self._index.discard(kind, uuid=uuid)
+
+            return res
+
+        except urllib.error.HTTPError as e:
+            logging.debug(e)
+
+            # only a missing uuid makes the lookup stale
+            if e.code == 404:
+                self._index.discard(kind, uuid=uuid)
+
+            # the server may have acted on anything but a read, so it is
+            # never sent again through the lookup
+            elif method is not None:
+                try:
+                    res = json.loads(e.fp.read().decode('utf-8'))
+
+                except (ValueError, AttributeError):
+                    res = {}
+
+                raise ServiceException('{0}'.format(res.get('error', 'unknown')))
+
+        except urllib.error.URLError as e:
+            logging.debug(e)
+
+            if method is not None:
+                raise ServiceException('unable to reach {0}'.format(self._urlbase))
+
+        return None
+
+    def _template_data_fetch(self, uuid, unv, cached=False, updated=None, fields=None):
+        entry = None
+        if cached and self._cache is not None:
+            entry = self._cache.entry(uuid)
+
+        # revalidate against the server reported update stamp
+        if entry is not None and updated is not None and entry.get('updated') == updated:
+            logging.debug('Cached template {0} is current'.format(unv))
+            self._cache.touch(uuid)
+            return entry['data']
+
+        url = '{0}/api/template/{1}.json'.format(self._urlbase, uuid)
+
+        # a projected response is a partial document, it can neither be
+        # validated against nor stored as a full cache entry
+        if fields:
+            url += '?' + urllib.parse.urlencode({'fields': fields})
+            entry = None
+
+        r = urllib.request.Request(url)
+
+        if entry is not None and entry.get('etag') is not None:
+            r.add_header('If-None-Match', entry['etag'])
+
+        try:
+            u = self._open(r)
+
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry is not None:
+                logging.debug('Cached template {0} is current'.format(unv))
+                self._cache.touch(uuid)
+                return entry['data']
+
+            raise
+
+        data = codec.loads(u.read())
+
+        if self._cache is not None and not fields:
+            self._cache.put(unv, data, etag=u.headers.get('ETag'), updated=updated)
+
+        self._index.set('template', unv, uuid)
+        self._index_add('template', [data])
 
-    def _template_data_get(self, template):
+        return data
+
+    def _template_data_get(self, template, cached=False, fields=None):
         if not isinstance(template, Template):
             TypeError('template is not of type Template')
 
+        # serve fresh entries straight from the local cache
+        if cached and self._cache is not None:
+            data = self._cache.get(unv=template.unv, fresh=True)
+
+            if data is not None:
+                logging.debug('Using cached template {0}'.format(template.unv))
+                return Template(template=data)
+
+        # skip the name lookup if we've seen this template before, unless
+        # there is a cached copy to revalidate against the lookup's update
+        # stamp, which is cheaper than fetching the template again
+        uuid = self._index.get('template', template.unv)
+
+        if uuid is not None and cached and not fields and self._cache is not None and self._cache.entry(uuid) is not None:
+            uuid = None
+
+        if uuid is not None:
+            try:
+                return Template(template=self._template_data_fetch(uuid, template.unv, cached=cached, fields=fields))
+
+            except urllib.error.HTTPError as e:
+                # fall back to the lookup, forgetting the uuid if it's gone
+                logging.debug(e)
+
+                if e.code == 404:
+                    self._index.discard('template', uuid=uuid)
+
+            except urllib.error.URLError as e:
+                logging.debug(e)
+
+        # the lookup only needs to identify the template
         query = {
             'user':    template.user,
             'name':    template.name,
-            'version': template.version
+            'version': template.version,
+            'fields':  'updated'
         }
 
         query = {k: v for k, v in query.items() if v != None}
@@ -68,22 +324,22 @@ class Service(object):
         logging.debug('Fetching template from {0}'.format(r.full_url))
 
         try:
-            u = self._opener.open(r)
+            u = self._open(r)
             template_summary = json.loads(u.read().decode('utf-8'))
 
             # nothing returned, so authenticate and retry
             if len(template_summary) == 0 and not self._authenticated:
                 self.authenticate()
 
-                u = self._opener.open(r)
+                u = self._open(r)
                 template_summary = json.loads(u.read().decode('utf-8'))
 
             if len(template_summary):
+                self._index_add('template', template_summary)
+
                 # we only have one returned since template names are unique per account
-                r = urllib.request.Request('{0}/api/template/{1}.json'.format(self._urlbase,
-                        template_summary[0]['uuid']))
-                u = self._opener.open(r)
-                data = json.loads(u.read().decode('utf-8'))
+                data = self._template_data_fetch(template_summary[0]['uuid'], template.unv,
+                        cached=cached, updated=template_summary[0].get('updated', None), fields=fields)
 
                 return Template(template=data)
 
@@ -92,6 +348,15 @@ class Service(object):
         except urllib.error.URLError as e:
             # TODO: clean up error message
             logging.debug(e)
+
+            # fall back to any cached copy when the server is unreachable
+            if cached and self._cache is not None and not isinstance(e, urllib.error.HTTPError):
+                data = self._cache.get(unv=template.unv)
+
+                if data is not None:
+                    logging.warning('Unable to reach {0}, using cached template {1}'.format(self._urlbase, template.unv))
+                    return Template(template=data)
+
             raise ServiceException('unknown service response')
 
         except urllib.error.HTTPError as e:
@@ -99,25 +364,125 @@ class Service(object):
             logging.debug(e)
             raise ServiceException('unknown service response')
 
-    def _template_resolve_includes(self, template_src):
+    def _template_patch(self, template, delta):
+        """
+        Uploads a template delta (see Template.to_delta).
+
+        Returns:
+          Server response dict, or None if the server doesn't support deltas.
+        """
+
+        r = urllib.request.Request('{0}/api/template/{1}.json'.format(self._urlbase, template.uuid),
+                json.dumps(delta, separators=(',', ':')).encode('utf-8'))
+        r.add_header('Content-Type', 'application/json')
+        r.get_method = lambda: 'PATCH'
+
+        try:
+            u = self._open(r)
+            res = json.loads(u.read().decode('utf-8'))
+
+        except urllib.error.HTTPError as e:
+            # servers without delta support either don't route PATCH or
+            # redirect it to the index
+            if e.code in (404, 405, 501) or 300 <= e.code < 400:
+                logging.debug('Delta updates not supported, sending full template')
+                self._delta_supported = False
+                return None
+
+            # the update precondition failed
+            if e.code in (409, 412):
+                raise ServiceException('template has changed on the server, fetch it and try again')
+
+            try:
+                res = json.loads(e.fp.read().decode('utf-8'))
+
+            except ValueError:
+                res = {}
+
+            raise ServiceException('{0}'.format(res.get('error', 'unknown')))
+
+        except urllib.error.URLError as e:
+            logging.debug(e)
+            raise ServiceException('unknown service response')
+
+        if self._cache is not None:
+            self._cache.invalidate(uuid=template.uuid)
+
+        return res
+
+    def _template_resolve_includes(self, template_src, cached=False, fields=None):
         if not template_src.includes:
             return template_src
 
-        for i in template_src.includes:
-            data = self._template_data_get(Template(i))
-            data_resolv = self._template_resolve_includes(data)
+        # build the include graph breadth first, fetching each unique
+        # template only once regardless of how many times it's included
+        fetched = {}
+        level = list(collections.OrderedDict.fromkeys(template_src.includes))
+
+        fetch = lambda i: self._template_data_get(Template(i), cached=cached, fields=fields)
+
+        # AsyncService workers already bound the requests in flight, so they
+        # fetch includes serially rather than on a nested pool
+        executor = None
+
+        if not getattr(_async_worker, 'active', False):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+
+        try:
+            while level:
+                templates = (map if executor is None else executor.map)(fetch, level)
+
+                for i, t in zip(level, templates):
+                    fetched[i] = t
+
+                level = list(collections.OrderedDict.fromkeys(
+                    i for u in level for i in fetched[u].includes if i not in fetched
+                ))
+
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # detect cycles before we attempt to flatten
+        visited = set()
+
+        def _check_cycles(includes, path):
+            for i in includes:
+                if i in path:
+                    cycle = ' -> '.join(path[path.index(i):] + [i])
+                    raise ServiceException('template include cycle detected: {0}'.format(cycle))
+
+                if i not in visited:
+                    _check_cycles(fetched[i].includes, path + [i])
+                    visited.add(i)
+
+        _check_cycles(template_src.includes, [template_src.unv])
+
+        # flatten bottom up, shared includes are only flattened once
+        resolved = {}
+
+        def _resolve(unv):
+            if unv not in resolved:
+                t = fetched[unv]
+
+                for i in t.includes:
+                    t._includes_resolved.append(_resolve(i))
+
+                t._flatten()
+                resolved[unv] = t
 
-            data_resolv._flatten()
+            return resolved[unv]
 
-            template_src._includes_resolved.append(data_resolv)
+        for i in template_src.includes:
+            template_src._includes_resolved.append(_resolve(i))
 
         template_src._flatten()
         return template_src
 
-    def authenticate(self, username=None, password=None, prompt=None, force=False):
+    def _authenticate(self, username=None, password=None, prompt=None, force=False):
         logging.debug('Authenticating to {0}'.format(self._urlbase))
 
-        if self._authenticated and not force:
+        if self._authenticated and not force and self._session_fresh(self._authenticated_at):
             return self._authenticated
 
         # load any saved cookies
@@ -127,12 +492,20 @@ class Service(object):
         except Exception as e:
             pass
 
+        # trust a session recently verified by this or another canvas process
+        if not force and len(self._cookiejar) and self._session_fresh(self._session_stamp_get()):
+            logging.debug('Using recently verified session')
+            self._authenticated = True
+            self._authenticated_at = time.time()
+
+            return self._authenticated
+
         # detect if we've got a valid session cookie
         try:
             r = urllib.request.Request('{0}/authorised.json'.format(self._urlbase))
             u = self._opener.open(r)
 
-            self._authenticated = True
+            self._session_verified()
 
             return self._authenticated
 
@@ -159,8 +532,14 @@ class Service(object):
             r = urllib.request.Request('{0}/authenticate.json'.format(self._urlbase), auth)
             u = self._opener.open(r)
 
-            self._cookiejar.save()
-            self._authenticated = True
+            try:
+                os.makedirs(os.path.dirname(self._cookiejar.filename), mode=0o700, exist_ok=True)
+                self._cookiejar.save()
+
+            except (IOError, OSError) as e:
+                logging.debug(e)
+
+            self._session_verified()
 
             return self._authenticated
 
@@ -171,6 +550,123 @@ class Service(object):
 
         raise ServiceException('unable to authenticate')
 
+    def _open(self, r):
+        try:
+            return self._opener.open(r)
+
+        except urllib.error.HTTPError as e:
+            if not self._authenticated or e.code not in (401, 403):
+                raise
+
+            # the server answers 403 for both expired sessions and denied
+            # access, only the former are worth re-authenticating for
+            if e.code == 403:
+                body = e.read()
+
+                if not self._session_expired(body):
+                    # leave the body readable for the caller's error handling
+                    raise urllib.error.HTTPError(e.url, e.code, e.msg, e.hdrs, io.BytesIO(body)) from None
+
+            # our trusted session may have expired server side, so verify
+            # (and if needed re-establish) it before retrying once
+            logging.debug('Session rejected, re-authenticating')
+
+            self._session_stamp_set(None)
+            self.authenticate(force=True)
+
+            return self._opener.open(r)
+
+    def _run_async(self, method, *args, **kwargs):
+        # run a bulk AsyncService method to completion on a private event
+        # loop, sharing this service's connections, session and caches
+        service = AsyncService(service=self, max_concurrency=self._max_workers)
+        loop = asyncio.new_event_loop()
+
+        try:
+            return loop.run_until_complete(getattr(service, method)(*args, **kwargs))
+
+        finally:
+            service.close()
+            loop.close()
+
+    @staticmethod
+    def _session_expired(body):
+        # the error body of a 403 for a session the server no longer knows
+        try:
+            return json.loads(body.decode('utf-8')).get('error') == 'not authenticated.'
+
+        except (ValueError, AttributeError):
+            return False
+
+    def _session_fresh(self, stamp):
+        return stamp is not None and (time.time() - stamp) < self._session_ttl
+
+    def _session_stamp_get(self):
+        try:
+            with open(self._session_stamp_path, 'r') as f:
+                stamp = json.load(f).get(self._urlbase)
+
+        except (IOError, OSError, ValueError, AttributeError):
+            return None
+
+        if not isinstance(stamp, (int, float)):
+            return None
+
+        return stamp
+
+    def _session_stamp_set(self, stamp):
+        # record when the session was last verified per host, so other canvas
+        # processes sharing the cookie jar can skip verifying it themselves
+        try:
+            with open(self._session_stamp_path, 'r') as f:
+                stamps = json.load(f)
+
+        except (IOError, OSError, ValueError):
+            stamps = {}
+
+        if not isinstance(stamps, dict):
+            stamps = {}
+
+        if stamp is None:
+            stamps.pop(self._urlbase, None)
+
+        else:
+            stamps[self._urlbase] = stamp
+
+        # replace atomically so concurrent canvas processes never see a
+        # partially written file
+        path = os.path.dirname(self._session_stamp_path)
+
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+
+            fd, tmp_path = tempfile.mkstemp(dir=path)
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stamps, f)
+
+            os.replace(tmp_path, self._session_stamp_path)
+
+        except (IOError, OSError) as e:
+            logging.debug(e)
+
+    def _session_verified(self):
+        self._authenticated = True
+        self._authenticated_at = time.time()
+
+        self._session_stamp_set(self._authenticated_at)
+
+    @_timed('authenticate')
+    def authenticate(self, username=None, password=None, prompt=None, force=False):
+        # include resolution may need to authenticate from several worker
+        # threads at once, ensure only one of them prompts
+        with self._auth_lock:
+            return self._authenticate(username, password, prompt, force)
+
+    def close(self):
+        """ Close all pooled connections held by the service. """
+        self._pool.close()
+
     def deauthenticate(self, username='', password='', force=False):
         if not self._authenticated and not force:
             return self._authenticated
@@ -186,11 +682,15 @@ class Service(object):
 
         #
         self._authenticated = False
+        self._authenticated_at = None
+
+        self._session_stamp_set(None)
 
         return self._authenticated
 
     #
     # MACHINE METHODS
+    @_timed('machine_create')
     def machine_create(self, machine):
         if not isinstance(machine, Machine):
             TypeError('machine is not of type Machine')
@@ -200,7 +700,7 @@ class Service(object):
 
         try:
             r = urllib.request.Request('{0}/api/machines.json'.format(self._urlbase), machine.to_json().encode('utf-8'))
-            u = self._opener.open(r)
+            u = self._open(r)
             res = json.loads(u.read().decode('utf-8'))
 
             return res
@@ -215,6 +715,7 @@ class Service(object):
 
         raise ServiceException('unable to add machine.')
 
+    @_timed('machine_delete')
     def machine_delete(self, machine):
         if not isinstance(machine, Machine):
             TypeError('machine is not of type Machine')
@@ -224,18 +725,26 @@ class Service(object):
         # always auth
         self.authenticate()
 
+        # skip the name lookup if we've seen this machine before
+        res = self._index_request('machine', self._unv(machine.user, machine.name), method='DELETE')
+
+        if res is not None:
+            return res
+
         try:
             r = urllib.request.Request('{0}/api/machines.json?{1}'.format(self._urlbase, urllib.parse.urlencode(query)))
-            u = self._opener.open(r)
+            u = self._open(r)
 
             machine_summary = json.loads(u.read().decode('utf-8'))
 
             if len(machine_summary):
                 r = urllib.request.Request('{0}/api/machine/{1}.json'.format(self._urlbase, machine_summary[0]['uuid']))
                 r.get_method = lambda: 'DELETE'
-                u = self._opener.open(r)
+                u = self._open(r)
                 res = json.loads(u.read().decode('utf-8'))
 
+                self._index.discard('machine', uuid=machine_summary[0]['uuid'])
+
                 return res
 
         except urllib.error.URLError as e:
@@ -260,23 +769,32 @@ class Service(object):
 
         query = {k: v for k, v in query.items() if v != None}
 
+        # skip the name lookup if we've seen this machine before
+        data = self._index_request('machine', self._unv(machine.user, machine.name, machine.version))
+
+        if data is not None:
+            return Machine(machine=data)
+
         r = urllib.request.Request('{0}/api/machines.json?{1}'.format(self._urlbase, urllib.parse.urlencode(query)))
 
         try:
-            u = self._opener.open(r)
+            u = self._open(r)
             machine_summary = json.loads(u.read().decode('utf-8'))
 
             # nothing returned, so authenticate and retry
             if len(machine_summary) == 0 and not self._authenticated:
                 self.authenticate()
 
-                u = self._opener.open(r)
+                u = self._open(r)
                 machine_summary = json.loads(u.read().decode('utf-8'))
 
             if len(machine_summary):
+                self._index_add('machine', machine_summary)
+                self._index.set('machine', self._unv(machine.user, machine.name, machine.version), machine_summary[0]['uuid'])
+
                 # we only have one returned since machine names are unique per account
                 r = urllib.request.Request('{0}/api/machine/{1}.json'.format(self._urlbase, machine_summary[0]['uuid']))
-                u = self._opener.open(r)
+                u = self._open(r)
                 data = json.loads(u.read().decode('utf-8'))
 
                 return Machine(machine=data)
@@ -305,9 +823,10 @@ class Service(object):
 
         try:
             r = urllib.request.Request('{0}/api/machines.json?{1}'.format(self._urlbase, params))
-            u = self._opener.open(r)
+            u = self._open(r)
 
             res = json.loads(u.read().decode('utf-8'))
+            self._index_add('machine', res)
 
             return res
 
@@ -321,6 +840,7 @@ class Service(object):
 
         return []
 
+    @_timed('machine_sync')
     def machine_sync(self, uuid=None, key=None, data=None, template=None):
         # generate nonce and hmac with
         nonce = 'foo'
@@ -343,7 +863,7 @@ class Service(object):
             elif isinstance(template, str):
                 r.add_header('x-canvas-template', template)
 
-            u = self._opener.open(r)
+            u = self._open(r)
             res = json.loads(u.read().decode('utf-8'))
 
             return res
@@ -358,6 +878,7 @@ class Service(object):
 
         raise ServiceException('unable to update machine.')
 
+    @_timed('machine_update')
     def machine_update(self, machine):
         if not isinstance(machine, Machine):
             TypeError('machine is not of type Machine')
@@ -368,7 +889,7 @@ class Service(object):
         try:
             r = urllib.request.Request('{0}/api/machine/{1}.json'.format(self._urlbase, machine.uuid), machine.to_json().encode('utf-8'))
             r.get_method = lambda: 'PUT'
-            u = self._opener.open(r)
+            u = self._open(r)
             res = json.loads(u.read().decode('utf-8'))
 
             return res
@@ -383,8 +904,54 @@ class Service(object):
 
         raise ServiceException('unable to update machine.')
 
+    def machines_get_many(self, machines, return_exceptions=False):
+        """ Fetches many machines concurrently, see AsyncService.machines_get_many. """
+        return self._run_async('machines_get_many', machines, return_exceptions=return_exceptions)
+
+    def machines_sync_many(self, machines, template=None, return_exceptions=False):
+        """ Syncs many machines concurrently, see AsyncService.machines_sync_many. """
+        return self._run_async('machines_sync_many', machines, template=template, return_exceptions=return_exceptions)
+
     #
     # TEMPLATE METHODS
+    @_timed('template_compile')
+    def template_compile(self, template, force=False):
+        """
+        Fetches and resolves a template, compiling it to the local cache
+        unless a compiled artifact of the same template and include versions
+        already exists.
+
+        Args:
+          template: Template identifying the user, name and version to compile.
+          force: compile even if a current artifact exists.
+
+        Returns:
+          Tuple of the resolved Template and the compiled manifest dict.
+
+        Raises:
+          ServiceException: no template cache is configured.
+        """
+
+        if self._cache is None:
+            raise ServiceException('compiling templates requires a template cache.')
+
+        t = self.template_get(template, cached=True)
+
+        manifest = None
+
+        if not force:
+            manifest = self._cache.compiled.get(t.uuid, versions=t.versions())
+
+        if manifest is None:
+            logging.debug('Compiling template {0}'.format(t.unv))
+            manifest = self._cache.compiled.put(t)
+
+            if manifest is None:
+                raise ServiceException('unable to compile template.')
+
+        return (t, manifest)
+
+    @_timed('template_create')
     def template_create(self, template):
         if not isinstance(template, Template):
             TypeError('template is not of type Template')
@@ -394,7 +961,7 @@ class Service(object):
 
         try:
             r = urllib.request.Request('{0}/api/templates.json'.format(self._urlbase), template.to_json().encode('utf-8'))
-            u = self._opener.open(r)
+            u = self._open(r)
             res = json.loads(u.read().decode('utf-8'))
 
             return res
@@ -409,6 +976,7 @@ class Service(object):
 
         raise ServiceException('unable to add template.')
 
+    @_timed('template_delete')
     def template_delete(self, template):
         if not isinstance(template, Template):
             TypeError('template is not of type Template')
@@ -416,19 +984,33 @@ class Service(object):
         # always auth
         self.authenticate()
 
+        # skip the name lookup if we've seen this template before
+        res = self._index_request('template', self._unv(template.user, template.name), method='DELETE')
+
+        if res is not None:
+            if self._cache is not None:
+                self._cache.invalidate(uuid=res.get('uuid'))
+
+            return res
+
         query = {'user': template.user, 'name': template.name}
         r = urllib.request.Request('%s/api/templates.json?%s' % (self._urlbase, urllib.parse.urlencode(query)))
 
         try:
-            u = self._opener.open(r)
+            u = self._open(r)
             template_summary = json.loads(u.read().decode('utf-8'))
 
             if len(template_summary):
                 r = urllib.request.Request('%s/api/template/%s.json' % (self._urlbase, template_summary[0]['uuid']))
                 r.get_method = lambda: 'DELETE'
-                u = self._opener.open(r)
+                u = self._open(r)
                 res = json.loads(u.read().decode('utf-8'))
 
+                if self._cache is not None:
+                    self._cache.invalidate(uuid=template_summary[0]['uuid'])
+
+                self._index.discard('template', uuid=template_summary[0]['uuid'])
+
                 return res
 
         except urllib.error.URLError as e:
@@ -441,7 +1023,25 @@ class Service(object):
 
         raise ServiceException('unable to delete template.')
 
-    def template_get(self, template, auth=False, resolve_includes=True):
+    def template_get(self, template, auth=False, resolve_includes=True, cached=False, fields=None):
+        """
+        Fetches a template (and optionally its includes) from the server.
+
+        Args:
+          template: Template identifying the user, name and version to fetch.
+          auth: force authentication prior to fetching.
+          resolve_includes: fetch and flatten all included templates.
+          cached: allow the template and its includes to be served from the
+            local cache, only appropriate for read only use.
+          fields: list (or comma separated string) of template fields to
+            fetch, eg. ['packages']. Identifying fields and includes are
+            always returned. Projected templates are partial and must not be
+            used for updates.
+
+        Returns:
+          Template
+        """
+
         if not isinstance(template, Template):
             TypeError('template is not of type Template')
 
@@ -449,13 +1049,53 @@ class Service(object):
         if auth:
             self.authenticate()
 
-        template = self._template_data_get(template)
+        fields = self._fields(fields)
+
+        with span(self._timings, 'template_fetch'):
+            template = self._template_data_get(template, cached=cached, fields=fields)
 
         if resolve_includes:
-            template = self._template_resolve_includes(template)
+            with span(self._timings, 'template_resolve_includes'):
+                template = self._template_resolve_includes(template, cached=cached, fields=fields)
 
         return template
 
+    def template_get_compiled(self, template):
+        """
+        Returns a fully resolved template from the compiled cache, compiling
+        it first if absent or outdated (see template_compile).
+
+        When the cached entries of the template and all its includes are
+        fresh (see TemplateCache.ttl) and match the compiled versions, the
+        compiled template is loaded without touching the server at all. This
+        requires a non-zero ttl, with the default ttl of 0 entries are never
+        fresh and the template is revalidated by template_compile.
+
+        Args:
+          template: Template identifying the user, name and version to fetch.
+
+        Returns:
+          Tuple of the resolved Template and the compiled manifest dict. The
+          compiled kickstart is available at
+          TemplateCache.compiled.kickstart(manifest['uuid']).
+        """
+
+        if self._cache is None:
+            raise ServiceException('compiling templates requires a template cache.')
+
+        manifest = self._cache.compiled.manifest(self._cache.lookup(template.unv))
+
+        if manifest is not None:
+            entries = [(self._cache.entry(u), v) for u, v in manifest['versions'].items()]
+
+            if all(e is not None and self._cache.is_fresh(e) and e.get('updated') == v for e, v in entries):
+                data = self._cache.compiled.load(manifest['uuid'])
+
+                if data is not None:
+                    logging.debug('Compiled template {0} is current'.format(template.unv))
+                    return (Template(data), manifest)
+
+        return self.template_compile(template)
 
     def template_list(self, user=None, name=None, description=None, public=False):
         params = {
@@ -472,9 +1112,10 @@ class Service(object):
 
         try:
             r = urllib.request.Request('{0}/api/templates.json?{1}'.format(self._urlbase, params))
-            u = self._opener.open(r)
+            u = self._open(r)
 
             res = json.loads(u.read().decode('utf-8'))
+            self._index_add('template', res)
 
             return res
 
@@ -488,19 +1129,45 @@ class Service(object):
 
         return []
 
-    def template_update(self, template):
+    @_timed('template_update')
+    def template_update(self, template, delta=True):
+        """
+        Uploads changes to an existing template.
+
+        Args:
+          template: Template to update.
+          delta: attempt to upload only the changes made since the template
+            was fetched when the service has delta updates enabled, falling
+            back to the full template if the server doesn't support them.
+
+        Returns:
+          Server response dict.
+        """
+
         if not isinstance(template, Template):
             TypeError('template is not of type Template')
 
         # always auth
         self.authenticate()
 
+        if delta and self._delta_supported:
+            body = template.to_delta()
+
+            if body is not None:
+                res = self._template_patch(template, body)
+
+                if res is not None:
+                    return res
+
         try:
             r = urllib.request.Request('{0}/api/template/{1}.json'.format(self._urlbase, template.uuid), template.to_json().encode('utf-8'))
             r.get_method = lambda: 'PUT'
-            u = self._opener.open(r)
+            u = self._open(r)
             res = json.loads(u.read().decode('utf-8'))
 
+            if self._cache is not None:
+                self._cache.invalidate(uuid=template.uuid)
+
             return res
 
         except urllib.error.URLError as e:
@@ -512,3 +1179,165 @@ class Service(object):
             raise ServiceException('unknown service response')
 
         raise ServiceException('unable to update template.')
+
+    def templates_get_many(self, templates, resolve_includes=True, cached=False, return_exceptions=False):
+        """ Fetches many templates concurrently, see AsyncService.templates_get_many. """
+        return self._run_async('templates_get_many', templates, resolve_includes=resolve_includes,
+            cached=cached, return_exceptions=return_exceptions)
+
+    def templates_update_many(self, templates, return_exceptions=False):
+        """ Updates many templates concurrently, see AsyncService.templates_update_many. """
+        return self._run_async('templates_update_many', templates, return_exceptions=return_exceptions)
+
+
+class AsyncService(object):
+    """
+    An asyncio interface to the canvas service.
+
+    Each request is performed by a (synchronous) Service on a bounded pool of
+    worker threads, so coroutines share its keep-alive connections, session
+    and caches while at most max_concurrency requests are in flight.
+    """
+
+    def __init__(self, service=None, max_concurrency=8, **kwargs):
+        self._owned = service is None
+
+        if service is None:
+            service = Service(**kwargs)
+
+        self._service = service
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency,
+            initializer=_async_worker_init)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # waiting for the workers blocks, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _gather(self, coros, return_exceptions=False):
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+    #
+    # PROPERTIES
+    @property
+    def service(self):
+        return self._service
+
+    #
+    # PUBLIC METHODS
+    async def authenticate(self, username=None, password=None, prompt=None, force=False):
+        return await self._call(self._service.authenticate, username, password, prompt, force)
+
+    def close(self):
+        """ Shut down the worker pool, closing the service if we created it. """
+        self._executor.shutdown(wait=True)
+
+        if self._owned:
+            self._service.close()
+
+    #
+    # MACHINE METHODS
+    async def machine_get(self, machine):
+        return await self._call(self._service.machine_get, machine)
+
+    async def machine_list(self, user=None, name=None, description=None):
+        return await self._call(self._service.machine_list, user=user, name=name, description=description)
+
+    async def machine_sync(self, uuid=None, key=None, data=None, template=None):
+        return await self._call(self._service.machine_sync, uuid=uuid, key=key, data=data, template=template)
+
+    async def machine_update(self, machine):
+        return await self._call(self._service.machine_update, machine)
+
+    async def machines_get_many(self, machines, return_exceptions=False):
+        """
+        Fetches many machines concurrently.
+
+        Args:
+          machines: iterable of Machine objects to fetch.
+          return_exceptions: return exceptions in place of results rather than
+            raising the first one encountered.
+
+        Returns:
+          List of Machine objects in the same order as supplied.
+        """
+
+        return await self._gather([self.machine_get(m) for m in machines], return_exceptions)
+
+    async def machines_sync_many(self, machines, template=None, return_exceptions=False):
+        """
+        Syncs many machines concurrently.
+
+        Args:
+          machines: iterable of (uuid, key) pairs identifying each machine.
+          template: template to request with each sync (see machine_sync).
+          return_exceptions: return exceptions in place of results rather than
+            raising the first one encountered.
+
+        Returns:
+          List of sync responses in the same order as supplied.
+        """
+
+        machines = list(machines)
+
+        if len(machines):
+            await self.authenticate()
+
+        return await self._gather([self.machine_sync(uuid=u, key=k, template=template) for u, k in machines], return_exceptions)
+
+    #
+    # TEMPLATE METHODS
+    async def template_get(self, template, auth=False, resolve_includes=True, cached=False, fields=None):
+        return await self._call(self._service.template_get, template, auth=auth,
+            resolve_includes=resolve_includes, cached=cached, fields=fields)
+
+    async def template_list(self, user=None, name=None, description=None, public=False):
+        return await self._call(self._service.template_list, user=user, name=name,
+            description=description, public=public)
+
+    async def template_update(self, template, delta=True):
+        return await self._call(self._service.template_update, template, delta=delta)
+
+    async def templates_get_many(self, templates, resolve_includes=True, cached=False, return_exceptions=False):
+        """
+        Fetches many templates concurrently.
+
+        Args:
+          templates: iterable of Template objects to fetch.
+          resolve_includes: fetch and flatten all included templates.
+          cached: allow templates to be served from the local cache.
+          return_exceptions: return exceptions in place of results rather than
+            raising the first one encountered.
+
+        Returns:
+          List of Template objects in the same order as supplied.
+        """
+
+        return await self._gather([self.template_get(t, resolve_includes=resolve_includes, cached=cached)
+            for t in templates], return_exceptions)
+
+    async def templates_update_many(self, templates, return_exceptions=False):
+        """
+        Updates many templates concurrently.
+
+        Args:
+          templates: iterable of Template objects to update.
+          return_exceptions: return exceptions in place of results rather than
+            raising the first one encountered.
+
+        Returns:
+          List of update responses in the same order as supplied.
+        """
+
+        templates = list(templates)
+
+        if len(templates):
+            await self.authenticate()
+
+        return await self._gather([self.template_update(t) for t in templates], return_exceptions)
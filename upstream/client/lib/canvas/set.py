@@ -17,41 +17,174 @@
 #
 
 import collections
+import collections.abc
+import hashlib
+import itertools
+
+class CanvasSet(collections.abc.MutableSet):
+    """
+    An insertion ordered set of canvas items (packages, repos, objects).
+
+    Items are indexed by bucket (see _bucket) so membership, add and discard
+    are O(1), while membership itself is still decided by item equality
+    within the bucket. This preserves equality rules that aren't consistent
+    with hashing, such as an arch-less Package being equal to the same
+    package of any arch.
+    """
 
-class CanvasSet(collections.MutableSet):
     def __init__(self, initvalue=()):
-        self._set = []
+        # items keyed on a token reflecting insertion order, and tokens
+        # grouped by bucket for lookup
+        self._items = collections.OrderedDict()
+        self._buckets = {}
+        self._tokens = itertools.count()
+
+        # bumped on every change, allowing views of the set to be cached
+        self._version = 0
+
+        # snapshot of the items for indexing and iteration, see _snapshot
+        self._snapshot_list = None
+
+        # item digests keyed on item identity and the set digest, see digest
+        self._digests = {}
+        self._digest = None
 
         for value in initvalue:
             self.add(value)
 
     def __contains__(self, item):
-        return item in self._set
+        return self._find(item) is not None
 
     def __getitem__(self, index):
-        return self._set[index]
+        return self._snapshot()[index]
 
     def __iter__(self):
-        return iter(self._set)
+        # iterate over a snapshot so the set may be modified while iterating
+        return iter(self._snapshot())
 
     def __len__(self):
-        return len(self._set)
+        return len(self._items)
 
     def __repr__(self):
-        return "%s(%r)" % (type(self).__name__, self._set)
+        return "%s(%r)" % (type(self).__name__, self.as_list())
+
+    def _append(self, item):
+        token = next(self._tokens)
+
+        self._items[token] = item
+        self._buckets.setdefault(self._bucket(item), []).append(token)
+        self._version += 1
+
+    def _bucket(self, item):
+        # items that are equal must share a bucket, unhashable items share
+        # a single bucket
+        try:
+            return hash(item)
+
+        except TypeError:
+            return None
+
+    def _merge(self, item):
+        token = self._find(item)
+
+        if token is None:
+            self._append(item)
 
+        elif self._items[token] is not item:
+            self._items[token] = item
+            self._version += 1
+
+    def _copy(self, other):
+        # bulk copy the contents of other (with the same bucketing) into
+        # this empty set, avoiding a lookup per item
+        self._items = collections.OrderedDict(other._items)
+        self._buckets = {b: list(tokens) for b, tokens in other._buckets.items()}
+        self._tokens = itertools.count(next(other._tokens))
+        self._digests = dict(other._digests)
+        self._version += 1
+
+    def _leaf(self, item):
+        # digest of a single item's canonical JSON form
+        return hashlib.sha256(item.to_json().encode('utf-8')).digest()
+
+    def _snapshot(self):
+        # the items as a list, rebuilt only when the set has changed since
+        # and never modified so iterators over it are unaffected by changes
+        if self._snapshot_list is None or self._snapshot_list[0] != self._version:
+            self._snapshot_list = (self._version, list(self._items.values()))
+
+        return self._snapshot_list[1]
+
+    def _find(self, item):
+        """ Returns the token of the first item equal to item, or None. """
+        for token in self._buckets.get(self._bucket(item), ()):
+            if self._items[token] == item:
+                return token
+
+        return None
+
+    #
+    # PROPERTIES
+    @property
+    def version(self):
+        """ A counter that changes whenever the set is modified. """
+        return self._version
+
+    #
+    # PUBLIC METHODS
     def add(self, item):
-        if item not in self._set:
-            self._set.append(item)
+        if self._find(item) is None:
+            self._append(item)
 
     def as_list(self):
-        return list(self._set)
+        return list(self._items.values())
 
     def discard(self, item):
-        if item not in self._set:
+        token = self._find(item)
+
+        if token is None:
             raise ValueError("item not in set")
 
-        self._set.remove(item)
+        bucket = self._bucket(self._items.pop(token))
+        tokens = self._buckets[bucket]
+        tokens.remove(token)
+
+        if not tokens:
+            del self._buckets[bucket]
+
+        self._version += 1
+
+    def digest(self):
+        """
+        Returns an order aware digest of the set's content, as a hex string.
+
+        The digest is a two level Merkle tree, hashing the digest of each
+        item in order. Item digests are cached (and carried over by union and
+        merge), so after a change only new items are rehashed. Items are
+        treated as values, changing an item in place must be followed by
+        re-adding it to the set.
+        """
+
+        if self._digest is not None and self._digest[0] == self._version:
+            return self._digest[1]
+
+        digests = {}
+        h = hashlib.sha256()
+
+        for item in self._items.values():
+            cached = self._digests.get(id(item))
+
+            # the cached entry holds the item, so its id cannot be reused
+            if cached is None or cached[0] is not item:
+                cached = (item, self._leaf(item))
+
+            digests[id(item)] = cached
+            h.update(cached[1])
+
+        self._digests = digests
+        self._digest = (self._version, h.hexdigest())
+
+        return self._digest[1]
 
     def difference(self, other):
         if not isinstance(other, CanvasSet):
@@ -61,31 +194,62 @@ class CanvasSet(collections.MutableSet):
         uniq_other = self.__class__()
 
         # find unique items to self
-        for x in self._set:
+        for x in self._items.values():
             if x not in other:
                 uniq_self.add(x)
 
         # find unique items to other
-        for x in other:
-            if x not in self._set:
+        for x in other._items.values():
+            if x not in self:
                 uniq_other.add(x)
 
         return (uniq_self, uniq_other)
 
+    def get(self, item, default=None):
+        """ Returns the item in the set equal to item, or default. """
+        token = self._find(item)
+
+        if token is None:
+            return default
+
+        return self._items[token]
+
+    def merge(self, *args):
+        """
+        Adds the items of each set, replacing equal items in place so items
+        from later sets take precedence while keeping their first position.
+        """
+
+        for o in args:
+            if not isinstance(o, CanvasSet):
+                raise TypeError('Not a CanvasSet %s %s.' % (type(o).__name__, type(self).__name__))
+
+            if not self._items and type(o)._bucket is type(self)._bucket:
+                self._copy(o)
+                continue
+
+            for x in o.as_list():
+                self._merge(x)
+
+            self._digests.update(o._digests)
+
     def union(self, *args):
         if len(args) == 0:
             raise Exception('No CanvasSets defined for union.')
 
-        u = self.__class__(self._set)
+        u = self.__class__()
+        u._copy(self)
 
         for o in args:
             if not isinstance(o, CanvasSet):
                 raise NotImplementedError
 
             # add takes care of uniqueness so let's use it
-            for x in o:
+            for x in o._items.values():
                 u.add(x)
 
+            u._digests.update(o._digests)
+
         return u
 
     def update(self, *args):
@@ -94,5 +258,5 @@ class CanvasSet(collections.MutableSet):
                 raise TypeError('Not a CanvasSet %s %s.' % (type(o).__name__, type(self).__name__))
 
             # add takes care of uniqueness so let's use it
-            for x in o:
+            for x in o.as_list():
                 self.add(x)
@@ -21,6 +21,7 @@ import hawkey
 import json
 import re
 
+from canvas.package import InstalledIndex, substitutions
 from canvas.set import CanvasSet
 
 # name[[#epoch]@version-release][:arch]
@@ -166,7 +167,7 @@ class Store(object):
         # only build with non-None values
         return {k: v for k, v in o.items() if v != None}
 
-    def to_pkg_spec(self):
+    def to_pkg_spec(self, subs=None):
         # return empty string if no name (should never happen)
         if self.name is None:
             return ''
@@ -183,9 +184,10 @@ class Store(object):
             evr = self.epoch + ':'
 
         if self.version is not None and self.release is not None:
-            db = dnf.Base()
-            conf = db.conf.substitutions
-            evr += '{0}-{1}.fc{2}'.format(self.version, self.release, conf['releasever'])
+            if subs is None:
+                subs = substitutions()
+
+            evr += '{0}-{1}.fc{2}'.format(self.version, self.release, subs['releasever'])
 
         elif self.version is not None:
             evr += self.version
@@ -200,21 +202,11 @@ class Store(object):
 
         return f
 
-    def to_pkg(self, db=None):
-        if not isinstance(db, dnf.Base):
-            db = dnf.Base()
-            try:
-                db.fill_sack()
-
-            except OSError as e:
-                pass
-
-        p_list = db.sack.query().installed().filter(name=self.name)
-
-        if not p_list:
-            return None
+    def to_pkg(self, db=None, index=None):
+        if index is None:
+            index = InstalledIndex.from_db(db)
 
-        return list(p_list)[0]
+        return index.get(self.name, self.arch)
 
 class StoreSet(CanvasSet):
     def __init__(self, initvalue=()):
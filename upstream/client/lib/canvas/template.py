@@ -17,15 +17,18 @@
 #
 
 import dnf
+import functools
 import hashlib
+import hawkey
 import json
 import logging
 import re
 import sys
 import yaml
 
+from canvas import codec
 from canvas.object import Object, ObjectSet
-from canvas.package import Package, PackageSet
+from canvas.package import InstalledIndex, Package, PackageSet
 from canvas.repository import Repository, RepoSet
 
 import pykickstart
@@ -45,6 +48,15 @@ RE_TEMPLATE = re.compile("(?:(?P<user>[\w\.\-]*):)?(?P<name>[\w\.\-]+)(?!.*:)(?:
 
 
 class Template(object):
+    """
+    A canvas template.
+
+    The objects, packages and repos properties (and their _all forms) are
+    unions memoised until the underlying sets change, and the same union is
+    returned to every caller. Treat them as read-only, changing the template
+    through the add, remove and update methods instead.
+    """
+
     def __init__(self, template=None, user=None):
         self._name = None
         self._user = user
@@ -55,22 +67,39 @@ class Template(object):
 
         self._includes = []           # includes in template
         self._includes_resolved = []  # data structs for all includes in template
+        self._flattened = []          # fingerprints of the flattened includes, see _flatten
         self._meta = {}
 
-        self._repos = RepoSet()           # repos in template
+        # repos, packages and objects of the template are built from the raw
+        # server data on first access, see _repos, _packages and _objects
+        self._raw = {}
+
         self._includes_repos = RepoSet()  # repos from includes in template
         self._delta_repos = RepoSet()     # repos to add/remove in template
 
-        self._packages = PackageSet()           # packages in template
         self._includes_packages = PackageSet()  # packages from includes in template
         self._delta_packages = PackageSet()     # packages to add/remove in template
 
         self._stores   = []           # remote stores for machine
 
-        self._objects  = ObjectSet()           # archive definitions in machine
         self._includes_objects  = ObjectSet()  # archive definitions in machine
         self._delta_objects  = ObjectSet()     # archive definitions in machine
 
+        # changes since the template was fetched, used for delta updates
+        self._removed_repos = RepoSet()
+        self._removed_packages = PackageSet()
+        self._removed_objects = ObjectSet()
+        self._cleared = False
+
+        # fetched repos, packages and objects since moved to the deltas, which
+        # must be removed from the server if they are removed again
+        self._updated_repos = RepoSet()
+        self._updated_packages = PackageSet()
+        self._updated_objects = ObjectSet()
+        self._updated = None          # server update stamp of fetched template
+
+        self._views = {}              # memoised unions, see _view
+
         self._db = None
 
         self._parse_template(template)
@@ -78,16 +107,147 @@ class Template(object):
     def __str__(self):
         return 'Template: %s (owner: %s) - R: %d, P: %d' % (self._name, self._user, len(self.repos_all), len(self.packages_all))
 
+    #
+    # LAZY PROPERTIES
+    # converting the packages, repos and objects of large templates is
+    # costly, and unnecessary when only the identity or meta data is used
+    @functools.cached_property
+    def _objects(self):
+        return self._raw_build('objects', lambda raw: ObjectSet(Object(o) for o in raw))
+
+    @functools.cached_property
+    def _packages(self):
+        unv = self._raw.get('unv')
+        return self._raw_build('packages', lambda raw: PackageSet(Package(p, template=unv) for p in raw))
+
+    @functools.cached_property
+    def _repos(self):
+        unv = self._raw.get('unv')
+        return self._raw_build('repos', lambda raw: RepoSet(Repository(r, template=unv) for r in raw))
+
+    def _raw_build(self, kind, build):
+        # the raw data is dropped once built as it is no longer needed, but
+        # kept if building fails so a later access fails the same way
+        built = build(self._raw.get(kind, []))
+        self._raw.pop(kind, None)
+
+        return built
+
+    @staticmethod
+    def _fingerprint(template):
+        # a resolved include is unchanged while its views are the same
+        # (memoised) sets at the same version
+        return [(s, s.version) for s in (template.repos_all, template.packages_all, template.objects_all)]
+
+    def _contents(self, resolved=False):
+        # packages and repos sorted, objects in insertion order as that is
+        # important
+        if resolved:
+            _packages = list(self.packages_all)
+            _repos    = list(self.repos_all)
+            _objects  = self.objects_all
+
+        else:
+            _packages = list(self.packages)
+            _repos    = list(self.repos)
+            _objects  = self.objects
+
+        _packages.sort(key=lambda x: x.name)
+        _repos.sort(key=lambda x: x.stub)
+
+        return (_packages, _repos, _objects)
+
+    @staticmethod
+    def _delta_add(delta, removed, updated, item):
+        # re-adding a removed item cancels its removal, it is sent as an
+        # update of the server's item instead
+        if item in removed:
+            removed.discard(item)
+            updated.add(item)
+
+        delta.add(item)
+
+    @staticmethod
+    def _delta_remove(delta, removed, updated, item):
+        delta.discard(item)
+
+        # an updated item still exists on the server
+        if item in updated:
+            updated.discard(item)
+            removed.add(item)
+
     def _flatten(self):
-        # iterate the includes in reverse order for packages and repos due to
-        # higher level templates prioritising lower levels
-        for t in reversed(self._includes_resolved):
-            self._includes_repos.update(t.repos_all)
-            self._includes_packages.update(t.packages_all)
+        """
+        Merges the content of the resolved includes into the includes sets.
+        As before, includes are flattened in reverse order so later includes
+        take precedence over, and come before, earlier ones.
+
+        Each merged include is remembered by fingerprint, so flattening is
+        free when no include has changed, and appended includes are flattened
+        on their own ahead of the unchanged earlier ones. Any other change
+        (eg. replacing an include) merges all includes again.
+
+        Each level still holds a copy of the content of its includes, so the
+        work for a deep include chain remains quadratic in its depth.
+        """
+
+        fingerprints = [self._fingerprint(t) for t in self._includes_resolved]
+        flattened = self._flattened
 
-        # iterate the includes in normal order for objects
-        for t in reversed(self._includes_resolved):
-            self._includes_objects.update(t.objects_all)
+        unchanged = len(flattened) <= len(fingerprints) and all(
+            len(f) == len(c) and all(s is cs and v == cv for (s, v), (cs, cv) in zip(f, c))
+            for f, c in zip(fingerprints, flattened))
+
+        if not unchanged:
+            self._includes_repos = RepoSet()
+            self._includes_packages = PackageSet()
+            self._includes_objects = ObjectSet()
+            flattened = []
+
+        appended = list(reversed(fingerprints[len(flattened):]))
+
+        if appended:
+            self._includes_repos = self._flatten_sets(RepoSet,
+                [r[0] for r, p, o in appended] + [self._includes_repos])
+            self._includes_packages = self._flatten_sets(PackageSet,
+                [p[0] for r, p, o in appended] + [self._includes_packages])
+            self._includes_objects = self._flatten_sets(ObjectSet,
+                [o[0] for r, p, o in appended] + [self._includes_objects])
+
+        self._flattened = fingerprints
+
+    @staticmethod
+    def _flatten_sets(cls, sets):
+        # the first set is bulk copied, the others only add the items not
+        # already present (or a more explicit arch for packages)
+        flattened = cls()
+        flattened.merge(sets[0])
+        flattened.update(*sets[1:])
+
+        return flattened
+
+    def _view(self, name, *sets):
+        """
+        Returns the union of sets, memoised until any of the sets (or the
+        returned union itself) are replaced or modified.
+
+        The union is shared by every caller until then, so it is read-only;
+        modifying it changes what other holders of the view see.
+        """
+
+        cached = self._views.get(name)
+
+        if cached is not None:
+            (sources, view, version) = cached
+
+            if (view.version == version and len(sources) == len(sets) and
+                    all(s is c and s.version == v for (c, v), s in zip(sources, sets))):
+                return view
+
+        view = sets[0].union(*sets[1:])
+        self._views[name] = ([(s, s.version) for s in sets], view, view.version)
+
+        return view
 
     def _parse_kickstart(self, path):
         """
@@ -157,12 +317,8 @@ class Template(object):
 
                 # store repo commands as canvas templates
                 elif c.currentCmd == 'repo':
-                    for r in c.__str__().split('\n'):
-                        # ignore blank lines
-                        if len(r.strip()) == 0:
-                            continue
-
-                        self.add_repo(Repository(r))
+                    # ignore blank lines
+                    self.add_repos(Repository(r) for r in c.__str__().split('\n') if len(r.strip()))
 
                 # otherwise store commands as canvas objects
                 else:
@@ -190,25 +346,25 @@ class Template(object):
             if packages.environment:
                 meta['package']['environment'] = "@^{0}".format(packages.environment)
 
-            grps = packages.groupList
-            grps.sort()
-            for g in grps:
-                self.add_package(Package({'n': g.__str__(), 'z': 1}, template=self.unv))
+            unv = self.unv
+
+            (included, errors) = PackageSet.parse((p.__str__() for p in sorted(packages.packageList)), template=unv)
+            (excluded, errors_excluded) = PackageSet.parse(('~' + p.__str__() for p in sorted(packages.excludedList)), template=unv)
 
-            pkgs = packages.packageList
-            pkgs.sort()
-            for p in pkgs:
-                self.add_package(Package({'n': p.__str__(), 'z': 1}, template=self.unv))
+            # keep names kickstart accepts but package strings do not verbatim
+            for (lineno, line, reason) in errors:
+                included.add(Package({'n': line, 'z': 1}, template=unv))
 
-            grps = packages.excludedGroupList
-            grps.sort()
-            for g in grps:
-                self.add_package(Package({'n': g.__str__(), 'z': 0}, template=self.unv))
+            for (lineno, line, reason) in errors_excluded:
+                excluded.add(Package({'n': line[1:], 'z': 0}, template=unv))
 
-            pkgs = packages.excludedList
-            pkgs.sort()
-            for p in pkgs:
-                self.add_package(Package({'n': p.__str__(), 'z': 0}, template=self.unv))
+            # included groups and packages followed by excluded
+            self.add_packages(
+                [Package({'n': g.__str__(), 'z': 1}, template=unv) for g in sorted(packages.groupList)] +
+                included.as_list() +
+                [Package({'n': g.__str__(), 'z': 0}, template=unv) for g in sorted(packages.excludedGroupList)] +
+                excluded.as_list()
+            )
 
         self._meta['kickstart'] = meta
 
@@ -244,13 +400,22 @@ class Template(object):
 
             self._includes = template.get('includes', [])
 
-            self._repos    = RepoSet(Repository(r, template=self.unv) for r in template.get('repos', []))
-            self._packages = PackageSet(Package(p, template=self.unv) for p in template.get('packages', []))
+            # keep the raw repos, packages and objects to be built on first
+            # access, discarding any already built
+            self._raw = {
+                'unv':      self.unv,
+                'repos':    template.get('repos', []),
+                'packages': template.get('packages', []),
+                'objects':  template.get('objects', [])
+            }
+
+            for kind in ('_repos', '_packages', '_objects'):
+                self.__dict__.pop(kind, None)
 
             self._stores   = template.get('stores', [])
-            self._objects  = ObjectSet(Object(o) for o in template.get('objects', []))
 
             self._meta = template.get('meta', {})
+            self._updated = template.get('updated', None)
 
     def _parse_unv(self, value):
         if isinstance(value, str):
@@ -336,12 +501,12 @@ class Template(object):
 
     @property
     def objects(self):
-        return self._objects.union(self._delta_objects)
+        return self._view('objects', self._objects, self._delta_objects)
 
     @property
     def objects_all(self):
         # order is important
-        return self._includes_objects.union(self._objects, self._delta_objects)
+        return self._view('objects_all', self._includes_objects, self._objects, self._delta_objects)
 
     @property
     def objects_delta(self):
@@ -349,11 +514,11 @@ class Template(object):
 
     @property
     def packages(self):
-        return self._packages.union(self._delta_packages)
+        return self._view('packages', self._packages, self._delta_packages)
 
     @property
     def packages_all(self):
-        return self._packages.union(self._delta_packages, self._includes_packages)
+        return self._view('packages_all', self._packages, self._delta_packages, self._includes_packages)
 
     @property
     def packages_delta(self):
@@ -373,11 +538,11 @@ class Template(object):
 
     @property
     def repos(self):
-        return self._repos.union(self._delta_repos)
+        return self._view('repos', self._repos, self._delta_repos)
 
     @property
     def repos_all(self):
-        return self._repos.union(self._delta_repos, self._includes_repos)
+        return self._view('repos_all', self._repos, self._delta_repos, self._includes_repos)
 
     @property
     def repos_delta(self):
@@ -400,6 +565,10 @@ class Template(object):
 
         return None
 
+    @property
+    def updated(self):
+        return self._updated
+
     @property
     def user(self):
         return self._user
@@ -421,23 +590,124 @@ class Template(object):
 
     #
     # PUBLIC METHODS
+    def add_include(self, template):
+        """
+        Adds a resolved include to the template, replacing any resolved
+        include of the same unv, and flattens it into the template.
+
+        Args:
+          template: the resolved Template to include.
+
+        Returns:
+          Nothing.
+
+        Raises:
+          TypeError: template is not a Template object.
+        """
+
+        if not isinstance(template, Template):
+            raise TypeError('Not a Template object')
+
+        for i, t in enumerate(self._includes_resolved):
+            if t.unv == template.unv:
+                self._includes_resolved[i] = template
+                break
+
+        else:
+            self._includes_resolved.append(template)
+
+            if template.unv not in self._includes:
+                self._includes.append(template.unv)
+
+        self._flatten()
+
     def add_object(self, object):
         if not isinstance(object, Object):
             raise TypeError('Not an Object object')
 
         if object not in self.objects:
-            self._delta_objects.add(object)
+            self._delta_add(self._delta_objects, self._removed_objects, self._updated_objects, object)
 
     def add_package(self, package):
         if package not in self.packages:
-            self._delta_packages.add(package)
+            self._delta_add(self._delta_packages, self._removed_packages, self._updated_packages, package)
+
+    def add_packages(self, packages):
+        """
+        Adds many packages to the template in a single pass.
+
+        Duplicates within packages are merged first, with a more explicit
+        arch taking precedence as per PackageSet. A package that is pending
+        addition without an arch is replaced by the same package with an
+        arch.
+
+        Args:
+          packages: iterable of Package objects.
+
+        Returns:
+          Dict of lists of the packages `added`, already `present` and those
+          that `replaced` a pending arch-less package.
+        """
+
+        packages = PackageSet(packages)
+
+        for p in packages:
+            if not isinstance(p, Package):
+                raise TypeError('Not a Package object')
+
+        summary = {'added': [], 'present': [], 'replaced': []}
+        current = self.packages
+
+        for p in packages:
+            if p not in current:
+                self._delta_add(self._delta_packages, self._removed_packages, self._updated_packages, p)
+                summary['added'].append(p)
+                continue
+
+            pending = self._delta_packages.get(p)
+
+            if p.arch is not None and pending is not None and pending.arch is None:
+                self._delta_packages.add(p)
+                summary['replaced'].append(p)
+
+            else:
+                summary['present'].append(p)
+
+        return summary
 
     def add_repo(self, repo):
         if not isinstance(repo, Repository):
             raise TypeError('Not a Repository object')
 
         if repo not in self.repos:
-            self._delta_repos.add(repo)
+            self._delta_add(self._delta_repos, self._removed_repos, self._updated_repos, repo)
+
+    def add_repos(self, repos):
+        """
+        Adds many repos to the template in a single pass.
+
+        Args:
+          repos: iterable of Repository objects.
+
+        Returns:
+          Dict of lists of the repos `added` and those already `present`.
+        """
+
+        summary = {'added': [], 'present': []}
+        current = self.repos
+
+        for r in RepoSet(repos):
+            if not isinstance(r, Repository):
+                raise TypeError('Not a Repository object')
+
+            if r in current:
+                summary['present'].append(r)
+
+            else:
+                self._delta_add(self._delta_repos, self._removed_repos, self._updated_repos, r)
+                summary['added'].append(r)
+
+        return summary
 
     def clear(self):
         """
@@ -453,6 +723,8 @@ class Template(object):
 
         self._includes = []           # includes in template
         self._includes_resolved = []  # data structs for all includes in template
+        self._flattened = []          # fingerprints of the flattened includes, see _flatten
+        self._raw = {}
         self._repos = RepoSet()           # repos in template
         self._includes_repos = RepoSet()  # repos from includes in template
         self._delta_repos = RepoSet()     # repos to add/remove in template
@@ -467,10 +739,47 @@ class Template(object):
         self._includes_objects  = ObjectSet()  # archive definitions in machine
         self._delta_objects  = ObjectSet()     # archive definitions in machine
 
+        # a cleared template can only be represented in full
+        self._cleared = True
+
         if 'kickstart' in self._meta:
             del self._meta['kickstart']
 
 
+    def digest(self, resolved=False):
+        """
+        Returns an order aware digest of the template content, as a hex
+        string, suitable for detecting changes to the template.
+
+        The digest is the root of a Merkle tree over the digests of the
+        packages, repos and objects (see CanvasSet.digest), the includes and
+        the meta data. Only changed components, and within them only changed
+        items, are rehashed.
+
+        Args:
+          resolved: digest the content of resolved includes as well.
+
+        Returns:
+          Hex digest string.
+        """
+
+        if resolved:
+            sets = (self.packages_all, self.repos_all, self.objects_all)
+
+        else:
+            sets = (self.packages, self.repos, self.objects)
+
+        h = hashlib.sha256()
+
+        for s in sets:
+            h.update(s.digest().encode('utf-8'))
+
+        for o in (self._includes, self._meta):
+            data = json.dumps(o, separators=(',', ':'), sort_keys=True, default=str)
+            h.update(hashlib.sha256(data.encode('utf-8')).hexdigest().encode('utf-8'))
+
+        return h.hexdigest()
+
     def find_package(self, name):
         return [p for p in self.packages if p.name == name]
 
@@ -496,11 +805,9 @@ class Template(object):
         else:
             p_list = db.iter_userinstalled()
 
-        for p in p_list:
-            system_template.add_package(Package(p, evr=False))
+        system_template.add_packages(Package(p, evr=False) for p in p_list)
+        system_template.add_repos(Repository(r) for r in db.repos.enabled())
 
-        for r in db.repos.enabled():
-            system_template.add_repo(Repository(r))
         return system_template
 
     def package_diff(self, packages):
@@ -535,11 +842,12 @@ class Template(object):
             raise TypeError('Not an Object object')
 
         if object in self._delta_objects:
-            self._objects.discard(object)
+            self._delta_remove(self._delta_objects, self._removed_objects, self._updated_objects, object)
             return True
 
         elif object in self._objects:
             self._objects.discard(object)
+            self._removed_objects.add(object)
             return True
 
         return False
@@ -549,25 +857,46 @@ class Template(object):
             raise TypeError('Not a Package object')
 
         if package in self._delta_packages:
-            self._packages.discard(package)
+            self._delta_remove(self._delta_packages, self._removed_packages, self._updated_packages, package)
             return True
 
         elif package in self._packages:
             self._packages.discard(package)
+            self._removed_packages.add(package)
             return True
 
         return False
 
+    def remove_packages(self, packages):
+        """
+        Removes many packages from the template.
+
+        Args:
+          packages: iterable of Package objects.
+
+        Returns:
+          Dict of lists of the packages `removed` and those `missing` from
+          the template.
+        """
+
+        summary = {'removed': [], 'missing': []}
+
+        for p in packages:
+            summary['removed' if self.remove_package(p) else 'missing'].append(p)
+
+        return summary
+
     def remove_repo(self, repo):
         if not isinstance(repo, Repository):
             raise TypeError('Not a Repository object')
 
         if repo in self._delta_repos:
-            self._delta_repos.remove(repo)
+            self._delta_remove(self._delta_repos, self._removed_repos, self._updated_repos, repo)
             return True
 
         elif repo in self._repos:
-            self._repos.remove(repo)
+            self._repos.discard(repo)
+            self._removed_repos.add(repo)
             return True
 
         return False
@@ -600,9 +929,14 @@ class Template(object):
         if len(self.packages_all):
             logging.info('Syncing history ...')
 
+            # the transaction has changed what is installed, so load the
+            # sack once and look every package up in the same index
+            InstalledIndex.invalidate()
+            index = InstalledIndex.from_db()
+
             for p in self.packages_all:
                 if p.included:
-                    pkg = p.to_pkg();
+                    pkg = p.to_pkg(index=index)
                     if pkg is not None:
                         db.yumdb.get_package(pkg).reason = 'user'
 
@@ -665,20 +999,24 @@ class Template(object):
         except OSError as e:
             pass
 
-        q_installed = db.sack.query().installed()
-
         # check we have packages to assess
         if len(self.packages_all) == 0:
             return
 
         multilib_policy = db.conf.multilib_policy
         clean_deps = db.conf.clean_requirements_on_remove
+        subs = db.conf.substitutions
 
         logging.info('Preparing package transaction ...')
-        # process all packages in template
+        index = InstalledIndex.from_db(db)
+        install = []
+        remove = []
+        removed = set()
+
+        # partition all packages in template against what is installed
         for p in self.packages_all:
             # handle package groups
-            if p.is_group:
+            if p.is_group():
                 if p.included:
                     try:
                         db.group_install(p.name, 'default')
@@ -694,33 +1032,66 @@ class Template(object):
                         logging.debug('Package not installed: {0}'.format(str(p)))
 
             # handle packages
-            else:
-                p_spec = p.to_pkg_spec()
+            elif p.included:
+                if not index.match(p, subs):
+                    install.append(p.to_pkg_spec(subs))
 
-                # TODO: improve matching on all p_spec params (not just name)
-                p_installed = list(q_installed.filter(name__glob=p_spec))
+            elif p.excluded:
+                p_installed = index.match(p, subs)
 
-                if p.included and len(p_installed) == 0:
-                    try:
-                        db.install(p_spec)
+                if not p_installed:
+                    logging.debug('Package not installed: {0}'.format(str(p)))
 
-                    except:
-                        logging.error('Package does not exist {0}'.format(str(p)))
+                for pi in p_installed:
+                    if pi not in removed:
+                        removed.add(pi)
+                        remove.append(pi)
 
-                elif p.excluded and len(p_installed) > 0:
-                    try:
-                        for pi in p_installed:
-                            db.remove(pi)
-
-                    except:
-                        logging.debug('Package not installed: {0}'.format(str(p)))
-
-                else:
-                    pass
+        self._system_install(db, install)
+        self._system_remove(db, remove, clean_deps)
 
         logging.info('Resolving package actions ...')
         db.resolve(allow_erasing=True)
 
+    def _system_remove(self, db, packages, clean_deps=False):
+        if not packages:
+            return
+
+        # mark all the installed packages for removal in a single selector,
+        # dnf's package_remove erases them from the goal one at a time
+        goal = getattr(db, '_goal', None)
+
+        if goal is not None:
+            selector = hawkey.Selector(db.sack)
+            selector.set(pkg=packages)
+            goal.erase(select=selector, clean_deps=clean_deps)
+            return
+
+        for pi in packages:
+            db.package_remove(pi)
+
+    def _system_install(self, db, specs):
+        if not specs:
+            return
+
+        # newer dnf can mark all specs in a single pass
+        if hasattr(db, 'install_specs'):
+            try:
+                db.install_specs(specs)
+
+            except dnf.exceptions.MarkingErrors as e:
+                for spec in getattr(e, 'no_match_pkg_specs', ()):
+                    logging.error('Package does not exist {0}'.format(spec))
+
+            return
+
+        for spec in specs:
+            try:
+                db.install(spec)
+
+            except:
+                logging.error('Package does not exist {0}'.format(spec))
+
     def system_transaction(self):
         """
         System transaction that specifies all package installations and removals.
@@ -740,18 +1111,97 @@ class Template(object):
 
         return None
 
+    def to_delta(self):
+        """
+        Represent the changes made to the template since it was fetched.
+
+        Additions and updates are listed under `add` (replacing any existing
+        entry with the same identity) and removals under `remove` for each of
+        packages, repos and objects. Scalar template fields are always sent
+        as they are small. The server reported update stamp of the fetched
+        template is included as `updated` so the server can reject deltas
+        against a template that has since changed.
+
+        Args:
+          None
+
+        Returns:
+          Delta dict, or None if the template can only be represented in full
+          (ie. it was never fetched or has been cleared).
+        """
+
+        if self._uuid is None or self._cleared:
+            return None
+
+        return {
+            'uuid':        self._uuid,
+            'updated':     self._updated,
+            'name':        self._name,
+            'user':        self._user,
+            'version':     self._version,
+            'title':       self._title,
+            'description': self._description,
+            'includes':    self._includes,
+            'stores':      self._stores,
+            'meta':        self._meta,
+            'packages': {
+                'add':    [p.to_object() for p in self._delta_packages],
+                'remove': [p.to_object() for p in self._removed_packages]
+            },
+            'repos': {
+                'add':    [r.to_object() for r in self._delta_repos],
+                'remove': [r.to_object() for r in self._removed_repos]
+            },
+            'objects': {
+                'add':    [o.to_object() for o in self._delta_objects],
+                'remove': [o.to_object() for o in self._removed_objects]
+            }
+        }
+
     def to_json(self, resolved=False):
-        return json.dumps(self.to_object(resolved=resolved), separators=(',', ':'))
+        """
+        Represent the template as JSON, as per to_object. The JSON is joined
+        from the encodings of each package, repo and object rather than
+        encoding the whole object at once.
 
-    def to_kickstart(self, resolved=False):
+        Args:
+          resolved: include the content of resolved includes.
+
+        Returns:
+          JSON string.
         """
-        Represent the template as a kickstart file.
+
+        (_packages, _repos, _objects) = self._contents(resolved=resolved)
+
+        head = codec.dumps({
+            'uuid':        self._uuid,
+            'name':        self._name,
+            'user':        self._user,
+            'version':     self._version,
+            'title':       self._title,
+            'description': self._description,
+            'includes':    self._includes,
+            'stores':      self._stores,
+            'meta':        self._meta
+        })
+
+        return '{0},"packages":[{1}],"repos":[{2}],"objects":[{3}]}}'.format(
+            head[:-1],
+            ','.join(p.to_json() for p in _packages),
+            ','.join(r.to_json() for r in _repos),
+            ','.join(o.to_json() for o in _objects)
+        )
+
+    def iter_kickstart(self, resolved=False):
+        """
+        Represent the template as a kickstart file, yielded in chunks so it
+        can be streamed without building the whole file in memory.
 
         Args:
-          None
+          resolved: include the content of resolved includes.
 
         Returns:
-          Kickstart formatted file.
+          Generator of kickstart formatted strings.
         """
 
         if resolved:
@@ -764,24 +1214,22 @@ class Template(object):
             _repos    = self.repos
             _objects  = self.objects
 
-        template = ('# Canvas generated template - {1}\n'
-                    '# UUID: {0}\n'
-                    '# Author: {2}\n'
-                    '# Title: {3}\n'
-                    '# Description:\n'
-                    "# {4}\n\n").format(
-                        self._uuid, self._name, self._user, self._title, self._description
-                    )
+        yield ('# Canvas generated template - {1}\n'
+               '# UUID: {0}\n'
+               '# Author: {2}\n'
+               '# Title: {3}\n'
+               '# Description:\n'
+               "# {4}\n\n").format(
+                   self._uuid, self._name, self._user, self._title, self._description
+               )
 
         # populate repos (technically commands)
         # since repos commands have writePriority 0 we'll put them up top
         if len(_repos):
             for r in _repos:
-                template += r.to_kickstart() + "\n"
-
-            template += "\n"
-
+                yield r.to_kickstart() + "\n"
 
+            yield "\n"
 
         # first kickstart command seen has highest priority
         ks_commands = {}
@@ -802,12 +1250,14 @@ class Template(object):
         # sort on priority order then add to template
         for oo in sorted(ks_commands.values(), key=lambda x: x[0].get_ks_command_priority()):
             for o in oo:
-                template += o.to_kickstart() + "\n"
+                yield from o.iter_kickstart()
+                yield "\n"
 
         # populate objects (ie ks-specific scripts)
         for o in _objects:
             if o.is_ks_script():
-                template += o.to_kickstart() + "\n"
+                yield from o.iter_kickstart()
+                yield "\n"
 
         # process packages
         if len(_packages) > 0:
@@ -834,36 +1284,118 @@ class Template(object):
                 #if 'handle_missing' in mp:
                 #    package_header += ' --handlemissing'
 
+            yield package_header + "\n\n"
 
-            template += package_header + "\n\n"
+            # included packages sorted followed by the sorted remainder, in
+            # a single sort
+            excluded = False
+            first = True
 
-            packages_included = sorted([p.to_kickstart() for p in _packages if p.included])
-            packages_excluded = sorted([p.to_kickstart() for p in _packages if not p.included])
+            for (not_included, line) in sorted((not p.included, p.to_kickstart()) for p in _packages):
+                if not_included and not excluded:
+                    yield "\n"
+                    excluded = True
+                    first = True
 
-            template += "\n".join(packages_included)
-            template += "\n"
-            template += "\n".join(packages_excluded)
+                yield line if first else "\n" + line
+                first = False
 
-            template += "\n%end\n"
+            if not excluded:
+                yield "\n"
 
-        return template
+            yield "\n%end\n"
 
-    def to_object(self, resolved=False):
-        if resolved:
-            _packages = list(self.packages_all)
-            _repos    = list(self.repos_all)
-            _objects  = self.objects_all
+    def to_kickstart(self, resolved=False):
+        """
+        Represent the template as a kickstart file.
 
-        else:
-            _packages = list(self.packages)
-            _repos    = list(self.repos)
-            _objects  = self.objects
+        Args:
+          resolved: include the content of resolved includes.
 
-        # sort packages and repos
-        _packages.sort(key=lambda x: x.name)
-        _repos.sort(key=lambda x: x.stub)
+        Returns:
+          Kickstart formatted file.
+        """
+
+        return ''.join(self.iter_kickstart(resolved=resolved))
+
+    def versions(self):
+        """
+        Returns the versions of the template and all resolved includes, keyed
+        by uuid (or unv if never fetched).
+
+        A template's version is its server update stamp, or the digest of its
+        own content if the server reported none.
+        """
+
+        versions = {}
+
+        def _versions(t):
+            key = t.uuid or t.unv
+
+            if key in versions:
+                return
+
+            versions[key] = t.updated if t.updated is not None else t.digest()
+
+            for i in t._includes_resolved:
+                _versions(i)
 
-        # we don't sort objects as insertion order is important
+        _versions(self)
+
+        return versions
+
+    def write_kickstart(self, stream, resolved=False):
+        """
+        Write the template as a kickstart file to a file-like object.
+
+        Args:
+          stream: file-like object to write to.
+          resolved: include the content of resolved includes.
+
+        Returns:
+          Nothing.
+        """
+
+        for chunk in self.iter_kickstart(resolved=resolved):
+            stream.write(chunk)
+
+    def to_compiled(self):
+        """
+        Represent the fully resolved template in the dict form returned by
+        the canvas server, such that Template(data) has the same resolved
+        content without fetching or flattening any includes.
+
+        Packages and repos retain the template they originate from and their
+        resolved order (so the digests match), and the versions of the
+        template and its includes are recorded (see versions).
+
+        Returns:
+          Dict of the resolved template.
+        """
+
+        _packages = self.packages_all
+        _repos    = self.repos_all
+        _objects  = self.objects_all
+
+        return {
+            'uuid':        self._uuid,
+            'updated':     self._updated,
+            'stub':        self._name,
+            'username':    self._user,
+            'version':     self._version,
+            'name':        self._title,
+            'description': self._description,
+            'includes':    self._includes,
+            'packages':    [dict(p.to_object(), t=p.template) for p in _packages],
+            'repos':       [dict(r.to_object(), t=r.template) for r in _repos],
+            'stores':      self._stores,
+            'objects':     [o.to_object() for o in _objects],
+            'meta':        self._meta,
+            'versions':    self.versions()
+        }
+
+    def to_object(self, resolved=False):
+        (_packages, _repos, _objects) = self._contents(resolved=resolved)
 
         return {
             'uuid':        self._uuid,
@@ -888,11 +1420,16 @@ class Template(object):
             raise TypeError('Not a Package object')
 
         if package in self._delta_packages:
-            self._delta_packages.update(package)
+            self._delta_packages.discard(package)
+            self._delta_packages.add(package)
             return True
 
+        # updated packages are tracked as deltas so they can be uploaded
+        # without the rest of the template
         elif package in self._packages:
-            self._packages.update(package)
+            self._packages.discard(package)
+            self._delta_packages.add(package)
+            self._updated_packages.add(package)
             return True
 
         return False
@@ -902,13 +1439,14 @@ class Template(object):
             raise TypeError('Not a Repository object')
 
         if repo in self._delta_repos:
-            self._delta_repos.remove(repo)
+            self._delta_repos.discard(repo)
             self._delta_repos.add(repo)
             return True
 
         elif repo in self._repos:
-            self._repos.remove(repo)
-            self._repos.add(repo)
+            self._repos.discard(repo)
+            self._delta_repos.add(repo)
+            self._updated_repos.add(repo)
             return True
 
         return False
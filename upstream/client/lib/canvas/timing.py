@@ -0,0 +1,308 @@
+#
+# Copyright (C) 2013-2016   Ian Firns   <firnsy@kororaproject.org>
+#                           Chris Smart <csmart@kororaproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import atexit
+import bisect
+import collections
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from canvas.texttable import TextTable
+
+# histogram bucket upper bounds in milliseconds
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+RE_ENDPOINT_UUID = re.compile(r'^(/api/(?:template|machine))/[^/.]+')
+
+_default = None
+_default_lock = threading.Lock()
+
+
+class Histogram(object):
+    """ A fixed bucket histogram of durations in milliseconds. """
+
+    def __init__(self):
+        self._buckets = [0] * (len(BUCKETS) + 1)
+        self._count = 0
+        self._total = 0.0
+        self._min = None
+        self._max = None
+
+    #
+    # PROPERTIES
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def total(self):
+        return self._total
+
+    #
+    # PUBLIC METHODS
+    def add(self, value):
+        self._buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self._count += 1
+        self._total += value
+
+        if self._min is None or value < self._min:
+            self._min = value
+
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def percentile(self, p):
+        """ Returns the bucket upper bound containing the p'th percentile. """
+        if not self._count:
+            return None
+
+        rank = p / 100.0 * self._count
+        seen = 0
+
+        for i, c in enumerate(self._buckets):
+            seen += c
+
+            if c and seen >= rank:
+                return round(min(BUCKETS[i] if i < len(BUCKETS) else self._max, self._max), 3)
+
+        return round(self._max, 3)
+
+    def to_object(self):
+        return {
+            'count':   self._count,
+            'total':   round(self._total, 3),
+            'min':     None if self._min is None else round(self._min, 3),
+            'max':     None if self._max is None else round(self._max, 3),
+            'p50':     self.percentile(50),
+            'p95':     self.percentile(95),
+            'buckets': {('<={0}'.format(b) if i < len(BUCKETS) else '>{0}'.format(BUCKETS[-1])): c
+                        for i, (b, c) in enumerate(zip(BUCKETS + [None], self._buckets)) if c}
+        }
+
+
+class Timings(object):
+    """
+    Collects per endpoint request timings and payload sizes, along with the
+    wall time of higher level phases (eg. authentication or include
+    resolution) so slow operations can be broken down.
+
+    Each request is also passed to hook, if provided, as a dict containing
+    the endpoint, method, status, bytes in/out and the connect, time to
+    first byte and total times in milliseconds.
+    """
+
+    def __init__(self, hook=None):
+        self._hook = hook
+        self._lock = threading.Lock()
+        self._endpoints = collections.OrderedDict()
+        self._phases = collections.OrderedDict()
+
+    @staticmethod
+    def _endpoint(url):
+        # group requests for different templates and machines together
+        path = urllib.parse.urlsplit(url).path
+        return RE_ENDPOINT_UUID.sub(r'\1/:uuid', path)
+
+    #
+    # PROPERTIES
+    @property
+    def hook(self):
+        return self._hook
+
+    @hook.setter
+    def hook(self, value):
+        self._hook = value
+
+    #
+    # PUBLIC METHODS
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._phases.clear()
+
+    def phase(self, name, duration):
+        """ Record duration seconds spent in the named phase. """
+        with self._lock:
+            self._phases.setdefault(name, Histogram()).add(duration * 1000)
+
+    def request(self, method, url, status, sent, received, connect, ttfb, total):
+        """
+        Record a single HTTP request.
+
+        Args:
+          method: HTTP method.
+          url: requested url, uuids are collapsed to form the endpoint.
+          status: HTTP status, or None if no response was received.
+          sent: request body bytes sent.
+          received: response body bytes received (as transferred).
+          connect: seconds spent resolving and connecting, 0 if reused.
+          ttfb: seconds until the response headers were received.
+          total: seconds until the response body was read.
+        """
+
+        record = {
+            'endpoint': self._endpoint(url),
+            'method':   method,
+            'status':   status,
+            'sent':     sent,
+            'received': received,
+            'connect':  connect * 1000,
+            'ttfb':     ttfb * 1000,
+            'total':    total * 1000
+        }
+
+        key = '{0} {1}'.format(method, record['endpoint'])
+
+        with self._lock:
+            e = self._endpoints.get(key)
+
+            if e is None:
+                e = self._endpoints[key] = {
+                    'count':    0,
+                    'errors':   0,
+                    'sent':     0,
+                    'received': 0,
+                    'connects': 0,
+                    'connect':  Histogram(),
+                    'ttfb':     Histogram(),
+                    'total':    Histogram()
+                }
+
+            e['count'] += 1
+            e['sent'] += sent
+            e['received'] += received
+
+            if status is None or status >= 400:
+                e['errors'] += 1
+
+            if connect:
+                e['connects'] += 1
+                e['connect'].add(record['connect'])
+
+            e['ttfb'].add(record['ttfb'])
+            e['total'].add(record['total'])
+
+        if self._hook is not None:
+            try:
+                self._hook(record)
+
+            except Exception as ex:
+                logging.debug('Timing hook failed: {0}'.format(ex))
+
+    def span(self, name):
+        """ Context manager recording the wall time of the enclosed block. """
+        return _Span(self, name)
+
+    def summary(self):
+        """ Returns the collected timings as a printable table. """
+        with self._lock:
+            l = TextTable(header=['ENDPOINT', 'CALLS', 'ERR', 'SENT', 'RECV', 'CONNECT', 'TTFB', 'P95', 'TOTAL (ms)'])
+
+            for k, e in self._endpoints.items():
+                l.add_row([k, e['count'], e['errors'], e['sent'], e['received'],
+                    float(e['connect'].total), float(e['ttfb'].total),
+                    float(e['total'].percentile(95) or 0), float(e['total'].total)])
+
+            for k, p in self._phases.items():
+                l.add_row(['[{0}]'.format(k), p.count, '-', '-', '-', '-', '-',
+                    float(p.percentile(95) or 0), float(p.total)])
+
+        return str(l)
+
+    def to_json(self):
+        return json.dumps(self.to_object(), separators=(',', ':'))
+
+    def to_object(self):
+        with self._lock:
+            return {
+                'endpoints': {k: {n: (v.to_object() if isinstance(v, Histogram) else v) for n, v in e.items()}
+                              for k, e in self._endpoints.items()},
+                'phases': {k: p.to_object() for k, p in self._phases.items()}
+            }
+
+
+class _Span(object):
+    def __init__(self, timings, name):
+        self._timings = timings
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._timings is not None:
+            self._timings.phase(self._name, time.monotonic() - self._start)
+
+        return False
+
+
+def default():
+    """
+    Returns the process wide Timings, or None if timings are not enabled.
+
+    Timings are enabled via enable() or by setting CANVAS_TIMINGS to `1`
+    (summary table) or `json`.
+    """
+
+    if _default is None:
+        output = os.environ.get('CANVAS_TIMINGS', '0').lower()
+
+        if output in ('1', 'true', 'table', 'json'):
+            enable(output='json' if output == 'json' else 'table')
+
+    return _default
+
+
+def enable(output='table', hook=None, stream=None):
+    """
+    Enables the process wide Timings, dumping them to stream (stderr by
+    default) at exit as either a summary table or JSON.
+
+    Returns:
+      Timings
+    """
+
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            _default = Timings(hook=hook)
+
+            def _dump():
+                s = stream or sys.stderr
+                print(_default.to_json() if output == 'json' else _default.summary(), file=s)
+
+            atexit.register(_dump)
+
+        elif hook is not None:
+            _default.hook = hook
+
+    return _default
+
+
+def span(timings, name):
+    """ As Timings.span, but a no-op when timings is None. """
+    return _Span(timings, name)
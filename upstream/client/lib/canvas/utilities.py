@@ -1,6 +1,7 @@
 import os
 import shutil
 import subprocess
+import sys
 import tarfile
 import zipfile
 
@@ -9,6 +10,13 @@ def copy_file(path, to_directory='.'):
 
     shutil.copyfile(path, dst_path)
 
+def intern_str(value):
+    """ Returns the interned copy of value if it is a string, otherwise value. """
+    if isinstance(value, str):
+        return sys.intern(value)
+
+    return value
+
 def execute_command(command):
     ret = subprocess.run(command, shell=True)
 
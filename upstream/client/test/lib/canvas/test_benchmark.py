@@ -0,0 +1,38 @@
+
+#
+# TESTS
+#
+
+from unittest import TestCase
+
+from canvas.benchmark import memory, parse, serialize
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_benchmark_memory(self):
+        results = {r['kind']: r for r in memory(templates=2, packages=10, repos=2, objects=1)}
+
+        self.assertEqual(['object', 'package', 'repository', 'template', 'template (lazy)'], sorted(results.keys()))
+        self.assertEqual(20, results['package']['count'])
+        self.assertEqual(26, results['template']['count'])
+        self.assertEqual(26, results['template (lazy)']['count'])
+        self.assertTrue(results['package']['bytes'] > 0)
+
+    def test_benchmark_parse(self):
+        results = parse(count=50)
+
+        self.assertEqual(['Package', 'PackageSet.parse'], [r['method'] for r in results])
+        self.assertEqual(results[0]['count'], results[1]['count'])
+
+    def test_benchmark_serialize(self):
+        results = serialize(packages=20, repeat=1)
+
+        self.assertEqual(['to_object', 'to_json', 'loads'], [r['method'] for r in results[:3]])
+        self.assertTrue(all(r['backend'] in ('json', 'orjson') for r in results))
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(BenchmarkTestCase)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,107 @@
+
+#
+# TESTS
+#
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from canvas.cache import LookupIndex, TemplateCache
+
+
+class TemplateCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cache_miss(self):
+        c = TemplateCache(path=self.path)
+
+        self.assertEqual(None, c.lookup('foo:bar'))
+        self.assertEqual(None, c.entry('1234'))
+        self.assertEqual(None, c.get(unv='foo:bar'))
+
+    def test_cache_put_get(self):
+        c = TemplateCache(path=self.path)
+        data = {'uuid': '1234', 'stub': 'bar', 'user': 'foo'}
+
+        c.put('foo:bar', data, etag='"abc"', updated=10)
+
+        self.assertEqual('1234', c.lookup('foo:bar'))
+        self.assertEqual(data, c.get(unv='foo:bar'))
+        self.assertEqual(data, c.get(uuid='1234'))
+        self.assertEqual('"abc"', c.entry('1234')['etag'])
+        self.assertEqual(10, c.entry('1234')['updated'])
+
+    def test_cache_ttl(self):
+        data = {'uuid': '1234'}
+
+        c1 = TemplateCache(path=self.path)
+        c1.put('foo:bar', data)
+
+        # zero ttl is never fresh
+        self.assertEqual(None, c1.get(unv='foo:bar', fresh=True))
+        self.assertEqual(data, c1.get(unv='foo:bar'))
+
+        c2 = TemplateCache(path=self.path, ttl='60')
+        self.assertEqual(data, c2.get(unv='foo:bar', fresh=True))
+
+    def test_cache_invalidate(self):
+        c = TemplateCache(path=self.path)
+
+        c.put('foo:bar', {'uuid': '1234'})
+        c.put('foo:bar@1', {'uuid': '1234'})
+        c.put('foo:baz', {'uuid': '5678'})
+
+        c.invalidate(uuid='1234')
+
+        self.assertEqual(None, c.lookup('foo:bar'))
+        self.assertEqual(None, c.lookup('foo:bar@1'))
+        self.assertEqual(None, c.entry('1234'))
+        self.assertEqual('5678', c.lookup('foo:baz'))
+
+
+class LookupIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_index_persistent(self):
+        i1 = LookupIndex(os.path.join(self.path, 'index.json'))
+        i1.set('template', 'foo:bar', '1234')
+        i1.update('machine', {'foo:bar': '5678', 'foo:baz': '9012'})
+
+        i2 = LookupIndex(os.path.join(self.path, 'index.json'))
+        self.assertEqual('1234', i2.get('template', 'foo:bar'))
+        self.assertEqual('5678', i2.get('machine', 'foo:bar'))
+        self.assertEqual('9012', i2.get('machine', 'foo:baz'))
+        self.assertEqual(None, i2.get('template', 'foo:baz'))
+
+    def test_index_discard(self):
+        i = LookupIndex(os.path.join(self.path, 'index.json'))
+        i.update('template', {'foo:bar': '1234', 'foo:bar@1': '1234', 'foo:baz': '5678'})
+
+        i.discard('template', uuid='1234')
+        self.assertEqual(None, i.get('template', 'foo:bar'))
+        self.assertEqual(None, i.get('template', 'foo:bar@1'))
+
+        i.discard('template', unv='foo:baz')
+        self.assertEqual(None, i.get('template', 'foo:baz'))
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TemplateCacheTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(LookupIndexTestCase)
+    ])
+    unittest.TextTestRunner().run(suite)
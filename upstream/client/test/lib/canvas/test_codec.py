@@ -0,0 +1,48 @@
+
+#
+# TESTS
+#
+
+import json
+
+from unittest import TestCase
+
+from canvas import codec
+
+
+class CodecTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = codec.backend()
+
+    def tearDown(self):
+        codec.set_backend(self.backend)
+
+    def test_codec_backends(self):
+        o = {'n': 'foo', 'z': 1, 'e': None, 'x': [True, 2.5, 'café\x7f', 2 ** 70], 'a': {'c': 'd', 'b': '"'}}
+
+        for b in codec.BACKENDS:
+            try:
+                codec.set_backend(b)
+
+            except ValueError:
+                continue
+
+            self.assertEqual(b, codec.backend())
+
+            # encodings are identical to the standard library's
+            self.assertEqual(json.dumps(o, separators=(',', ':')), codec.dumps(o))
+            self.assertEqual(json.dumps(o, separators=(',', ':'), sort_keys=True), codec.dumps(o, sort_keys=True))
+
+            self.assertEqual(o, codec.loads(codec.dumps(o)))
+            self.assertEqual(o, codec.loads(codec.dumps(o).encode('utf-8')))
+
+    def test_codec_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            codec.set_backend('foo')
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(CodecTestCase)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,167 @@
+
+#
+# TESTS
+#
+
+import gzip
+import http.server
+import socketserver
+import threading
+import time
+import urllib.error
+
+from unittest import TestCase
+
+from canvas.connection import ConnectionPool, build_opener
+
+
+class KeepAliveRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _drop(self):
+        # close the connection without responding
+        self.server.drops += 1
+        self.close_connection = True
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+
+        if self.path == '/drop':
+            return self._drop()
+
+        if self.path == '/missing':
+            self.send_response(404)
+            body = b'{"error":"not found"}'
+
+        elif self.path == '/gzip' and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            body = gzip.compress(b'{"packages":[]}')
+
+        else:
+            self.send_response(200)
+            body = b'{}'
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        # close once idle, as servers do after their keep-alive timeout
+        if self.path == '/idle':
+            self.close_connection = True
+
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+
+        # echo the request body, decoding it if compressed
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if self.path == '/drop':
+            return self._drop()
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionTestCase(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveRequestHandler)
+        self.server.clients = set()
+        self.server.drops = 0
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        pool = ConnectionPool()
+        opener = build_opener(pool=pool)
+
+        for i in range(3):
+            self.assertEqual(b'{}', opener.open(self.url + '/a').read())
+
+        self.assertEqual(1, len(self.server.clients))
+        self.assertEqual(1, len(pool))
+
+        pool.close()
+        self.assertEqual(0, len(pool))
+
+    def test_connection_http_error(self):
+        opener = build_opener()
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            opener.open(self.url + '/missing')
+
+        self.assertEqual(404, cm.exception.code)
+        self.assertEqual(b'{"error":"not found"}', cm.exception.fp.read())
+
+    def test_connection_compressed_response(self):
+        opener = build_opener()
+
+        u = opener.open(self.url + '/gzip')
+
+        self.assertEqual(b'{"packages":[]}', u.read())
+        self.assertEqual(None, u.headers.get('Content-Encoding'))
+
+    def test_connection_compressed_request(self):
+        body = b'{"packages":[]}' * 10
+
+        self.assertEqual(body, build_opener(compress_min=1).open(self.url + '/echo', body).read())
+        self.assertEqual(body, build_opener().open(self.url + '/echo', body).read())
+
+    def test_connection_retry_idempotent(self):
+        opener = build_opener()
+        opener.open(self.url + '/a').read()
+
+        # a lost response to a GET on a reused connection is retried once
+        with self.assertRaises(urllib.error.URLError):
+            opener.open(self.url + '/drop')
+
+        self.assertEqual(2, self.server.drops)
+
+    def test_connection_no_retry_post(self):
+        opener = build_opener()
+        opener.open(self.url + '/a').read()
+
+        # but a POST may have been processed, so is never sent again
+        with self.assertRaises(urllib.error.URLError):
+            opener.open(self.url + '/drop', b'{}')
+
+        self.assertEqual(1, self.server.drops)
+
+    def test_connection_idle_closed(self):
+        pool = ConnectionPool()
+        opener = build_opener(pool=pool)
+
+        opener.open(self.url + '/idle').read()
+        self.assertEqual(1, len(pool))
+
+        # connections closed while idle are discarded rather than reused
+        time.sleep(0.1)
+        self.assertEqual(b'{}', opener.open(self.url + '/echo', b'{}').read())
+        self.assertEqual(2, len(self.server.clients))
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(ConnectionTestCase)
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,342 @@
+
+#
+# TESTS
+#
+
+import asyncio
+import codecs
+import hmac
+import http.cookiejar
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from unittest import TestCase
+
+from canvas.cache import LookupIndex, TemplateCache
+from canvas.localserver import LocalServer, MemoryStore, SQLiteStore, fixtures
+from canvas.service import AsyncService, Service, ServiceException
+from canvas.template import Template
+
+
+class LocalServerTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        self.store = MemoryStore()
+        fixtures(self.store, templates=3, packages=5, repos=2, objects=1)
+
+        self.server = LocalServer(store=self.store, users={'canvas': 'secret'})
+        self.url = self.server.start()
+
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def _service(self, host=None):
+        # an authenticated service keeping its session files under self.path
+        cs = Service(host=host or self.url, index=LookupIndex(os.path.join(self.path, 'index.json')),
+            session_path=os.path.join(self.path, 'session'))
+        cs.authenticate('canvas', 'secret')
+
+        return cs
+
+    def _machines(self, count):
+        # create machines on the t2 template, returning their (uuid, key)
+        self._json('/authenticate.json', {'u': 'canvas', 'p': 'secret'})
+        template = self._json('/api/templates.json?name=t2')[0]['uuid']
+
+        machines = []
+
+        for i in range(count):
+            res = self._json('/api/machines.json', {'name': 'm{0}'.format(i), 'template': template})
+            machines.append((res['uuid'], res['key']))
+
+        return machines
+
+    def _json(self, path, data=None, method=None):
+        if data is not None:
+            data = json.dumps(data).encode('utf-8')
+
+        r = urllib.request.Request(self.url + path, data)
+
+        if method is not None:
+            r.get_method = lambda: method
+
+        return json.loads(self.opener.open(r).read().decode('utf-8'))
+
+    def test_localserver_template_get(self):
+        cs = Service(host=self.url, index=LookupIndex(os.path.join(self.path, 'index.json')),
+            session_path=os.path.join(self.path, 'session'))
+
+        t = cs.template_get(Template('canvas:t0'))
+
+        self.assertEqual(['canvas:t1', 'canvas:t2'], t.includes)
+        self.assertEqual(15, len(t.packages_all))
+        self.assertEqual(6, len(t.repos_all))
+
+        t = cs.template_get(Template('canvas:t0'), resolve_includes=False, fields=['repos'])
+
+        self.assertEqual(0, len(t.packages))
+        self.assertEqual(2, len(t.repos))
+
+    def test_localserver_template_compile(self):
+        cache = TemplateCache(os.path.join(self.path, 'cache'), ttl=60)
+        cs = Service(host=self.url, cache=cache, index=cache.index, session_path=os.path.join(self.path, 'session'))
+
+        (t, m1) = cs.template_compile(Template('canvas:t0'))
+
+        self.assertEqual(t.uuid, m1['uuid'])
+        self.assertEqual(3, len(m1['versions']))
+        self.assertEqual(t.to_kickstart(resolved=True), open(cache.compiled.kickstart(t.uuid)).read())
+
+        # compiled templates are reused, with the same resolved content
+        (t2, m2) = cs.template_get_compiled(Template('canvas:t0'))
+
+        self.assertEqual(m1['compiled'], m2['compiled'])
+        self.assertEqual(t.to_object(resolved=True), t2.to_object(resolved=True))
+        self.assertEqual(m1['digest'], t2.digest())
+        self.assertEqual(['canvas:t1', 'canvas:t2'], sorted({p.template for p in t2.packages} - {t.unv}))
+
+        # an updated include recompiles
+        row = self.store.find('template', stub='t2')[0]
+        row['updated'] = 'later'
+        self.store.put('template', row)
+        cache.invalidate(uuid=row['uuid'])
+
+        (t3, m3) = cs.template_get_compiled(Template('canvas:t0'))
+        self.assertNotEqual(m1['key'], m3['key'])
+        self.assertEqual(m1['digest'], m3['digest'])
+
+    def test_localserver_template_compile_unwritable(self):
+        cache = TemplateCache(os.path.join(self.path, 'cache'), ttl=60)
+        cs = Service(host=self.url, cache=cache, index=cache.index, session_path=os.path.join(self.path, 'session'))
+
+        # a compiled cache that can't be written fails as a service error,
+        # leaving dump and iso to resolve the template directly
+        os.makedirs(cache.path)
+        open(cache.compiled.path, 'w').close()
+
+        with self.assertRaises(ServiceException):
+            cs.template_get_compiled(Template('canvas:t0'))
+
+        t = cs.template_get(Template('canvas:t0'), cached=True)
+        self.assertEqual(['canvas:t1', 'canvas:t2'], sorted({p.template for p in t.packages_all} - {t.unv}))
+
+    def test_localserver_template_index(self):
+        index = LookupIndex(os.path.join(self.path, 'index.json'))
+        cs = Service(host=self.url, index=index, session_path=os.path.join(self.path, 'session'))
+
+        row = self.store.find('template', stub='t1')[0]
+        row['version'] = '2'
+        self.store.put('template', row)
+
+        cs.template_list(user='canvas', public=True)
+
+        # versioned templates are found by the versionless name deletes use
+        self.assertEqual(row['uuid'], index.get('template', 'canvas:t1'))
+        self.assertEqual(row['uuid'], index.get('template', 'canvas:t1@2'))
+
+    def test_localserver_template_cached(self):
+        cache = TemplateCache(os.path.join(self.path, 'cache'), ttl=0)
+        cs = Service(host=self.url, cache=cache, index=cache.index, session_path=os.path.join(self.path, 'session'))
+
+        urls = []
+        open_ = cs._opener.open
+        cs._opener.open = lambda r: urls.append(r.full_url) or open_(r)
+
+        cs.template_get(Template('canvas:t2'), cached=True)
+        self.assertIsNotNone(cache.index.get('template', 'canvas:t2'))
+
+        # a warm cache is revalidated by the update stamp alone
+        del urls[:]
+        t = cs.template_get(Template('canvas:t2'), cached=True)
+
+        self.assertEqual('t2', t.name)
+        self.assertEqual(1, len(urls))
+        self.assertIn('fields=updated', urls[0])
+
+    def test_localserver_authenticate(self):
+        uuid = self._json('/api/templates.json?name=t2')[0]['uuid']
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self._json('/api/template/{0}.json'.format(uuid), {'name': 't2'}, method='PUT')
+
+        self.assertEqual(403, cm.exception.code)
+
+        self._json('/authenticate.json', {'u': 'canvas', 'p': 'secret'})
+        self.assertEqual({}, self._json('/authorised.json'))
+
+        self._json('/api/template/{0}.json'.format(uuid), {'name': 't2', 'packages': []}, method='PUT')
+        self.assertEqual([], self.store.get('template', uuid)['packages'])
+
+    def test_localserver_service_session(self):
+        self._service()
+
+        # the session files are kept where the service was told
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'session')))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'session.verified')))
+
+    def test_localserver_machine_sync(self):
+        self._json('/authenticate.json', {'u': 'canvas', 'p': 'secret'})
+
+        template = self._json('/api/templates.json?name=t2')[0]['uuid']
+        res = self._json('/api/machines.json', {'name': 'm1', 'template': template})
+
+        nonce = 'bar'
+        h = hmac.new(codecs.decode(res['key'], 'hex'), msg=(nonce + res['uuid']).encode('utf-8'), digestmod='sha512')
+
+        # unauthenticated machines sync with their key
+        r = urllib.request.Request('{0}/api/machine/{1}/sync.json'.format(self.url, res['uuid']))
+        r.add_header('x-canvas-nonce', nonce)
+        r.add_header('x-canvas-uuid', res['uuid'])
+        r.add_header('x-canvas-hash', h.hexdigest())
+        r.add_header('x-canvas-template', '1')
+
+        sync = json.loads(urllib.request.urlopen(r).read().decode('utf-8'))
+
+        self.assertEqual('m1', sync['machine']['stub'])
+        self.assertEqual(template, sync['template']['uuid'])
+        self.assertNotIn('key', sync['machine'])
+
+    def test_localserver_templates_get_many(self):
+        with LocalServer(store=self.store, users={'canvas': 'secret'}, latency=0.2) as server:
+            cs = self._service(host=server.url)
+
+            start = time.time()
+            res = cs.templates_get_many([Template('canvas:t{0}'.format(i)) for i in (2, 0, 1)],
+                resolve_includes=False)
+
+            # each get takes two requests, which run concurrently
+            self.assertLess(time.time() - start, 1.0)
+            self.assertEqual(['t2', 't0', 't1'], [t.name for t in res])
+
+            cs.close()
+
+    def test_localserver_templates_get_many_error(self):
+        cs = self._service()
+        templates = [Template('canvas:t0'), Template('canvas:missing'), Template('canvas:t1')]
+
+        with self.assertRaises(ServiceException):
+            cs.templates_get_many(templates, resolve_includes=False)
+
+        res = cs.templates_get_many(templates, resolve_includes=False, return_exceptions=True)
+
+        self.assertEqual('t0', res[0].name)
+        self.assertIsInstance(res[1], ServiceException)
+        self.assertEqual('t1', res[2].name)
+
+    def test_localserver_machines_sync_many(self):
+        machines = self._machines(3)
+        cs = self._service()
+
+        res = cs.machines_sync_many(machines)
+        self.assertEqual(['m0', 'm1', 'm2'], [r['machine']['stub'] for r in res])
+
+        # an unknown machine fails only its own sync
+        machines[1] = ('missing', machines[1][1])
+
+        with self.assertRaises(ServiceException):
+            cs.machines_sync_many(machines)
+
+        res = cs.machines_sync_many(machines, return_exceptions=True)
+
+        self.assertEqual('m0', res[0]['machine']['stub'])
+        self.assertIsInstance(res[1], ServiceException)
+        self.assertEqual('m2', res[2]['machine']['stub'])
+
+    def test_localserver_async_service(self):
+        cs = self._service()
+
+        async def run():
+            async with AsyncService(service=cs, max_concurrency=2) as service:
+                return await asyncio.gather(
+                    service.templates_get_many([Template('canvas:t1'), Template('canvas:t0')], resolve_includes=False),
+                    service.template_list(user='canvas'))
+
+        loop = asyncio.new_event_loop()
+
+        try:
+            (templates, summary) = loop.run_until_complete(run())
+
+        finally:
+            loop.close()
+
+        self.assertEqual(['t1', 't0'], [t.name for t in templates])
+        self.assertEqual(['t0', 't1', 't2'], sorted(t['stub'] for t in summary))
+
+    def test_localserver_async_service_bound(self):
+        with LocalServer(store=self.store, users={'canvas': 'secret'}, latency=0.05) as server:
+            cs = self._service(host=server.url)
+
+            # count requests in flight, including those resolving includes
+            lock = threading.Lock()
+            flight = [0, 0]
+            open_ = cs._opener.open
+
+            def counted(r):
+                with lock:
+                    flight[0] += 1
+                    flight[1] = max(flight)
+
+                try:
+                    return open_(r)
+
+                finally:
+                    with lock:
+                        flight[0] -= 1
+
+            cs._opener.open = counted
+
+            async def run():
+                async with AsyncService(service=cs, max_concurrency=2) as service:
+                    return await service.templates_get_many([Template('canvas:t0')] * 4)
+
+            loop = asyncio.new_event_loop()
+
+            try:
+                res = loop.run_until_complete(run())
+
+            finally:
+                loop.close()
+
+            self.assertEqual(4, len(res))
+            self.assertEqual(15, len(res[0].packages_all))
+            self.assertEqual(2, flight[1])
+
+            cs.close()
+
+    def test_localserver_unknown_route(self):
+        r = urllib.request.Request('{0}/api/template/1234.json'.format(self.url), b'{}')
+        r.get_method = lambda: 'PATCH'
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(r)
+
+        self.assertEqual(302, cm.exception.code)
+
+    def test_localserver_sqlite_store(self):
+        path = os.path.join(self.path, 'canvas.db')
+
+        s1 = SQLiteStore(path)
+        fixtures(s1, templates=2, packages=1)
+        s1.close()
+
+        s2 = SQLiteStore(path)
+        self.assertEqual(['t0', 't1'], [t['stub'] for t in s2.find('template', username='canvas')])
+        s2.close()
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(LocalServerTestCase)
+    unittest.TextTestRunner().run(suite)
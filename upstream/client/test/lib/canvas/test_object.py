@@ -75,6 +75,22 @@ class ObjectTestCase(TestCase):
         l1.add(o3)
         self.assertNotEqual(l1, l2)
 
+    def test_objectset_lookup(self):
+        o1 = Object({'name': 'foo', 'data': 'abc', 'actions': []})
+        o2 = Object({'name': 'bar', 'data': 'xyz', 'actions': []})
+        o3 = Object({'name': 'foo', 'source': 'http://example.com/foo', 'actions': []})
+
+        self.assertIsInstance(hash(o1), int)
+
+        # objects are bucketed on checksum, those without one are found by name
+        l1 = ObjectSet([o1, o2])
+        self.assertEqual(2, len(l1._buckets))
+        self.assertTrue(o3 in l1)
+
+        l2 = ObjectSet([o3])
+        self.assertTrue(o1 in l2)
+        self.assertFalse(o2 in l2)
+
     def test_objectset_update(self):
         o1 = Object({
                 'name': 'foo',
@@ -7,7 +7,7 @@ import dnf
 
 from unittest import TestCase
 
-from canvas.package import Package, PackageSet
+from canvas.package import InstalledIndex, Package, PackageSet, set_substitutions, substitutions
 
 class PackageTestCase(TestCase):
 
@@ -247,6 +247,32 @@ class PackageTestCase(TestCase):
         self.assertEqual(None, p2.release)
         self.assertEqual("x86_64", p2.arch)
 
+    def test_packageset_parse(self):
+        specs = [
+            '# comment',
+            'foo',
+            '~bar:x86_64',
+            '',
+            'baz#1@2.1-3:x86_64',
+            'bad@1.0',
+            '!@core',
+            '  qux  '
+        ]
+
+        (s1, errors) = PackageSet.parse(specs, template='canvas:t0')
+
+        self.assertEqual(['foo', 'bar', 'baz', '@core', 'qux'], [p.name for p in s1])
+        self.assertEqual([(6, 'bad@1.0', 'invalid package format')], errors)
+
+        self.assertEqual(Package.ACTION_EXCLUDE, s1[1].action)
+        self.assertEqual(('1', '2.1', '3', 'x86_64'), (s1[2].epoch, s1[2].version, s1[2].release, s1[2].arch))
+        self.assertTrue(s1[3].ignored)
+        self.assertEqual('canvas:t0', s1[4].template)
+
+        # bulk parsing agrees with parsing one at a time
+        self.assertEqual([Package(p.strip()).to_object() for p in specs if p.strip() and p[0] != '#' and p != 'bad@1.0'],
+                         [p.to_object() for p in s1])
+
     def test_package_excluded(self):
         # Release is required
         p1 = Package("~foo")
@@ -322,9 +348,31 @@ class PackageTestCase(TestCase):
         self.assertRegexpMatches(p5.to_pkg_spec(),
                                  r'^the_silver_searcher-0:0.31.0-1.fc\d{2}.x86_64$')
 
+    def test_package_to_pkg_specs(self):
+        l1 = PackageSet([
+            Package({'n': 'foo'}),
+            Package({'n': 'bar', 'v': '1.0', 'r': '1', 'a': 'x86_64'})
+        ])
+
+        try:
+            set_substitutions({'releasever': '99'})
+            self.assertEqual('99', substitutions()['releasever'])
+            self.assertEqual(['foo', 'bar-1.0-1.fc99.x86_64'], l1.to_pkg_specs())
+
+            # explicit substitutions take precedence
+            self.assertEqual(['foo', 'bar-1.0-1.fc24.x86_64'], l1.to_pkg_specs({'releasever': '24'}))
+
+        finally:
+            set_substitutions()
+
     def test_package_to_json(self):
-        # TODO
-        pass
+        p1 = Package({'n': 'foo', 'e': '1', 'v': '2.0', 'r': '3', 'a': 'x86_64'})
+        self.assertEqual('{"a":"x86_64","e":"1","n":"foo","r":"3","v":"2.0","z":1}', p1.to_json())
+
+        # encodings follow changes to the package
+        p1.action = Package.ACTION_EXCLUDE
+        p1.arch = None
+        self.assertEqual('{"e":"1","n":"foo","r":"3","v":"2.0","z":2}', p1.to_json())
 
 
     def test_package_parse_dnf_invalid(self):
@@ -471,6 +519,73 @@ class PackageTestCase(TestCase):
         self.assertEqual(PackageSet([p5]), luniq1)
         self.assertEqual(PackageSet([p6]), luniq2)
 
+    def test_package_compact(self):
+        p1 = Package({'n': ''.join(['fo', 'o']), 'a': 'x86_64'}, template='canvas:t0')
+        p2 = Package({'n': 'foo', 'a': ''.join(['x86', '_64'])}, template=''.join(['canvas:', 't0']))
+
+        # packages carry no per instance dict and share repeated strings
+        self.assertFalse(hasattr(p1, '__dict__'))
+        self.assertIs(p1.name, p2.name)
+        self.assertIs(p1.arch, p2.arch)
+        self.assertIs(p1.template, p2.template)
+
+    def test_installedindex(self):
+        class Installed(object):
+            def __init__(self, name, arch):
+                self.name = name
+                self.arch = arch
+
+        i1 = Installed('foo', 'x86_64')
+        i2 = Installed('foo', 'i686')
+        i3 = Installed('bar', 'noarch')
+
+        index = InstalledIndex([i1, i2, i3])
+
+        self.assertEqual(3, len(index))
+        self.assertTrue('foo' in index)
+        self.assertEqual(i1, index.get('foo'))
+        self.assertEqual(i2, index.get('foo', 'i686'))
+        self.assertEqual(None, index.get('foo', 'ppc64'))
+        self.assertEqual([i1, i2], index.packages('foo'))
+
+        # packages are looked up in the index rather than the sack
+        self.assertEqual(i2, Package({'n': 'foo', 'a': 'i686'}).to_pkg(index=index))
+        self.assertEqual(i3, Package({'n': 'bar'}).to_pkg(index=index))
+        self.assertEqual(None, Package({'n': 'baz'}).to_pkg(index=index))
+
+    def test_installedindex_match(self):
+        class Installed(object):
+            def __init__(self, name, epoch, version, release, arch):
+                self.name = name
+                self.epoch = epoch
+                self.version = version
+                self.release = release
+                self.arch = arch
+
+        i1 = Installed('foo', 0, '1.0', '1.fc23', 'x86_64')
+        i2 = Installed('foo', 0, '1.0', '1.fc23', 'i686')
+
+        index = InstalledIndex([i1, i2])
+        subs = {'releasever': '23'}
+
+        self.assertEqual([i1, i2], index.match(Package({'n': 'foo'}), subs))
+        self.assertEqual([i2], index.match(Package({'n': 'foo', 'a': 'i686'}), subs))
+        self.assertEqual([i1], index.match(Package({'n': 'foo', 'e': '0', 'v': '1.0', 'r': '1', 'a': 'x86_64'}), subs))
+        self.assertEqual([i1], index.match(Package({'n': 'foo', 'v': '1.0', 'r': '1.fc23', 'a': 'x86_64'}), subs))
+        self.assertEqual([], index.match(Package({'n': 'foo', 'v': '1.1', 'r': '1'}), subs))
+        self.assertEqual([], index.match(Package({'n': 'foo', 'e': '1'}), subs))
+        self.assertEqual([], index.match(Package({'n': 'bar'}), subs))
+
+        # wildcards match as globs, as in ~foo-* excludes
+        i3 = Installed('foo-devel', 0, '1.0', '1.fc23', 'x86_64')
+        i4 = Installed('foo-libs', 0, '2.0', '1.fc23', 'x86_64')
+
+        index = InstalledIndex([i1, i2, i3, i4])
+
+        self.assertEqual([i3, i4], index.match(Package('~foo-*'), subs))
+        self.assertEqual([i4], index.match(Package({'n': 'foo-*', 'v': '2.*', 'r': '*'}), subs))
+        self.assertEqual([i1, i3, i4], index.match(Package({'n': 'foo*', 'a': 'x86_*'}), subs))
+
 
 if __name__ == "__main__":
     import unittest
@@ -0,0 +1,77 @@
+
+#
+# TESTS
+#
+
+from unittest import TestCase
+
+from canvas.package import Package, PackageSet
+from canvas.packagetable import PackageTable, StringDictionary
+
+
+class PackageTableTestCase(TestCase):
+
+    def test_packagetable_roundtrip(self):
+        objects = [
+            {'n': 'foo', 'z': 1},
+            {'n': 'bar', 'e': '1', 'v': '2.0', 'r': '3', 'a': 'x86_64', 'z': 2},
+            {'n': '@core', 'z': 17}
+        ]
+
+        t1 = PackageTable.from_object({'packages': objects})
+
+        self.assertEqual(3, len(t1))
+        self.assertEqual(objects, t1.to_object())
+
+        s1 = t1.to_packageset()
+        self.assertEqual(objects, [p.to_object() for p in s1])
+        self.assertEqual(objects, PackageTable.from_packages(s1).to_object())
+
+    def test_packagetable_filter(self):
+        t1 = PackageTable.from_object([
+            {'n': 'python3-foo', 'a': 'x86_64', 'z': 1},
+            {'n': 'python3-bar', 'z': 2},
+            {'n': 'perl-foo', 'a': 'i686', 'z': 1}
+        ], template='canvas:t0')
+
+        self.assertEqual(['python3-foo', 'python3-bar'], t1.filter(name='python3-*').column('name'))
+        self.assertEqual(['python3-bar'], t1.filter(arch='-').column('name'))
+        self.assertEqual(['perl-foo', 'python3-foo'], t1.filter(action=Package.ACTION_INCLUDE).sort().column('name'))
+        self.assertEqual([], t1.filter(name='python3-*', arch='i*').column('name'))
+        self.assertEqual(3, len(t1.filter(template='canvas:t0')))
+
+    def test_packagetable_diff_join(self):
+        p1 = Package({'n': 'foo'})
+        p2 = Package({'n': 'foo', 'a': 'x'})
+        p3 = Package({'n': 'bar'})
+        p4 = Package({'n': 'bar', 'a': 'y'})
+        p5 = Package({'n': 'baz', 'a': 'x'})
+        p6 = Package({'n': 'baz', 'a': 'y'})
+
+        l1 = PackageSet([p1, p3, p5])
+        l2 = PackageSet([p2, p4, p6])
+
+        # tables with their own dictionary are remapped before comparing
+        t1 = PackageTable.from_packages(l1)
+        t2 = PackageTable.from_packages(l2, strings=StringDictionary())
+
+        (u1, u2) = t1.diff(t2)
+        (s1, s2) = l1.difference(l2)
+
+        self.assertEqual([p.to_object() for p in s1], u1.to_object())
+        self.assertEqual([p.to_object() for p in s2], u2.to_object())
+
+        self.assertEqual([(0, 0), (1, 1)], t1.join(t2))
+
+        # sharing a dictionary is explicit, and avoids the remapping
+        self.assertIsNot(t1.strings, PackageTable().strings)
+
+        t3 = PackageTable.from_packages(l2, strings=t1.strings)
+        self.assertIs(t3, t1._compatible(t3))
+        self.assertEqual(u2.to_object(), t1.diff(t3)[1].to_object())
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(PackageTableTestCase)
+    unittest.TextTestRunner().run(suite)
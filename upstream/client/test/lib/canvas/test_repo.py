@@ -4,6 +4,7 @@
 #
 
 import dnf
+import json
 
 from unittest import TestCase
 
@@ -202,6 +203,21 @@ class RepoTestCase(TestCase):
         self.assertEqual(repr(r1),
                          'Repository: {"e":true,"i":false,"n":"Korora 23 - i386 - Updates","s":"korora-23-i386-updates","z":1}')
 
+    def test_repo_to_json(self):
+        r1 = Repository({'n': 'test', 's': 'foo', 'xp': ['bar']})
+        self.assertEqual('{"i":false,"n":"test","s":"foo","xp":["bar"],"z":1}', r1.to_json())
+
+        # encodings follow changes to the repo, including in place
+        r1.exclude_packages.append('baz')
+        r1.baseurl = 'http://foo'
+        self.assertEqual('{"bu":"http://foo","i":false,"n":"test","s":"foo","xp":["bar","baz"],"z":1}', r1.to_json())
+
+        r2 = Repository({'n': 'test', 's': 'foo', 'bu': ['http://foo'], 'gk': ['file:///key1']})
+        self.assertEqual(r2.to_object(), json.loads(r2.to_json()))
+
+        r2.baseurl.append('http://bar')
+        r2.gpgkey[0] = 'file:///key2'
+        self.assertEqual(r2.to_object(), json.loads(r2.to_json()))
 
     def test_repo_equality(self):
         r1 = Repository({'n':'test', 's': 'foo'})
@@ -0,0 +1,130 @@
+
+#
+# TESTS
+#
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+
+from unittest import TestCase
+
+from canvas.cache import LookupIndex
+from canvas.service import Service, ServiceException
+from canvas.template import Template
+
+
+class StubOpener(object):
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def open(self, r):
+        self.requests.append(r)
+        res = self.responses.pop(0)
+
+        if isinstance(res, Exception):
+            raise res
+
+        return res
+
+
+def _error(code, error):
+    body = json.dumps({'error': error}).encode('utf-8')
+    return urllib.error.HTTPError('http://localhost/', code, 'error', {}, io.BytesIO(body))
+
+
+class ServiceTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        self.cs = Service(host='http://localhost', session_path=os.path.join(self.path, 'session'))
+        self.cs._authenticated = True
+
+        self.forced = []
+        self.cs.authenticate = lambda force=False: self.forced.append(force)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_service_open_denied(self):
+        self.cs._opener = StubOpener([_error(403, 'access denied')])
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.cs._open(urllib.request.Request('http://localhost/api/templates.json'))
+
+        # denied requests are not retried and keep their error body
+        self.assertEqual([], self.forced)
+        self.assertEqual({'error': 'access denied'}, json.loads(cm.exception.fp.read().decode('utf-8')))
+
+    def test_service_open_expired(self):
+        for e in (_error(401, ''), _error(403, 'not authenticated.')):
+            self.forced = []
+            self.cs._opener = StubOpener([e, 'ok'])
+
+            self.assertEqual('ok', self.cs._open(urllib.request.Request('http://localhost/api/templates.json')))
+            self.assertEqual([True], self.forced)
+            self.assertEqual(2, len(self.cs._opener.requests))
+
+    def test_service_index_request(self):
+        self.cs._index = LookupIndex(os.path.join(self.path, 'index.json'))
+        self.cs._index.set('template', 'foo:bar', '1234')
+
+        # errors other than a missing uuid keep the lookup, and a failed
+        # delete is not sent again
+        self.cs._opener = StubOpener([_error(500, 'internal server error.')])
+
+        with self.assertRaises(ServiceException):
+            self.cs._index_request('template', 'foo:bar', method='DELETE')
+
+        self.assertEqual(1, len(self.cs._opener.requests))
+        self.assertEqual('1234', self.cs._index.get('template', 'foo:bar'))
+
+        self.cs._opener = StubOpener([_error(500, 'internal server error.'), _error(404, 'not found')])
+
+        self.assertEqual(None, self.cs._index_request('template', 'foo:bar'))
+        self.assertEqual('1234', self.cs._index.get('template', 'foo:bar'))
+
+        self.assertEqual(None, self.cs._index_request('template', 'foo:bar'))
+        self.assertEqual(None, self.cs._index.get('template', 'foo:bar'))
+
+    def test_service_template_update(self):
+        t = Template({'uuid': '1234', 'user': 'foo', 'stub': 'bar', 'updated': 10})
+        ok = io.BytesIO(b'{}')
+
+        # full updates unless delta updates are enabled
+        self.cs._opener = StubOpener([ok])
+        self.cs.template_update(t)
+
+        self.assertEqual(['PUT'], [r.get_method() for r in self.cs._opener.requests])
+
+        cs = Service(host='http://localhost', delta_updates=True, session_path=os.path.join(self.path, 'session'))
+        cs.authenticate = lambda force=False: None
+        cs._opener = StubOpener([io.BytesIO(b'{}')])
+        cs.template_update(t)
+
+        self.assertEqual(['PATCH'], [r.get_method() for r in cs._opener.requests])
+
+    def test_service_session_stamp(self):
+        self.cs._session_stamp_set(10)
+        self.assertEqual(10, self.cs._session_stamp_get())
+
+        self.cs._session_stamp_set(None)
+        self.assertEqual(None, self.cs._session_stamp_get())
+
+        # written by replacing, leaving no temporary files behind
+        self.assertEqual(['session.verified'], os.listdir(self.path))
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(ServiceTestCase)
+    ])
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,98 @@
+
+#
+# TESTS
+#
+
+from unittest import TestCase
+
+from canvas.package import Package, PackageSet
+from canvas.repository import Repository, RepoSet
+from canvas.set import CanvasSet
+
+
+class CanvasSetTestCase(TestCase):
+
+    def test_set_ordered(self):
+        s1 = CanvasSet(['c', 'a', 'b', 'a'])
+
+        self.assertEqual(['c', 'a', 'b'], list(s1))
+        self.assertEqual('a', s1[1])
+        self.assertTrue('b' in s1)
+
+        s1.discard('a')
+        s1.add('a')
+        self.assertEqual(['c', 'b', 'a'], s1.as_list())
+
+        with self.assertRaises(ValueError):
+            s1.discard('d')
+
+    def test_set_union_difference(self):
+        s1 = CanvasSet(['a', 'b'])
+        s2 = CanvasSet(['b', 'c'])
+
+        self.assertEqual(['a', 'b', 'c'], list(s1.union(s2)))
+
+        (u1, u2) = s1.difference(s2)
+        self.assertEqual(['a'], list(u1))
+        self.assertEqual(['c'], list(u2))
+
+    def test_set_modify_while_iterating(self):
+        s1 = RepoSet([Repository({'s': 'a', 'n': 'A'}), Repository({'s': 'b', 'n': 'B'})])
+
+        for r in s1:
+            s1.discard(r)
+
+        self.assertEqual(0, len(s1))
+
+    def test_set_snapshot(self):
+        s1 = CanvasSet(['a', 'b'])
+
+        # indexing and iteration share a snapshot until the set changes
+        self.assertIs(s1._snapshot(), s1._snapshot())
+
+        i1 = iter(s1)
+        s1.add('c')
+
+        self.assertEqual(['a', 'b'], list(i1))
+        self.assertEqual('c', s1[2])
+
+    def test_set_digest(self):
+        s1 = PackageSet([Package({'n': 'foo'}), Package({'n': 'bar'})])
+        d1 = s1.digest()
+
+        u1 = s1.union(PackageSet([Package({'n': 'baz'})]))
+        self.assertNotEqual(d1, u1.digest())
+        self.assertEqual(d1, PackageSet(u1.as_list()[:2]).digest())
+
+        s1.discard(Package({'n': 'bar'}))
+        s1.add(Package({'n': 'bar'}))
+        self.assertEqual(d1, s1.digest())
+
+        s1.add(Package({'n': 'foo', 'a': 'x86_64'}))
+        self.assertNotEqual(d1, s1.digest())
+
+    def test_packageset_arch(self):
+        s1 = PackageSet([Package('foo'), Package('bar')])
+
+        # arch-less packages match any arch
+        self.assertTrue(Package({'n': 'foo', 'a': 'x86_64'}) in s1)
+        self.assertFalse('foo' in s1)
+
+        # a more explicit arch replaces the arch-less package in place
+        s1.add(Package({'n': 'foo', 'a': 'x86_64'}))
+        self.assertEqual(['foo', 'bar'], [p.name for p in s1])
+        self.assertEqual('x86_64', s1[0].arch)
+
+        # but other archs are kept alongside
+        s1.add(Package({'n': 'foo', 'a': 'i686'}))
+        s1.add(Package('foo'))
+        self.assertEqual(['x86_64', None, 'i686'], [p.arch for p in s1])
+
+        s1.discard(Package({'n': 'foo', 'a': 'x86_64'}))
+        self.assertEqual(['bar', 'foo'], [p.name for p in s1])
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(CanvasSetTestCase)
+    unittest.TextTestRunner().run(suite)
@@ -3,12 +3,15 @@
 # TESTS
 #
 
+import io
+import json
+
 from unittest import TestCase
 
 from canvas.template import Template
 from canvas.object import ObjectSet
 from canvas.package import Package, PackageSet
-from canvas.repository import RepoSet
+from canvas.repository import RepoSet, Repository
 
 
 class TemplateTestCase(TestCase):
@@ -140,6 +143,241 @@ class TemplateTestCase(TestCase):
         t1.includes = [t3, t2]
         self.assertEqual(PackageSet([p1, p2, p4]), t1.packages_all)
 
+    def test_template_views_memoised(self):
+        t1 = Template('foo:bar')
+        t1.add_package(Package('foo'))
+
+        p1 = t1.packages_all
+        self.assertIs(p1, t1.packages_all)
+
+        # changes to the underlying sets invalidate the view
+        t1.add_package(Package('bar'))
+        p2 = t1.packages_all
+        self.assertIsNot(p1, p2)
+        self.assertEqual(PackageSet([Package('foo'), Package('bar')]), p2)
+
+        # as do changes made to the view itself
+        p2.add(Package('baz'))
+        self.assertEqual(PackageSet([Package('foo'), Package('bar')]), t1.packages_all)
+
+    def test_template_flatten_incremental(self):
+        t1 = Template({'user': 'foo', 'stub': 't1', 'packages': [{'n': 'foo', 'z': 1}, {'n': 'bar', 'a': 'x86_64'}]})
+        t2 = Template({'user': 'foo', 'stub': 't2', 'packages': [{'n': 'foo', 'z': 2}, {'n': 'bar'}, {'n': 'baz'}]})
+
+        t0 = Template('foo:t0')
+        t0.add_include(t1)
+
+        s1 = t0.packages_all
+        self.assertIs(s1, t0.packages_all)
+
+        # flattening unchanged includes again is a no-op
+        t0.includes = [t1]
+        self.assertIs(s1, t0.packages_all)
+
+        # later includes take precedence, but explicit archs are kept
+        t0.add_include(t2)
+        self.assertEqual(['foo:t1', 'foo:t2'], t0.includes)
+        self.assertEqual(['foo', 'bar', 'baz'], [p.name for p in t0.packages_all])
+        self.assertTrue(t0.packages_all[0].excluded)
+        self.assertEqual('x86_64', t0.packages_all[1].arch)
+
+        # replacing an include drops the content of the one replaced
+        t0.add_include(Template({'user': 'foo', 'stub': 't2', 'packages': [{'n': 'qux'}]}))
+        self.assertEqual(['foo:t1', 'foo:t2'], t0.includes)
+        self.assertEqual(['qux', 'foo', 'bar'], [p.name for p in t0.packages_all])
+        self.assertTrue(t0.packages_all[1].included)
+
+    def test_template_flatten_order(self):
+        def obj(name):
+            return {'name': name, 'source': 'raw', 'data': name, 'actions': [{'type': 'ks-post'}]}
+
+        a = Template({'user': 'foo', 'stub': 'a', 'objects': [obj('a1'), obj('shared')]})
+        b = Template({'user': 'foo', 'stub': 'b', 'objects': [obj('b1'), obj('shared')]})
+
+        # objects of later includes come first, ahead of the template's own
+        t = Template({'user': 'foo', 'stub': 't', 'objects': [obj('t1')]})
+        t.includes = [a, b]
+        self.assertEqual(['b1', 'shared', 'a1', 't1'], [o.name for o in t.objects_all])
+
+        t.includes = [a, Template({'user': 'foo', 'stub': 'b', 'objects': [obj('b1')]})]
+        self.assertEqual(['b1', 'a1', 'shared', 't1'], [o.name for o in t.objects_all])
+
+        # appending an include flattens the same as including it up front
+        t = Template({'user': 'foo', 'stub': 't', 'objects': [obj('t1')]})
+        t.add_include(a)
+        t.add_include(b)
+        self.assertEqual(['b1', 'shared', 'a1', 't1'], [o.name for o in t.objects_all])
+
+    def test_template_digest(self):
+        t1 = Template({'user': 'foo', 'stub': 'bar', 'packages': [{'n': 'foo'}, {'n': 'bar'}],
+            'objects': [{'name': 'post', 'source': 'raw', 'data': 'echo hi\n', 'actions': [{'type': 'ks-post'}]}]})
+        t2 = Template({'user': 'baz', 'stub': 'qux', 'packages': [{'n': 'foo'}, {'n': 'bar'}],
+            'objects': [{'name': 'post', 'source': 'raw', 'data': 'echo hi\n', 'actions': [{'type': 'ks-post'}]}]})
+
+        # digests cover content only, and are stable
+        d1 = t1.digest()
+        self.assertEqual(d1, t2.digest())
+        self.assertEqual(d1, t1.digest())
+
+        # and change with the content, order or includes
+        t1.add_package(Package('baz'))
+        self.assertNotEqual(d1, t1.digest())
+
+        t3 = Template({'user': 'foo', 'stub': 'bar', 'packages': [{'n': 'bar'}, {'n': 'foo'}],
+            'objects': [{'name': 'post', 'source': 'raw', 'data': 'echo hi\n', 'actions': [{'type': 'ks-post'}]}]})
+        self.assertNotEqual(d1, t3.digest())
+
+        t2.add_include(Template({'user': 'baz', 'stub': 'inc', 'packages': [{'n': 'qux'}]}))
+        self.assertNotEqual(d1, t2.digest())
+        self.assertNotEqual(t2.digest(), t2.digest(resolved=True))
+
+    def test_template_write_kickstart(self):
+        t1 = Template({'uuid': '1234', 'user': 'foo', 'stub': 'bar', 'name': 'Bar', 'description': 'baz',
+            'packages': [{'n': 'b'}, {'n': 'a'}, {'n': 'c', 'z': 2}, {'n': '@core'}],
+            'objects': [{'name': 'post', 'source': 'raw', 'data': 'echo hi\n', 'actions': [{'type': 'ks-post'}]}]})
+
+        f = io.StringIO()
+        t1.write_kickstart(f)
+
+        self.assertEqual(t1.to_kickstart(), f.getvalue())
+        self.assertEqual(
+            '# Canvas generated template - bar\n# UUID: 1234\n# Author: foo\n# Title: Bar\n# Description:\n# baz\n\n'
+            '%post\necho hi\n%end\n\n'
+            '%packages\n\n@core\na\nb\n-c\n%end\n', f.getvalue())
+
+    def test_template_to_json(self):
+        t1 = Template({'uuid': '1234', 'user': 'foo', 'stub': 'bar', 'name': 'Bar', 'includes': ['foo:inc'],
+            'packages': [{'n': 'b'}, {'n': 'a', 'a': 'x86_64'}], 'repos': [{'s': 'r', 'n': 'R'}],
+            'objects': [{'name': 'post', 'source': 'raw', 'data': 'echo hi\n', 'actions': [{'type': 'ks-post'}]}],
+            'meta': {'kickstart': {'lang': 'en_AU'}}})
+        t1.add_include(Template({'user': 'foo', 'stub': 'inc', 'packages': [{'n': 'c'}]}))
+
+        self.assertEqual(t1.to_object(), json.loads(t1.to_json()))
+        self.assertEqual(t1.to_object(resolved=True), json.loads(t1.to_json(resolved=True)))
+        self.assertEqual(t1.to_json(), t1.to_json())
+
+    def test_template_lazy(self):
+        # content is only built on access, so invalid packages go unnoticed
+        # until then
+        t1 = Template({'uuid': '1234', 'user': 'foo', 'stub': 'bar', 'packages': [{'v': '1.0'}]})
+        self.assertEqual('1234', t1.uuid)
+        self.assertEqual('foo:bar', t1.unv)
+
+        with self.assertRaises(ValueError):
+            t1.packages
+
+        # content is attributed to the template as parsed
+        t2 = Template({'user': 'foo', 'stub': 'bar', 'packages': [{'n': 'foo'}], 'repos': [{'s': 'r', 'n': 'R'}]})
+        t2.parse('foo:baz')
+        self.assertEqual(['foo:bar'], [p.template for p in t2.packages])
+        self.assertEqual(['foo:bar'], [r.template for r in t2.repos])
+
+        # and replaced when parsing new content
+        t2.parse({'user': 'foo', 'stub': 'qux', 'packages': [{'n': 'bar'}]})
+        self.assertEqual(['bar'], [p.name for p in t2.packages])
+        self.assertEqual(0, len(t2.repos))
+
+        t2.clear()
+        self.assertEqual(0, len(t2.packages))
+
+    def test_template_add_packages(self):
+        t1 = Template({'uuid': '1234', 'user': 'foo', 'stub': 'bar', 'packages': [{'n': 'foo'}]})
+        t1.add_package(Package('bar'))
+
+        s1 = t1.add_packages([
+            Package('foo'),
+            Package({'n': 'bar', 'a': 'x86_64'}),
+            Package('baz'),
+            Package('baz')
+        ])
+
+        self.assertEqual(['baz'], [p.name for p in s1['added']])
+        self.assertEqual(['foo'], [p.name for p in s1['present']])
+        self.assertEqual(['bar'], [p.name for p in s1['replaced']])
+        self.assertEqual(['x86_64', None], [p.arch for p in t1.packages_delta])
+
+        s2 = t1.remove_packages([Package('foo'), Package('baz'), Package('daz')])
+
+        self.assertEqual(['foo', 'baz'], [p.name for p in s2['removed']])
+        self.assertEqual(['daz'], [p.name for p in s2['missing']])
+
+    def test_template_lazy_retry(self):
+        t1 = Template({'user': 'foo', 'stub': 'bar', 'repos': [{'s': 'foo'}, {'s': 'bar', 'n': 'Bar'}]})
+
+        # a failed build keeps the raw data, so it fails again rather than
+        # returning an empty set
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                t1.repos
+
+        t1._raw['repos'][0]['n'] = 'Foo'
+        self.assertEqual(['foo', 'bar'], [r.stub for r in t1.repos])
+        self.assertNotIn('repos', t1._raw)
+
+    def test_template_to_delta_repos(self):
+        t1 = Template({
+            'uuid': '1234',
+            'user': 'foo',
+            'stub': 'bar',
+            'repos': [{'s': 'foo', 'n': 'Foo'}, {'s': 'bar', 'n': 'Bar'}]
+        })
+
+        t1.update_repo(Repository({'s': 'foo', 'n': 'Foo updated'}))
+        t1.remove_repo(Repository({'s': 'foo', 'n': 'Foo'}))
+        t1.remove_repo(Repository({'s': 'bar', 'n': 'Bar'}))
+        t1.add_repo(Repository({'s': 'bar', 'n': 'Bar again'}))
+
+        d1 = t1.to_delta()
+        self.assertEqual(['Bar again'], [r['n'] for r in d1['repos']['add']])
+        self.assertEqual(['foo'], [r['s'] for r in d1['repos']['remove']])
+
+    def test_template_to_delta(self):
+        t1 = Template({
+            'uuid': '1234',
+            'user': 'foo',
+            'stub': 'bar',
+            'updated': 10,
+            'packages': [{'n': 'foo'}, {'n': 'bar'}]
+        })
+
+        t1.add_package(Package('baz'))
+        t1.remove_package(Package('foo'))
+
+        d1 = t1.to_delta()
+        self.assertEqual('1234', d1['uuid'])
+        self.assertEqual(10, d1['updated'])
+        self.assertEqual(['baz'], [p['n'] for p in d1['packages']['add']])
+        self.assertEqual(['foo'], [p['n'] for p in d1['packages']['remove']])
+        self.assertEqual({'add': [], 'remove': []}, d1['repos'])
+
+        # removing an unsent addition leaves nothing to send
+        t1.remove_package(Package('baz'))
+        self.assertEqual([], t1.to_delta()['packages']['add'])
+
+        # removing an update still removes the server's package
+        t1.update_package(Package('bar@1.0-1'))
+        t1.remove_package(Package('bar'))
+
+        d2 = t1.to_delta()
+        self.assertEqual([], d2['packages']['add'])
+        self.assertEqual(['bar', 'foo'], sorted(p['n'] for p in d2['packages']['remove']))
+
+        # re-adding cancels the removal, replacing the server's package
+        t1.add_package(Package('foo@2.0-1'))
+
+        d3 = t1.to_delta()
+        self.assertEqual([('foo', '2.0')], [(p['n'], p['v']) for p in d3['packages']['add']])
+        self.assertEqual(['bar'], [p['n'] for p in d3['packages']['remove']])
+
+        t1.remove_package(Package('foo'))
+        self.assertEqual(['bar', 'foo'], sorted(p['n'] for p in t1.to_delta()['packages']['remove']))
+
+        # unfetched and cleared templates can only be sent in full
+        self.assertEqual(None, Template('foo:bar').to_delta())
+
+        t1.clear()
+        self.assertEqual(None, t1.to_delta())
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+
+#
+# TESTS
+#
+
+import json
+
+from unittest import TestCase
+
+from canvas.timing import Histogram, Timings, span
+
+
+class TimingTestCase(TestCase):
+
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEqual(None, h.percentile(50))
+
+        for v in (0.5, 3, 4, 40, 900):
+            h.add(v)
+
+        self.assertEqual(5, h.count)
+        self.assertEqual(5, h.percentile(50))
+        self.assertEqual(900, h.percentile(100))
+        self.assertEqual(0.5, h.to_object()['min'])
+
+    def test_timings_request(self):
+        records = []
+        t = Timings(hook=records.append)
+
+        t.request('GET', 'http://localhost/api/template/1234.json?fields=packages', 200, 0, 100, 0.01, 0.02, 0.03)
+        t.request('GET', 'http://localhost/api/template/5678.json', 500, 0, 10, 0, 0.01, 0.01)
+        t.request('PUT', 'http://localhost/api/template/5678.json', 200, 50, 10, 0, 0.01, 0.01)
+
+        self.assertEqual(3, len(records))
+        self.assertEqual('/api/template/:uuid.json', records[0]['endpoint'])
+
+        o = json.loads(t.to_json())['endpoints']
+        self.assertEqual(['GET /api/template/:uuid.json', 'PUT /api/template/:uuid.json'], sorted(o.keys()))
+
+        e = o['GET /api/template/:uuid.json']
+        self.assertEqual(2, e['count'])
+        self.assertEqual(1, e['errors'])
+        self.assertEqual(110, e['received'])
+        self.assertEqual(1, e['connects'])
+
+        self.assertIn('PUT /api/template/:uuid.json', t.summary())
+
+    def test_timings_span(self):
+        t = Timings()
+
+        with t.span('authenticate'):
+            pass
+
+        # spans without timings are no-ops
+        with span(None, 'authenticate'):
+            pass
+
+        self.assertEqual(1, t.to_object()['phases']['authenticate']['count'])
+
+
+if __name__ == "__main__":
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(TimingTestCase)
+    unittest.TextTestRunner().run(suite)
@@ -32,6 +32,28 @@ use Time::Piece;
 # LOCAL INCLUDES
 #
 
+#
+# Limits a template (or list of templates) to the comma separated fields
+# requested via the "fields" parameter. Identifying fields and includes are
+# always returned.
+#
+sub _fields_project {
+  my ($c, $data) = @_;
+
+  my $fields = $c->param('fields');
+  return $data unless defined $fields;
+
+  my %keep = map { $_ => 1 }
+    (qw(uuid name stub username version includes updated), split /,/, $fields);
+
+  my $project = sub {
+    my $t = shift;
+    return { map { $_ => $t->{$_} } grep { $keep{$_} } keys %$t };
+  };
+
+  return ref $data eq 'ARRAY' ? [ map { $project->($_) } @$data ] : $project->($data);
+}
+
 sub alpha { shift->render('alpha'); }
 sub index { shift->render('index'); }
 
@@ -175,7 +197,7 @@ sub templates_get {
 
       return $c->render(status => 500, json => {error => $err}) if $err;
 
-      $c->render(status  => 200, json => $templates->to_array);
+      $c->render(status  => 200, json => $c->_fields_project($templates->to_array));
     }
   );
 };
@@ -261,7 +283,7 @@ sub template_get {
       # only expect one template
       my $template = $templates->first;
 
-      $c->render(json => $template);
+      $c->render(json => $c->_fields_project($template));
     }
   );
 }